@@ -0,0 +1,113 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import os
+import random
+import tempfile
+import time
+from typing import Optional
+
+import fire
+
+from benchmarks.fake_openai import FakeOpenAIServer, generation_completion, run_fake_openai
+from benchmarks.report import TimedRateLimiter, build_result, check_regression, log_result, save_result
+from wgpt.data.generate import DataGenerationEngine
+from wgpt.openai.backend import HTTPChatBackend
+from wgpt.openai.client import GPTClient
+
+
+def count_lines(file_path: str) -> int:
+    if not os.path.isfile(file_path):
+        return 0
+    with open(file_path) as file_object:
+        return sum(1 for line in file_object if line.strip())
+
+
+def bench_generation(
+        num_samples: int = 2000,
+        num_samples_per_batch: int = 5,
+        num_rounds_per_call: int = 4,
+        num_completion: int = 1,
+        max_concurrency: int = 64,
+        pipeline: bool = False,
+        stream: bool = False,
+        http_backend: bool = False,
+        latency_ms: float = 50.0,
+        jitter_ms: float = 20.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        invalid_rate: float = 0.05,
+        seed: int = 42,
+        output_path: Optional[str] = None,
+        baseline_path: Optional[str] = None,
+        tolerance: float = 0.2,
+) -> None:
+    random.seed(seed)
+    server = FakeOpenAIServer(
+        completion_fn=functools.partial(
+            generation_completion, num_samples=num_samples_per_batch, invalid_rate=invalid_rate
+        ),
+        latency_ms=latency_ms,
+        jitter_ms=jitter_ms,
+        error_rate=error_rate,
+        rate_limit_rate=rate_limit_rate,
+        seed=seed,
+    )
+    rate_limiter = TimedRateLimiter(max_concurrency=max_concurrency)
+    engine = DataGenerationEngine(num_samples_per_batch=num_samples_per_batch)
+
+    with tempfile.TemporaryDirectory() as work_dir, run_fake_openai(server=server):
+        gpt_client = GPTClient(
+            num_completion=num_completion,
+            max_concurrency=max_concurrency,
+            rate_limiter=rate_limiter,
+            backend=HTTPChatBackend(base_url=server.base_url) if http_backend else None,
+        )
+        data_file_path = os.path.join(work_dir, "data.jsonl")
+        fails_file_path = os.path.join(work_dir, "fails.jsonl")
+
+        start_time = time.perf_counter()
+        engine.generate_data(
+            gpt_client=gpt_client,
+            data_file_path=data_file_path,
+            fails_file_path=fails_file_path,
+            num_samples=num_samples,
+            num_rounds_per_call=num_rounds_per_call,
+            pipeline=pipeline,
+            stream=stream,
+        )
+        elapsed_seconds = time.perf_counter() - start_time
+
+        num_parsed = count_lines(data_file_path)
+        num_fails = count_lines(fails_file_path)
+
+    mode = "stream" if stream else "pipeline" if pipeline else "rounds"
+    result = build_result(
+        name=f"generation-{mode}{'-http' if http_backend else ''}",
+        num_samples=num_parsed,
+        num_requests=server.num_requests,
+        elapsed_seconds=elapsed_seconds,
+        latencies=rate_limiter.latencies,
+        parse_yield=num_parsed / max(num_parsed + num_fails, 1),
+        num_errors=server.num_errors,
+        num_rate_limited=server.num_rate_limited,
+    )
+    log_result(result=result)
+    save_result(result=result, output_path=output_path)
+    check_regression(result=result, baseline_path=baseline_path, tolerance=tolerance)
+
+
+if __name__ == "__main__":
+    fire.Fire(bench_generation)
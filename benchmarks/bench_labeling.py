@@ -0,0 +1,110 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import time
+from typing import Optional
+
+import fire
+
+from benchmarks.fake_openai import (
+    ASSESSMENT_VALUES,
+    FakeOpenAIServer,
+    labeling_completion,
+    random_weather_sample,
+    run_fake_openai,
+)
+from benchmarks.report import TimedRateLimiter, build_result, check_regression, log_result, save_result
+from wgpt.eval.labeling import Labeler
+from wgpt.openai.backend import HTTPChatBackend
+from wgpt.openai.client import GPTClient
+from wgpt.openai.executor import IndexedExecutor
+
+
+def bench_labeling(
+        num_samples: int = 2000,
+        max_concurrency: int = 64,
+        max_attempts: int = 3,
+        http_backend: bool = False,
+        latency_ms: float = 50.0,
+        jitter_ms: float = 20.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        seed: int = 42,
+        output_path: Optional[str] = None,
+        baseline_path: Optional[str] = None,
+        tolerance: float = 0.2,
+) -> None:
+    rng = random.Random(seed)
+    server = FakeOpenAIServer(
+        completion_fn=labeling_completion,
+        latency_ms=latency_ms,
+        jitter_ms=jitter_ms,
+        error_rate=error_rate,
+        rate_limit_rate=rate_limit_rate,
+        seed=seed,
+    )
+    rate_limiter = TimedRateLimiter(max_concurrency=max_concurrency)
+
+    with run_fake_openai(server=server):
+        gpt_client = GPTClient(
+            max_concurrency=max_concurrency,
+            rate_limiter=rate_limiter,
+            backend=HTTPChatBackend(base_url=server.base_url) if http_backend else None,
+        )
+        # Labeling requests never touch the model, the wrapper is left out to keep the benchmark on the client
+        labeler = Labeler(
+            wrapper=None,  # type: ignore[arg-type]
+            gpt_client=gpt_client,
+            num_requests=max_concurrency,
+            executor=IndexedExecutor(gpt_client=gpt_client, max_attempts=max_attempts),
+        )
+
+        prompts = list()
+        for _ in range(num_samples):
+            description, json_string = random_weather_sample(rng=rng).split("\nOutput: ")
+            prompts.append(
+                labeler.format_prompt(
+                    weather_description=description[len("Input: "):],
+                    generated_json_string=json_string,
+                    true_json_string=json_string,
+                )
+            )
+
+        start_time = time.perf_counter()
+        raw_assessments = labeler.label_batch(prompts=prompts)
+        elapsed_seconds = time.perf_counter() - start_time
+
+    assessments = [labeler.parse_assessment(text) for text in raw_assessments if text.strip()]
+    # Assessment is parsed to its first word
+    valid_assessments = {value.split()[0] for value in ASSESSMENT_VALUES}
+    num_parsed = sum(assessment in valid_assessments for assessment in assessments)
+
+    result = build_result(
+        name=f"labeling{'-http' if http_backend else ''}",
+        num_samples=len(assessments),
+        num_requests=server.num_requests,
+        elapsed_seconds=elapsed_seconds,
+        latencies=rate_limiter.latencies,
+        parse_yield=num_parsed / max(num_samples, 1),
+        num_errors=server.num_errors,
+        num_rate_limited=server.num_rate_limited,
+    )
+    log_result(result=result)
+    save_result(result=result, output_path=output_path)
+    check_regression(result=result, baseline_path=baseline_path, tolerance=tolerance)
+
+
+if __name__ == "__main__":
+    fire.Fire(bench_labeling)
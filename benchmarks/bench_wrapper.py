@@ -0,0 +1,142 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import tempfile
+import time
+from typing import List, Optional
+
+import fire
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+from benchmarks.fake_openai import random_weather_sample
+from benchmarks.report import build_result, check_regression, log_result, save_result
+from wgpt import enums
+from wgpt.eval.parse import parse_accuracy
+from wgpt.eval.wrapper import WGPTWrapper
+
+END_OF_TEXT_TOKEN = "<|endoftext|>"
+
+
+def build_tiny_model(
+        model_dir: str,
+        texts: List[str],
+        vocab_size: int = 512,
+        hidden_size: int = 64,
+        num_layers: int = 2,
+        num_heads: int = 2,
+        seed: int = 42,
+) -> None:
+    # Randomly initialized GPT-2 with a byte level BPE tokenizer trained on the given texts. Weights are random,
+    # so outputs are noise, but the compute per token has the shape of a real causal LM
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=[END_OF_TEXT_TOKEN],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(texts, trainer=trainer)
+
+    hf_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token=END_OF_TEXT_TOKEN,
+        bos_token=END_OF_TEXT_TOKEN,
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    hf_tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    config = GPT2Config(
+        vocab_size=len(hf_tokenizer),
+        n_positions=1024,
+        n_embd=hidden_size,
+        n_layer=num_layers,
+        n_head=num_heads,
+        bos_token_id=hf_tokenizer.bos_token_id,
+        eos_token_id=hf_tokenizer.eos_token_id,
+    )
+    GPT2LMHeadModel(config).save_pretrained(model_dir)
+
+
+def bench_wrapper(
+        num_texts: int = 64,
+        batch_size: int = 16,
+        max_new_tokens: int = 32,
+        batching: str = enums.Batching.fixed,
+        constrained: bool = False,
+        speculation: Optional[str] = None,
+        num_threads: Optional[int] = None,
+        num_repeats: int = 5,
+        hidden_size: int = 64,
+        num_layers: int = 2,
+        seed: int = 42,
+        output_path: Optional[str] = None,
+        baseline_path: Optional[str] = None,
+        tolerance: float = 0.2,
+) -> None:
+    rng = random.Random(seed)
+    samples = [random_weather_sample(rng=rng) for _ in range(max(num_texts, 256))]
+    texts = [sample.split("\nOutput: ")[0][len("Input: "):] + "\n" for sample in samples[:num_texts]]
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        build_tiny_model(
+            model_dir=model_dir,
+            texts=samples,
+            hidden_size=hidden_size,
+            num_layers=num_layers,
+            seed=seed,
+        )
+        wrapper = WGPTWrapper(
+            model_name_or_path=model_dir,
+            batch_size=batch_size,
+            max_new_tokens=max_new_tokens,
+            batching=batching,
+            device="cpu",
+            num_threads=num_threads,
+            constrained=constrained,
+            speculation=speculation,
+        )
+
+    # First call warms up kernels and allocator, it is not measured
+    wrapper.generate(texts=texts)
+
+    latencies = list()
+    generated_texts: List[str] = list()
+    for _ in range(num_repeats):
+        start_time = time.perf_counter()
+        generated_texts = wrapper.generate(texts=texts)
+        latencies.append(time.perf_counter() - start_time)
+
+    elapsed_seconds = sum(latencies)
+
+    result = build_result(
+        name=f"wrapper-{batching}{'-constrained' if constrained else ''}{f'-{speculation}' if speculation else ''}",
+        num_samples=num_texts * num_repeats,
+        num_requests=num_repeats,
+        elapsed_seconds=elapsed_seconds,
+        latencies=latencies,
+        # Generated tokens/sec of every call is logged by the wrapper itself
+        parse_yield=parse_accuracy(json_strings=generated_texts)[0],
+    )
+    log_result(result=result)
+    save_result(result=result, output_path=output_path)
+    check_regression(result=result, baseline_path=baseline_path, tolerance=tolerance)
+
+
+if __name__ == "__main__":
+    fire.Fire(bench_wrapper)
@@ -0,0 +1,239 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import openai
+from aiohttp import web
+from loguru import logger
+
+from wgpt import enums
+
+WEATHER_VALUES = ["sunny", "cloudy", "rainy", "snowy", "foggy", "stormy"]
+PRECIPITATION_VALUES = ["none", "light rain", "heavy rain", "snow"]
+VISIBILITY_VALUES = ["good", "moderate", "poor"]
+AIR_QUALITY_VALUES = ["good", "moderate", "unhealthy"]
+ASSESSMENT_VALUES = ["correct", "minor inaccuracies", "incorrect"]
+
+
+def random_weather_sample(rng: random.Random) -> str:
+    weather = rng.choice(WEATHER_VALUES)
+    temperature = rng.randint(-20, 35)
+    wind_speed = round(rng.uniform(0, 20), 1)
+    data = {
+        "weather": weather,
+        "temperature": temperature,
+        "wind_speed": wind_speed,
+        "humidity": round(rng.uniform(10, 100), 1),
+        "precipitation": rng.choice(PRECIPITATION_VALUES),
+        "visibility": rng.choice(VISIBILITY_VALUES),
+        "air_quality": rng.choice(AIR_QUALITY_VALUES),
+        "real_feel_temperature": temperature + rng.randint(-5, 5),
+    }
+    # Random number keeps descriptions apart, so near duplicate filtering does not eat the samples
+    description = (
+        f"A {weather} day number {rng.randint(0, 10**9)}, {temperature} degrees and wind of {wind_speed} m/s."
+    )
+    return f"Input: {description}\nOutput: {json.dumps(data)}"
+
+
+def generation_completion(rng: random.Random, num_samples: int = 5, invalid_rate: float = 0.0) -> str:
+    # Completion in the format SampleParser expects, invalid_rate of the samples are cut short
+    samples = list()
+    for _ in range(num_samples):
+        sample = random_weather_sample(rng=rng)
+        if rng.random() < invalid_rate:
+            sample = sample[: sample.index("{") + 20]
+        samples.append(sample)
+    return "\n\n".join(samples)
+
+
+def labeling_completion(rng: random.Random) -> str:
+    return f"Assessment: {rng.choice(ASSESSMENT_VALUES)}"
+
+
+class FakeOpenAIServer:
+    # Local stand-in of the chat completions endpoint, so clients can be benchmarked with no network.
+    # Every request waits latency_ms plus uniform jitter, then fails with 500 at error_rate, with 429 at
+    # rate_limit_rate, or returns n completions made by completion_fn. Server runs its own event loop in a thread,
+    # so it works with clients that call asyncio.run themselves
+    def __init__(
+            self,
+            completion_fn: Callable[[random.Random], str],
+            latency_ms: float = 50.0,
+            jitter_ms: float = 0.0,
+            error_rate: float = 0.0,
+            rate_limit_rate: float = 0.0,
+            retry_after_seconds: float = 0.1,
+            chunk_size: int = 16,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            seed: int = 42,
+    ):
+        self.completion_fn = completion_fn
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_seconds = retry_after_seconds
+        self.chunk_size = chunk_size
+        self.host = host
+        self.port = port
+        self.rng = random.Random(seed)
+
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_rate_limited = 0
+        self.num_completions = 0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def build_response(self, contents: List[str], model_name: str) -> Dict[str, Any]:
+        completion_tokens = sum(len(content) for content in contents) // 4
+        response = {
+            "id": f"chatcmpl-{self.num_requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model_name,
+            "choices": [
+                {
+                    "index": index,
+                    "message": {enums.Field.role: enums.GPTRole.assistant, enums.Field.content: content},
+                    "finish_reason": "stop",
+                }
+                for index, content in enumerate(contents)
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": completion_tokens, "total_tokens": completion_tokens},
+        }
+        return response
+
+    async def stream_response(self, request: web.Request, contents: List[str], model_name: str) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        try:
+            for index, content in enumerate(contents):
+                for start in range(0, len(content), self.chunk_size):
+                    chunk = {
+                        "id": f"chatcmpl-{self.num_requests}",
+                        "object": "chat.completion.chunk",
+                        "model": model_name,
+                        "choices": [
+                            {
+                                "index": index,
+                                "delta": {enums.Field.content: content[start: start + self.chunk_size]},
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+                    await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # Client closed the stream early because it already has enough samples
+            pass
+        return response
+
+    async def handle_chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.num_requests += 1
+        params = await request.json()
+
+        latency = self.latency_ms + self.rng.uniform(0, self.jitter_ms)
+        await asyncio.sleep(latency / 1000)
+
+        draw = self.rng.random()
+        if draw < self.error_rate:
+            self.num_errors += 1
+            return web.json_response({"error": {"message": "Fake server error", "type": "server_error"}}, status=500)
+        if draw < self.error_rate + self.rate_limit_rate:
+            self.num_rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Fake rate limit", "type": "rate_limit_error"}},
+                status=429,
+                headers={"Retry-After": str(self.retry_after_seconds)},
+            )
+
+        contents = [self.completion_fn(self.rng) for _ in range(params.get("n", 1))]
+        self.num_completions += len(contents)
+        model_name = params.get("model", "")
+
+        if params.get("stream"):
+            return await self.stream_response(request=request, contents=contents, model_name=model_name)
+        return web.json_response(self.build_response(contents=contents, model_name=model_name))
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        return app
+
+    def _serve(self, started: threading.Event) -> None:
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, host=self.host, port=self.port)
+        self._loop.run_until_complete(site.start())
+        # Port 0 means any free port, the real one is known only after the bind
+        self.port = self._runner.addresses[0][1]
+        started.set()
+
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self) -> None:
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+        logger.info(f"Fake OpenAI server is running on {self.base_url}")
+
+    def stop(self) -> None:
+        if self._loop is None or self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+        self._thread = None
+        logger.info(
+            f"Fake OpenAI server stopped. Requests: {self.num_requests}. Errors: {self.num_errors}. "
+            f"Rate limited: {self.num_rate_limited}"
+        )
+
+
+@contextmanager
+def run_fake_openai(server: FakeOpenAIServer) -> Iterator[FakeOpenAIServer]:
+    # Module level openai settings point at the server while the context is open
+    api_base, api_key = openai.api_base, openai.api_key
+    server.start()
+    openai.api_base, openai.api_key = server.base_url, "fake"
+    try:
+        yield server
+    finally:
+        openai.api_base, openai.api_key = api_base, api_key
+        server.stop()
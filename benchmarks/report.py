@@ -0,0 +1,113 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from loguru import logger
+
+from wgpt.openai.limiter import RateLimiter
+
+
+class TimedRateLimiter(RateLimiter):
+    # Latency of every request attempt, from the moment it is let through to the end of the response. Time spent
+    # waiting for a free slot is left out, so the numbers do not grow with the number of queued requests
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.latencies: List[float] = list()
+        self._started_at: Dict[Optional["asyncio.Task[Any]"], float] = dict()
+
+    async def acquire(self, num_tokens: int) -> None:
+        await super().acquire(num_tokens=num_tokens)
+        self._started_at[asyncio.current_task()] = time.perf_counter()
+
+    async def release(self) -> None:
+        started_at = self._started_at.pop(asyncio.current_task(), None)
+        if started_at is not None:
+            self.latencies.append(time.perf_counter() - started_at)
+        await super().release()
+
+
+def latency_percentiles(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return {"latency_p50_ms": 0.0, "latency_p99_ms": 0.0}
+    p50, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 99]).tolist()
+    return {"latency_p50_ms": p50, "latency_p99_ms": p99}
+
+
+def build_result(
+        name: str,
+        num_samples: int,
+        num_requests: int,
+        elapsed_seconds: float,
+        latencies: List[float],
+        parse_yield: Optional[float] = None,
+        **extra: Any,
+) -> Dict[str, Any]:
+    result = {
+        "name": name,
+        "num_samples": num_samples,
+        "num_requests": num_requests,
+        "elapsed_seconds": elapsed_seconds,
+        "samples_per_second": num_samples / max(elapsed_seconds, 1e-9),
+        "requests_per_second": num_requests / max(elapsed_seconds, 1e-9),
+        **latency_percentiles(latencies=latencies),
+    }
+    if parse_yield is not None:
+        result["parse_yield"] = parse_yield
+    result.update(extra)
+    return result
+
+
+def log_result(result: Dict[str, Any]) -> None:
+    logger.info(f"Benchmark {result['name']}")
+    for key, value in result.items():
+        if key == "name":
+            continue
+        logger.info(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+def save_result(result: Dict[str, Any], output_path: Optional[str]) -> None:
+    if output_path is None:
+        return
+    with open(output_path, "w") as file_object:
+        json.dump(result, file_object, indent=2)
+    logger.info(f"Benchmark result saved to {output_path}")
+
+
+def check_regression(result: Dict[str, Any], baseline_path: Optional[str], tolerance: float = 0.2) -> None:
+    # Throughput must not fall more than tolerance below the saved baseline of the same benchmark
+    if baseline_path is None:
+        return
+
+    with open(baseline_path) as file_object:
+        baseline = json.load(file_object)
+
+    if baseline.get("name") != result["name"]:
+        raise ValueError(f"Baseline is for {baseline.get('name')}, not for {result['name']}")
+
+    regressions = list()
+    for key in [key for key in result if key.endswith("_per_second")]:
+        if not baseline.get(key):
+            continue
+        ratio = result[key] / baseline[key]
+        logger.info(f"{key}: {ratio * 100:.1f} % of baseline")
+        if ratio < 1 - tolerance:
+            regressions.append(f"{key} {result[key]:.2f} vs baseline {baseline[key]:.2f}")
+
+    if regressions:
+        raise RuntimeError(f"Throughput regression: {'; '.join(regressions)}")
@@ -12,7 +12,7 @@ def read_requirements():
 setup(
     name="wgpt",
     version="0.0.1",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks"]),
     include_package_data=True,
     install_requires=read_requirements(),
     # entry_points='''
@@ -0,0 +1,44 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from typing import Optional
+
+import fire
+from loguru import logger
+
+from wgpt.data.dedup import NearDuplicateIndex, find_leakage
+
+
+def check_leakage(
+        train_file_path: str = "./data/train.jsonl",
+        test_file_path: str = "./data/test.jsonl",
+        threshold: float = 0.8,
+        require_same_data: bool = True,
+        output_file_path: Optional[str] = None,
+) -> None:
+    index = NearDuplicateIndex(threshold=threshold, require_same_data=require_same_data)
+    leaks = find_leakage(train_file_path=train_file_path, test_file_path=test_file_path, index=index)
+
+    logger.info(f"Train duplicates: {index.dedup_rate * 100:.2f} % - {index.num_duplicates}")
+    logger.info(f"Test samples leaked from train: {len(leaks)}")
+
+    if output_file_path is not None:
+        with open(output_file_path, mode="w") as file_object:
+            for test_row_index, train_row_index in leaks:
+                file_object.write(json.dumps({"test_row": test_row_index, "train_row": train_row_index}) + "\n")
+
+
+if __name__ == "__main__":
+    fire.Fire(check_leakage)
@@ -18,14 +18,57 @@ from typing import Optional
 import fire
 from loguru import logger
 
+from wgpt import enums
+from wgpt.eval.compare import FieldComparator
 from wgpt.eval.labeling import Labeler
+from wgpt.eval.metrics import compute_metrics, log_metrics
 from wgpt.eval.parse import parse_accuracy
 from wgpt.eval.wrapper import WGPTWrapper
+from wgpt.openai.backend import build_chat_backend
+from wgpt.openai.batch import BatchRunner, OpenAIBatchBackend
+from wgpt.openai.cache import ResponseCache
 from wgpt.openai.client import GPTClient
+from wgpt.openai.executor import IndexedExecutor
+from wgpt.openai.limiter import RateLimiter
 from wgpt.utils.cli import setup_cli
 
 
-def evaluation(path_to_data: str, model_name_or_path: str, env_file_path: Optional[str] = "./.env") -> None:
+def evaluation(
+        path_to_data: str,
+        model_name_or_path: str,
+        batch_size: int = 16,
+        batching: str = enums.Batching.fixed,
+        max_batch_tokens: Optional[int] = None,
+        device: Optional[str] = None,
+        num_threads: Optional[int] = None,
+        device_map: Optional[str] = None,
+        replicate: bool = False,
+        constrained: bool = False,
+        speculation: Optional[str] = None,
+        draft_model_name_or_path: Optional[str] = None,
+        num_draft_tokens: int = 10,
+        max_concurrency: int = 64,
+        gpt_model_name: str = GPTClient.DEFAULT_MODEL_NAME,
+        gpt_base_url: Optional[str] = None,
+        gpt_api_key: Optional[str] = None,
+        gpt_timeout_seconds: Optional[float] = None,
+        gpt_max_connections: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        cache_path: Optional[str] = None,
+        cache_max_entries: Optional[int] = None,
+        cache_ttl_seconds: Optional[float] = None,
+        batch_api: bool = False,
+        batch_work_dir: str = "./batches",
+        batch_poll_interval_seconds: float = 30.0,
+        pipeline: bool = False,
+        prejudge: bool = False,
+        label_max_attempts: int = 3,
+        label_retry_budget: Optional[int] = None,
+        label_timeout_seconds: Optional[float] = None,
+        label_checkpoint_path: Optional[str] = None,
+        env_file_path: Optional[str] = "./.env",
+) -> None:
     setup_cli(env_file_path=env_file_path)
 
     data = list()
@@ -36,10 +79,68 @@ def evaluation(path_to_data: str, model_name_or_path: str, env_file_path: Option
 
     logger.info(f"Data size: {len(data)}")
 
-    wrapper = WGPTWrapper(model_name_or_path=model_name_or_path)
-    gpt_client = GPTClient(num_completion=1)
-    labeler = Labeler(wrapper=wrapper, gpt_client=gpt_client)
+    wrapper = WGPTWrapper(
+        model_name_or_path=model_name_or_path,
+        batch_size=batch_size,
+        batching=batching,
+        max_batch_tokens=max_batch_tokens,
+        device=device,
+        num_threads=num_threads,
+        device_map=device_map,
+        replicate=replicate,
+        constrained=constrained,
+        speculation=speculation,
+        draft_model_name_or_path=draft_model_name_or_path,
+        num_draft_tokens=num_draft_tokens,
+    )
+    rate_limiter = RateLimiter(
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        max_concurrency=max_concurrency,
+    )
+    cache = None
+    if cache_path is not None:
+        cache = ResponseCache(path=cache_path, max_entries=cache_max_entries, ttl_seconds=cache_ttl_seconds)
+    gpt_client = GPTClient(
+        num_completion=1,
+        max_concurrency=max_concurrency,
+        rate_limiter=rate_limiter,
+        cache=cache,
+        model_name=gpt_model_name,
+        backend=build_chat_backend(
+            base_url=gpt_base_url,
+            api_key=gpt_api_key,
+            timeout_seconds=gpt_timeout_seconds,
+            max_connections=gpt_max_connections,
+        ),
+    )
+    batch_runner = None
+    if batch_api:
+        batch_runner = BatchRunner(
+            gpt_client=gpt_client,
+            backend=OpenAIBatchBackend(),
+            work_dir=batch_work_dir,
+            poll_interval_seconds=batch_poll_interval_seconds,
+        )
+    executor = IndexedExecutor(
+        gpt_client=gpt_client,
+        max_attempts=label_max_attempts,
+        retry_budget=label_retry_budget,
+        item_timeout_seconds=label_timeout_seconds,
+        checkpoint_path=label_checkpoint_path,
+    )
+    labeler = Labeler(
+        wrapper=wrapper,
+        gpt_client=gpt_client,
+        batch_runner=batch_runner,
+        pipeline=pipeline,
+        comparator=FieldComparator() if prejudge else None,
+        executor=executor,
+    )
     generated_json_strings, assessments = labeler.run(data=data)
+    true_json_strings = [json.dumps(sample.get(enums.Field.data)) for sample in data]
+    metrics = compute_metrics(generated_json_strings=generated_json_strings, true_json_strings=true_json_strings)
+    log_metrics(metrics=metrics)
     parse_accuracy_value, _, _ = parse_accuracy(json_strings=generated_json_strings)
     logger.info(f"Parse accuracy value: {parse_accuracy_value:.2f}")
 
@@ -12,13 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import random
 from typing import Optional
 
 import fire
 from loguru import logger
 
+from wgpt.data.dedup import NearDuplicateIndex
 from wgpt.data.generate import DataGenerationEngine
+from wgpt.openai.backend import build_chat_backend
+from wgpt.openai.batch import BatchRunner, OpenAIBatchBackend
+from wgpt.openai.cache import ResponseCache
 from wgpt.openai.client import GPTClient
+from wgpt.openai.limiter import RateLimiter
 from wgpt.utils.cli import setup_cli
 
 
@@ -35,20 +41,71 @@ def generate(
         max_tokens: int = 8192,
         top_p: float = 0.99,
         data_file_mode: str = "w",
+        max_concurrency: int = 64,
+        model_name: str = GPTClient.DEFAULT_MODEL_NAME,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        request_timeout_seconds: Optional[float] = None,
+        max_connections: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        cache_path: Optional[str] = None,
+        cache_max_entries: Optional[int] = None,
+        cache_ttl_seconds: Optional[float] = None,
+        batch_api: bool = False,
+        batch_work_dir: str = "./batches",
+        batch_poll_interval_seconds: float = 30.0,
+        pipeline: bool = False,
+        stream: bool = False,
+        max_consecutive_fails: int = 16,
+        seed: Optional[int] = None,
+        resume: bool = False,
+        dedup: bool = False,
+        dedup_threshold: float = 0.8,
         env_file_path: Optional[str] = "./.env",
 ) -> None:
     setup_cli(env_file_path=env_file_path)
+    if seed is not None:
+        # Same seed gives the same prompts, so a rerun with a cache does not pay for completions twice
+        random.seed(seed)
+    rate_limiter = RateLimiter(
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        max_concurrency=max_concurrency,
+    )
+    cache = None
+    if cache_path is not None:
+        cache = ResponseCache(path=cache_path, max_entries=cache_max_entries, ttl_seconds=cache_ttl_seconds)
     gpt_client = GPTClient(
         num_completion=num_batches_per_request,
         temperature=temperature,
         max_tokens=max_tokens,
         top_p=top_p,
+        max_concurrency=max_concurrency,
+        rate_limiter=rate_limiter,
+        cache=cache,
+        model_name=model_name,
+        backend=build_chat_backend(
+            base_url=base_url,
+            api_key=api_key,
+            timeout_seconds=request_timeout_seconds,
+            max_connections=max_connections,
+        ),
     )
     logger.info("GPTClient built")
+    batch_runner = None
+    if batch_api:
+        batch_runner = BatchRunner(
+            gpt_client=gpt_client,
+            backend=OpenAIBatchBackend(),
+            work_dir=batch_work_dir,
+            poll_interval_seconds=batch_poll_interval_seconds,
+        )
     data_generation_engine = DataGenerationEngine(
         num_samples_per_batch=num_samples_per_batch,
         min_examples=min_examples,
         max_examples=max_examples,
+        deduplicator=NearDuplicateIndex(threshold=dedup_threshold) if dedup else None,
     )
     logger.info("DataGenerationEngine built")
     data_generation_engine.generate_data(
@@ -58,6 +115,11 @@ def generate(
         fails_file_path=fails_file_path,
         num_samples=num_samples,
         num_rounds_per_call=num_rounds_per_call,
+        pipeline=pipeline,
+        stream=stream,
+        max_consecutive_fails=max_consecutive_fails,
+        resume=resume,
+        batch_runner=batch_runner,
     )
     logger.info("Generation complete")
 
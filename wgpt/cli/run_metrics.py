@@ -0,0 +1,83 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from typing import Optional
+
+import fire
+from loguru import logger
+
+from wgpt import enums
+from wgpt.eval.metrics import compute_metrics, log_metrics
+from wgpt.eval.wrapper import WGPTWrapper
+
+
+def metrics(
+        path_to_data: str,
+        generated_file_path: str,
+        model_name_or_path: Optional[str] = None,
+        batch_size: int = 16,
+        batching: str = enums.Batching.fixed,
+        device: Optional[str] = None,
+        constrained: bool = False,
+        numeric_tolerance: float = 1.0,
+        num_bootstrap: int = 1000,
+        confidence: float = 0.95,
+        output_path: Optional[str] = None,
+) -> None:
+    true_json_strings = list()
+    descriptions = list()
+
+    with open(path_to_data) as file_object:
+        for line in file_object:
+            sample = json.loads(line)
+            descriptions.append(sample.get(enums.Field.description) + "\n")
+            true_json_strings.append(json.dumps(sample.get(enums.Field.data)))
+
+    logger.info(f"Data size: {len(true_json_strings)}")
+
+    if model_name_or_path is not None:
+        wrapper = WGPTWrapper(
+            model_name_or_path=model_name_or_path,
+            batch_size=batch_size,
+            batching=batching,
+            device=device,
+            constrained=constrained,
+        )
+        wrapper.generate_to_jsonl(texts=descriptions, file_path=generated_file_path)
+
+    # Rows of the generated file can come in any order, they are placed by index
+    generated_json_strings = [""] * len(true_json_strings)
+    with open(generated_file_path) as file_object:
+        for line in file_object:
+            sample = json.loads(line)
+            generated_json_strings[sample[enums.Field.index]] = sample[enums.Field.generated]
+
+    result = compute_metrics(
+        generated_json_strings=generated_json_strings,
+        true_json_strings=true_json_strings,
+        numeric_tolerance=numeric_tolerance,
+        num_bootstrap=num_bootstrap,
+        confidence=confidence,
+    )
+    log_metrics(metrics=result)
+
+    if output_path is not None:
+        with open(output_path, "w") as file_object:
+            json.dump(result, file_object, ensure_ascii=False, indent=2)
+        logger.info(f"Metrics saved to {output_path}")
+
+
+if __name__ == "__main__":
+    fire.Fire(metrics)
@@ -17,5 +17,5 @@ from xllm.cli.quantize import cli_run_quantize
 from wgpt.data.registry import registry_description_to_json_dataset
 
 if __name__ == "__main__":
-    registry_description_to_json_dataset()
+    registry_description_to_json_dataset(use_token_cache=False)
     cli_run_quantize()
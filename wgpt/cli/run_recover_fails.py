@@ -0,0 +1,41 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Optional
+
+import fire
+
+from wgpt.data.dedup import NearDuplicateIndex
+from wgpt.data.generate import DataGenerationEngine
+
+
+def recover(
+        fails_file_path: str = "./data/fails.jsonl",
+        data_file_path: str = "./data/train.jsonl",
+        remaining_fails_file_path: Optional[str] = None,
+        dedup: bool = False,
+        dedup_threshold: float = 0.8,
+) -> None:
+    data_generation_engine = DataGenerationEngine(
+        deduplicator=NearDuplicateIndex(threshold=dedup_threshold) if dedup else None,
+    )
+    data_generation_engine.recover_fails(
+        fails_file_path=fails_file_path,
+        data_file_path=data_file_path,
+        remaining_fails_file_path=remaining_fails_file_path,
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(recover)
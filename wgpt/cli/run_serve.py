@@ -0,0 +1,59 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Optional
+
+import fire
+from aiohttp import web
+
+from wgpt.eval.server import InferenceServer
+from wgpt.eval.wrapper import WGPTWrapper
+
+
+def serve(
+        model_name_or_path: str,
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10.0,
+        max_batch_tokens: Optional[int] = None,
+        max_queue_size: int = 4096,
+        device: Optional[str] = None,
+        num_threads: Optional[int] = None,
+        device_map: Optional[str] = None,
+        replicate: bool = False,
+        constrained: bool = False,
+) -> None:
+    wrapper = WGPTWrapper(
+        model_name_or_path=model_name_or_path,
+        batch_size=max_batch_size,
+        max_batch_tokens=max_batch_tokens,
+        device=device,
+        num_threads=num_threads,
+        device_map=device_map,
+        replicate=replicate,
+        constrained=constrained,
+    )
+    server = InferenceServer(
+        wrapper=wrapper,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+        max_batch_tokens=max_batch_tokens,
+        max_queue_size=max_queue_size,
+    )
+    web.run_app(server.build_app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    fire.Fire(serve)
@@ -14,8 +14,14 @@
 
 from xllm import cli_run_train
 
-from wgpt.data.registry import registry_description_to_json_dataset
+from wgpt.data.registry import (
+    registry_description_to_json_dataset,
+    registry_packing_experiment,
+    registry_pretokenized_completion_collator,
+)
 
 if __name__ == "__main__":
     registry_description_to_json_dataset()
+    registry_pretokenized_completion_collator()
+    registry_packing_experiment()
     cli_run_train()
@@ -27,3 +27,7 @@ class WGPTConfig(Config):
         default="./data/test.jsonl",
         metadata={"help": "Path to raw train file"},
     )
+    pretokenize: bool = field(
+        default=True,
+        metadata={"help": "Tokenize prepared train and eval data once and cache token ids beside the data files"},
+    )
@@ -13,3 +13,36 @@
 # limitations under the License.
 
 DATASET_KEY = "desc2json"
+COLLATOR_KEY = "pretokenized_completion"
+PACKING_EXPERIMENT_KEY = "desc2json_packing"
+
+WEATHER_JSON_SCHEMA = {
+    "weather": str,
+    "temperature": int,
+    "wind_speed": float,
+    "humidity": float,
+    "precipitation": str,
+    "visibility": str,
+    "air_quality": str,
+    "real_feel_temperature": int,
+}
+
+# Forms of the same categorical value that the labeling model treats as equal, per field. Visibility and air
+# quality grades like "fair", "average" and "moderate" are distinct values in the data, so they are not folded
+CATEGORICAL_SYNONYMS = {
+    "weather": {
+        "sun": "sunny",
+        "clear": "sunny",
+        "rain": "rainy",
+        "raining": "rainy",
+        "snow": "snowy",
+        "snowing": "snowy",
+        "cloud": "cloudy",
+        "clouds": "cloudy",
+        "fog": "foggy",
+    },
+    "precipitation": {
+        "no": "none",
+        "drizzling": "drizzle",
+    },
+}
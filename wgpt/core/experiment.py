@@ -0,0 +1,64 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from typing import Optional
+
+from transformers import PreTrainedModel
+from xllm import dist_logger
+from xllm.datasets.base import BaseDataset
+from xllm.experiments import Experiment
+
+from wgpt.data.packing import PackedDescriptionToJsonDataset
+
+FLASH_ATTENTION_2 = "flash_attention_2"
+SDPA = "sdpa"
+EAGER = "eager"
+
+
+def use_packed_attention_mask(model: PreTrainedModel) -> None:
+    # Packed batches come with a 4d block diagonal mask. Some models build the sdpa mask only from a 2d one, with
+    # eager mask preparation the 4d mask is passed to the attention layers as is, sdpa layers still run sdpa
+    attn_implementation = getattr(model.config, "_attn_implementation", None)
+    if attn_implementation == FLASH_ATTENTION_2:
+        raise ValueError("Packing needs a 4d attention mask, flash attention 2 does not support it")
+    if attn_implementation == SDPA:
+        model.config._attn_implementation = EAGER
+        # Some models keep their own copy of the value
+        for module in model.modules():
+            if getattr(module, "_attn_implementation", None) == SDPA:
+                module._attn_implementation = EAGER
+        dist_logger("Attention mask preparation switched to eager for packed batches")
+
+
+class PackingExperiment(Experiment):
+    # Train and eval samples are packed into max_length sequences, see PackedDescriptionToJsonDataset
+    def build_train_dataset(self) -> BaseDataset:
+        return PackedDescriptionToJsonDataset.load(
+            path_to_data=self.config.train_local_path_to_data,
+            max_length=self.config.max_length,
+            seed=self.config.seed,
+        )
+
+    def build_eval_dataset(self) -> Optional[BaseDataset]:
+        path_to_data = self.config.eval_local_path_to_data
+        if path_to_data is None or not os.path.isfile(path_to_data):
+            return None
+        return PackedDescriptionToJsonDataset.load(
+            path_to_data=path_to_data, max_length=self.config.max_length, seed=self.config.seed
+        )
+
+    def after_model_build(self) -> None:
+        if self.model is not None:
+            use_packed_attention_mask(model=self.model)
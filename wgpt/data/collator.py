@@ -0,0 +1,185 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from typing import List, Optional, Tuple
+
+import torch
+from loguru import logger
+from transformers import PreTrainedTokenizer
+from xllm import enums as xllm_enums
+from xllm.collators.completion import CompletionCollator
+from xllm.types import Batch, RawSample
+
+from wgpt import enums
+from wgpt.data.tokens import get_tokenizer_hash
+
+POSITION_IDS = "position_ids"
+
+
+class PretokenizedCompletionCollator(CompletionCollator):
+    # Completion collator for samples from the token cache: token ids come ready, only targets and padding are
+    # built here. Samples with text parts are tokenized as usual, so it also works when there is no cache.
+    # Packed samples hold several segments in one row: positions restart at every segment and a block diagonal
+    # causal mask keeps segments from attending to each other
+    def __init__(
+            self,
+            tokenizer: PreTrainedTokenizer,
+            max_length: int,
+            prefix_end: Optional[str] = None,
+            separator: str = "\n",
+            log_every: int = 100,
+    ):
+        super().__init__(tokenizer=tokenizer, max_length=max_length, prefix_end=prefix_end, separator=separator)
+        self.tokenizer_hash = get_tokenizer_hash(tokenizer=tokenizer)
+        self.log_every = log_every
+
+        self.num_batches = 0
+        self.num_tokens = 0
+        self.num_padding_tokens = 0
+        self.num_target_tokens = 0
+        self._started_at: Optional[float] = None
+
+    def parse_tokenized_sample(self, token_ids: List[int], completion_start: int) -> Tuple[List[int], List[int]]:
+        # Loss only on the completion, same as CompletionCollator without prefix_end
+        input_ids = token_ids[:-1]
+        targets = [self.tokenizer.pad_token_id] * max(completion_start - 1, 0) + token_ids[max(completion_start, 1):]
+        return input_ids, targets
+
+    def parse_segments(self, sample: RawSample) -> List[Tuple[List[int], List[int]]]:
+        if enums.Field.token_ids not in sample:
+            text_parts = sample[xllm_enums.General.text_parts]
+            if not isinstance(text_parts, list):
+                return list()
+            return [self.parse_sample(sample=[str(item) for item in text_parts])]
+
+        if sample[enums.Field.tokenizer_hash] != self.tokenizer_hash:
+            raise ValueError("Token cache was built with another tokenizer, run prepare again")
+
+        token_ids: List[int] = sample[enums.Field.token_ids]  # type: ignore[assignment]
+        if enums.Field.segment_lengths not in sample:
+            completion_start: int = sample[enums.Field.completion_start]  # type: ignore[assignment]
+            return [self.parse_tokenized_sample(token_ids=token_ids, completion_start=completion_start)]
+
+        segments = list()
+        start = 0
+        for segment_length, completion_start in zip(
+                sample[enums.Field.segment_lengths], sample[enums.Field.completion_starts]  # type: ignore[call-overload]
+        ):
+            segments.append(
+                self.parse_tokenized_sample(
+                    token_ids=token_ids[start: start + segment_length], completion_start=completion_start
+                )
+            )
+            start += segment_length
+
+        return segments
+
+    def parse_batch(self, raw_batch: List[RawSample]) -> Batch:
+        batch_segments = [segments for segments in map(self.parse_segments, raw_batch) if segments]
+        is_packed = any(len(segments) > 1 for segments in batch_segments)
+
+        input_ids = [
+            [token_id for segment_input_ids, _ in segments for token_id in segment_input_ids]
+            for segments in batch_segments
+        ]
+        targets = [
+            [token_id for _, segment_targets in segments for token_id in segment_targets]
+            for segments in batch_segments
+        ]
+
+        batch_max_length = max(len(sample_input_ids) for sample_input_ids in input_ids)
+        left_padding = self.tokenizer.padding_side == "left"
+        attention_masks = list()
+
+        for n_sample in range(len(input_ids)):
+            num_padding = batch_max_length - len(input_ids[n_sample])
+            pad_sequence = [self.tokenizer.pad_token_id] * num_padding
+            attention_mask = [1] * len(input_ids[n_sample])
+            if left_padding:
+                input_ids[n_sample] = pad_sequence + input_ids[n_sample]
+                targets[n_sample] = pad_sequence + targets[n_sample]
+                attention_masks.append([0] * num_padding + attention_mask)
+            else:
+                input_ids[n_sample] = input_ids[n_sample] + pad_sequence
+                targets[n_sample] = targets[n_sample] + pad_sequence
+                attention_masks.append(attention_mask + [0] * num_padding)
+
+        batch = {
+            xllm_enums.Transformers.input_ids: torch.tensor(input_ids),
+            xllm_enums.Transformers.attention_mask: torch.tensor(attention_masks),
+            xllm_enums.Transformers.labels: torch.tensor(targets),
+        }
+
+        if is_packed:
+            batch[xllm_enums.Transformers.attention_mask], batch[POSITION_IDS] = self.build_packed_mask(
+                batch_segments=batch_segments, batch_max_length=batch_max_length, left_padding=left_padding
+            )
+
+        self.update_stats(batch=batch, num_real_tokens=sum(map(sum, attention_masks)))
+
+        return batch
+
+    @staticmethod
+    def build_packed_mask(
+            batch_segments: List[List[Tuple[List[int], List[int]]]],
+            batch_max_length: int,
+            left_padding: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # 4d mask (batch, 1, query, key) with 1 where attention is allowed, it replaces the causal mask of the model.
+        # Padding attends only to itself, so its rows do not turn into nan
+        batch_size = len(batch_segments)
+        segment_ids = torch.full((batch_size, batch_max_length), -1, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, batch_max_length), dtype=torch.long)
+
+        for n_sample, segments in enumerate(batch_segments):
+            num_tokens = sum(len(segment_input_ids) for segment_input_ids, _ in segments)
+            position = batch_max_length - num_tokens if left_padding else 0
+            for segment_index, (segment_input_ids, _) in enumerate(segments):
+                segment_length = len(segment_input_ids)
+                segment_ids[n_sample, position: position + segment_length] = segment_index
+                position_ids[n_sample, position: position + segment_length] = torch.arange(segment_length)
+                position += segment_length
+
+        same_segment = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, :, None] >= 0)
+        causal = torch.ones(batch_max_length, batch_max_length, dtype=torch.bool).tril()
+        diagonal = torch.eye(batch_max_length, dtype=torch.bool)
+        attention_mask = ((same_segment & causal) | diagonal).unsqueeze(1).to(torch.uint8)
+
+        return attention_mask, position_ids
+
+    def update_stats(self, batch: Batch, num_real_tokens: int) -> None:
+        if self._started_at is None:
+            self._started_at = time.perf_counter()
+
+        labels = batch[xllm_enums.Transformers.labels]
+        self.num_batches += 1
+        self.num_tokens += labels.numel()
+        self.num_padding_tokens += labels.numel() - num_real_tokens
+        self.num_target_tokens += int((labels != self.tokenizer.pad_token_id).sum())
+
+        if self.log_every and self.num_batches % self.log_every == 0:
+            self.log_stats()
+
+    def log_stats(self) -> None:
+        if not self.num_tokens or self._started_at is None:
+            return
+
+        elapsed = max(time.perf_counter() - self._started_at, 1e-9)
+        logger.info(
+            f"Collated batches: {self.num_batches}. "
+            f"Padding: {self.num_padding_tokens * 100 / self.num_tokens:.1f} %. "
+            f"Target tokens: {self.num_target_tokens * 100 / self.num_tokens:.1f} %. "
+            f"Tokens per second: {(self.num_tokens - self.num_padding_tokens) / elapsed:.0f}"
+        )
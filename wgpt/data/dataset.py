@@ -13,45 +13,147 @@
 # limitations under the License.
 
 import json
-import random
-from typing import List, Optional, Tuple
+import os
+from typing import Any, List, Optional, Tuple, Union
 
+import numpy as np
 from xllm import dist_logger
 from xllm import enums as xllm_enums
+from xllm.core.dependencies import build_tokenizer
 from xllm.datasets.base import BaseDataset
 from xllm.types import RawSample
 
 from wgpt import enums
 from wgpt.core.config import WGPTConfig
+from wgpt.data.jsonl import JsonlFile
+from wgpt.data.tokens import TokenCache, build_token_cache_for_file, find_token_cache_dir
 
 
 class DescriptionToJsonDataset(BaseDataset):
-    @classmethod
-    def get_data(cls, config: WGPTConfig) -> Optional[Tuple[List[RawSample], Optional[List[RawSample]]]]:
-        data = list()
+    # Samples are read lazily from mmap through a line offset index cached beside the file, so loading does not
+    # depend on data size and ranks do not hold their own copy of the data. When prepare has built a token cache
+    # for the file, samples are token ids from the cache and are not serialized or tokenized again
+    use_token_cache: bool = True
+
+    def __init__(self, data: Union[List[RawSample], JsonlFile], token_cache: Optional[TokenCache] = None):
+        super().__init__(data=data)  # type: ignore[arg-type]
+        self.token_cache = token_cache
 
-        with open(config.path_to_raw_train_file) as file_object:
-            for line in file_object:
-                sample = json.loads(line)
-                data.append(sample)
+    @classmethod
+    def split_indices(cls, config: WGPTConfig, num_samples: int) -> Tuple[np.ndarray, np.ndarray]:
+        indices = np.arange(num_samples, dtype=np.int64)
+        rng = np.random.default_rng(seed=config.seed)
 
         if config.shuffle:
-            random.shuffle(data)
+            rng.shuffle(indices)
+
+        train_indices = indices[config.max_eval_samples:]
+        eval_indices = indices[: config.max_eval_samples]
 
-        train_data = data[config.max_eval_samples:]
-        eval_data = data[: config.max_eval_samples]
+        return train_indices, eval_indices
+
+    @classmethod
+    def get_data(  # type: ignore[override]
+            cls,
+            config: WGPTConfig,
+    ) -> Optional[Tuple[JsonlFile, Optional[JsonlFile]]]:
+        # Subsets are lazy, rows are decoded only when accessed. Base prepare needs lists, so prepare below is
+        # overridden and does not go through this method
+        data = JsonlFile(file_path=config.path_to_raw_train_file)
+        train_indices, eval_indices = cls.split_indices(config=config, num_samples=len(data))
+
+        train_data = data.subset(indices=train_indices)
+        eval_data = data.subset(indices=eval_indices)
 
         dist_logger(f"Train data length: {len(train_data)}")
         dist_logger(f"Eval data length: {len(eval_data)}")
 
         return train_data, eval_data
 
-    def get_sample(self, index: int) -> RawSample:
+    @classmethod
+    def prepare(cls, config: WGPTConfig) -> None:
+        # Same split as get_data with base prepare, but over index arrays: raw lines are copied to the train and
+        # eval files, samples are never decoded
+        data = JsonlFile(file_path=config.path_to_raw_train_file)
+        train_indices, eval_indices = cls.split_indices(config=config, num_samples=len(data))
+
+        dist_logger(f"Train data length: {len(train_indices)}")
+        dist_logger(f"Eval data length: {len(eval_indices)}")
+
+        if config.eval_local_path_to_data is not None:
+            data.subset(indices=eval_indices).write(file_path=config.eval_local_path_to_data)
+            dist_logger(f"Eval data size: {len(eval_indices)}")
+        elif config.add_eval_to_train_if_no_path:
+            train_indices = np.concatenate([train_indices, eval_indices])
+            dist_logger("Add eval data to train")
+
+        if config.shuffle:
+            np.random.default_rng(seed=config.seed + 1).shuffle(train_indices)
+
+        if len(train_indices) == 0:
+            raise ValueError("Train data length is 0 at prepare step")
+
+        data.subset(indices=train_indices).write(file_path=config.train_local_path_to_data)
+        dist_logger(f"Train data size: {len(train_indices)}")
+
+        if config.pretokenize:
+            cls.build_token_caches(config=config)
+
+    @classmethod
+    def build_token_caches(cls, config: WGPTConfig) -> None:
+        tokenizer = build_tokenizer(config=config)
+
+        for file_path in (config.train_local_path_to_data, config.eval_local_path_to_data):
+            if file_path is None or not os.path.isfile(file_path):
+                continue
+            dataset = cls(data=JsonlFile(file_path=file_path))
+            build_token_cache_for_file(
+                file_path=file_path,
+                tokenizer=tokenizer,
+                get_text_parts=dataset.get_text_parts,
+                num_samples=len(dataset),
+            )
+
+    @classmethod
+    def load(cls, path_to_data: str, **kwargs: Any) -> "DescriptionToJsonDataset":
+        if not os.path.isfile(path_to_data):
+            raise FileNotFoundError(f"File {path_to_data} not found. Probably you should run .prepare before")
+
+        data = JsonlFile(file_path=path_to_data)
+        dist_logger(f"Data loaded lazily from {path_to_data}: {len(data)} samples")
+
+        token_cache = None
+        token_cache_dir = find_token_cache_dir(file_path=path_to_data) if cls.use_token_cache else None
+        if token_cache_dir is not None:
+            token_cache = TokenCache(cache_dir=token_cache_dir)
+            if len(token_cache) != len(data):
+                raise ValueError(f"Token cache {token_cache_dir} does not match {path_to_data}, run prepare again")
+            dist_logger(f"Token cache loaded from {token_cache_dir}")
+
+        return cls(data=data, token_cache=token_cache)
+
+    def get_text_parts(self, index: int) -> List[str]:
         sample = self.data[index]
 
         description = sample.get(enums.Field.description)
         json_string = json.dumps(sample.get(enums.Field.data))
 
-        sample = {xllm_enums.General.text_parts: [description, json_string + "\n"]}
+        return [description, json_string + "\n"]
+
+    def get_sample(self, index: int) -> RawSample:
+        if self.token_cache is not None:
+            token_ids, completion_start = self.token_cache.get(index=index)
+            return {
+                enums.Field.token_ids: token_ids,
+                enums.Field.completion_start: completion_start,
+                enums.Field.tokenizer_hash: self.token_cache.tokenizer_hash,
+            }
+
+        sample = {xllm_enums.General.text_parts: self.get_text_parts(index=index)}
 
         return sample
+
+
+class DescriptionToJsonTextDataset(DescriptionToJsonDataset):
+    # Text samples only, for consumers that read text parts instead of using the collator, e.g. GPTQ calibration
+    use_token_cache = False
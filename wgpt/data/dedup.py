@@ -0,0 +1,199 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import re
+import zlib
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from wgpt import enums
+
+MERSENNE_PRIME = (1 << 31) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+class NearDuplicateIndex:
+    def __init__(
+            self,
+            num_permutations: int = 64,
+            num_bands: int = 16,
+            shingle_size: int = 3,
+            threshold: float = 0.8,
+            require_same_data: bool = True,
+            seed: int = 42,
+    ):
+        assert num_permutations % num_bands == 0
+
+        self.num_permutations = num_permutations
+        self.num_bands = num_bands
+        self.rows_per_band = num_permutations // num_bands
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.require_same_data = require_same_data
+
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, MERSENNE_PRIME, size=(num_permutations, 1), dtype=np.uint64)
+        self._b = generator.randint(0, MERSENNE_PRIME, size=(num_permutations, 1), dtype=np.uint64)
+
+        self._bands: List[Dict[bytes, List[int]]] = [defaultdict(list) for _ in range(num_bands)]
+        self._signatures: List[np.ndarray] = list()
+        self._data_hashes: List[str] = list()
+        self._exact_hashes: Dict[str, int] = dict()
+
+        self.num_checked = 0
+        self.num_exact_duplicates = 0
+        self.num_near_duplicates = 0
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    @property
+    def num_duplicates(self) -> int:
+        return self.num_exact_duplicates + self.num_near_duplicates
+
+    @property
+    def dedup_rate(self) -> float:
+        return self.num_duplicates / self.num_checked if self.num_checked > 0 else 0.0
+
+    @staticmethod
+    def normalize(text: str) -> List[str]:
+        return re.findall(r"[a-z0-9]+", text.lower())
+
+    @staticmethod
+    def hash_data(data: Any) -> str:
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def shingles(self, words: List[str]) -> np.ndarray:
+        if len(words) <= self.shingle_size:
+            parts = [" ".join(words)]
+        else:
+            parts = [" ".join(words[i: i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)]
+        return np.array(sorted({zlib.crc32(part.encode("utf-8")) for part in parts}), dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        shingles = self.shingles(words=self.normalize(text))
+        # a * x + b fits into uint64 because a, b < 2^31 and x < 2^32
+        hashes = (self._a * shingles[None, :] + self._b) % MERSENNE_PRIME
+        signature: np.ndarray = hashes.min(axis=1).astype(np.uint32)
+        return signature
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            signature[band * self.rows_per_band: (band + 1) * self.rows_per_band].tobytes()
+            for band in range(self.num_bands)
+        ]
+
+    def similarity(self, first_signature: np.ndarray, second_signature: np.ndarray) -> float:
+        return float(np.mean(first_signature == second_signature))
+
+    def query(self, text: str, signature: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        # Indices of indexed samples with estimated Jaccard similarity of descriptions above the threshold
+        signature = signature if signature is not None else self.signature(text)
+
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self._bands[band].get(key, list()))
+
+        matches = list()
+        for candidate in sorted(candidates):
+            similarity = self.similarity(signature, self._signatures[candidate])
+            if similarity >= self.threshold:
+                matches.append((candidate, similarity))
+
+        return matches
+
+    def _insert(self, signature: np.ndarray, data_hash: str, exact_hash: str) -> int:
+        index = len(self._signatures)
+        for band, key in enumerate(self._band_keys(signature)):
+            self._bands[band][key].append(index)
+        self._signatures.append(signature)
+        self._data_hashes.append(data_hash)
+        self._exact_hashes[exact_hash] = index
+        return index
+
+    def _hash_sample(self, sample: Dict[str, Any]) -> Tuple[str, str, str]:
+        description = sample.get(enums.Field.description) or ""
+        data_hash = self.hash_data(sample.get(enums.Field.data))
+        exact_hash = self.hash_data([self.normalize(description), data_hash])
+        return description, data_hash, exact_hash
+
+    def _find_near_duplicate(self, description: str, data_hash: str, signature: np.ndarray) -> Optional[int]:
+        for candidate, _ in self.query(text=description, signature=signature):
+            if not self.require_same_data or self._data_hashes[candidate] == data_hash:
+                return candidate
+        return None
+
+    def find_duplicate(self, sample: Dict[str, Any]) -> Optional[int]:
+        description, data_hash, exact_hash = self._hash_sample(sample=sample)
+
+        if exact_hash in self._exact_hashes:
+            return self._exact_hashes[exact_hash]
+
+        return self._find_near_duplicate(
+            description=description, data_hash=data_hash, signature=self.signature(description)
+        )
+
+    def add(self, sample: Dict[str, Any]) -> bool:
+        # Returns False and does not index the sample if it is a duplicate of an already indexed one
+        self.num_checked += 1
+
+        description, data_hash, exact_hash = self._hash_sample(sample=sample)
+
+        if exact_hash in self._exact_hashes:
+            self.num_exact_duplicates += 1
+            return False
+
+        signature = self.signature(description)
+
+        if self._find_near_duplicate(description=description, data_hash=data_hash, signature=signature) is not None:
+            self.num_near_duplicates += 1
+            return False
+
+        self._insert(signature=signature, data_hash=data_hash, exact_hash=exact_hash)
+
+        return True
+
+    def add_file(self, path_to_data: str) -> None:
+        with open(path_to_data) as file_object:
+            for line in file_object:
+                self.add(sample=json.loads(line))
+
+
+def find_leakage(
+        train_file_path: str,
+        test_file_path: str,
+        index: Optional[NearDuplicateIndex] = None,
+) -> List[Tuple[int, int]]:
+    # Pairs of (test row, train row) where the test sample is a duplicate of the train one
+    if index is None:
+        index = NearDuplicateIndex()
+
+    row_indices = list()
+    with open(train_file_path) as file_object:
+        for row_index, line in enumerate(file_object):
+            if index.add(sample=json.loads(line)):
+                row_indices.append(row_index)
+
+    leaks = list()
+    with open(test_file_path) as file_object:
+        for test_row_index, line in enumerate(file_object):
+            duplicate = index.find_duplicate(sample=json.loads(line))
+            if duplicate is not None:
+                leaks.append((test_row_index, row_indices[duplicate]))
+
+    return leaks
@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import concurrent
+import asyncio
 import json
+import math
 import os
 import random
-from concurrent.futures import ThreadPoolExecutor
-from typing import IO, Any, Dict, List, Optional
+import time
+from collections import defaultdict
+from typing import IO, Any, Dict, List, Optional, Tuple
 
 from loguru import logger
 from tqdm import tqdm
@@ -25,6 +27,9 @@ from tqdm import tqdm
 from wgpt import enums
 from wgpt.core.examples import EXAMPLES
 from wgpt.core.prompts import GENERERATE_DATA_PROMPT
+from wgpt.data.dedup import NearDuplicateIndex
+from wgpt.data.parse import SampleParser
+from wgpt.openai.batch import BatchRunner
 from wgpt.openai.client import GPTClient
 
 
@@ -36,6 +41,9 @@ class DataGenerationEngine:
             max_examples: int = 5,
             input_placeholder: str = "Input:",
             examples_separator: str = "\n\n",
+            flush_every: int = 100,
+            fsync_every_seconds: float = 30.0,
+            deduplicator: Optional[NearDuplicateIndex] = None,
     ):
         assert min_examples >= 2
 
@@ -44,13 +52,22 @@ class DataGenerationEngine:
         self.max_examples = max_examples
         self.input_placeholder = input_placeholder
         self.examples_separator = examples_separator
+        self.flush_every = flush_every
+        self.fsync_every_seconds = fsync_every_seconds
+        self.deduplicator = deduplicator
+        self.parser = SampleParser(input_placeholder=input_placeholder)
 
         self._file: Optional[IO[Any]] = None
         self._fails_file: Optional[IO[Any]] = None
         self._progress_bar: Optional[tqdm] = None
         self._counter = 0
         self._fails_counter = 0
-        self._batch_separator_fails_counter = 0
+        self._empty_batch_counter = 0
+        self._duplicates_counter = 0
+        self._requests_counter = 0
+        self._manifest_path: Optional[str] = None
+        self._last_checkpoint_counter = 0
+        self._last_fsync_time = 0.0
 
     def format_examples_prompt(self, examples: List[str]) -> str:
         text_parts = ["Examples:"] + [f"{n}. {text}" for n, text in enumerate(examples)]
@@ -66,60 +83,394 @@ class DataGenerationEngine:
         prompt = GENERERATE_DATA_PROMPT.format(examples_prompt=examples_prompt, num_samples=self.num_samples_per_batch)
         return prompt
 
-    def parse_generated_sample(self, sample: str) -> Dict[str, str]:
-        input_text, output_text = sample.split("\n")
-        weather_description = input_text[input_text.find(self.input_placeholder) + len(self.input_placeholder) + 1:]
-        weather_data = json.loads(output_text[output_text.find("{"):])
-        parsed_sample = {
-            enums.Field.description: weather_description,
-            enums.Field.data: weather_data,
-        }
-        return parsed_sample
+    def _next_cache_indices(self, num_requests: int) -> List[int]:
+        # Running request number as the cache key salt: identical prompts must still get distinct cached completions
+        cache_indices = list(range(self._requests_counter, self._requests_counter + num_requests))
+        self._requests_counter += num_requests
+        return cache_indices
+
+    def parse_generated_sample(self, sample: str) -> Dict[str, Any]:
+        parsed_samples, _ = self.parser.parse(text=sample)
+        if len(parsed_samples) != 1:
+            raise ValueError(f"Expected one sample, found {len(parsed_samples)}")
+        return parsed_samples[0]
 
-    def save_parsed_sample(self, sample: Dict[str, str]) -> None:
+    def save_parsed_sample(self, sample: Dict[str, Any]) -> None:
         if self._file is None:
             raise ValueError("File is not open")
 
+        if self.deduplicator is not None and not self.deduplicator.add(sample=sample):
+            self._duplicates_counter += 1
+            return None
+
         self._file.write(json.dumps(sample) + "\n")
         self._counter += 1
 
         if self._progress_bar is not None:
             self._progress_bar.update()
 
+    def save_failed_sample(self, sample: str) -> None:
+        self._fails_counter += 1
+        if self._fails_file is not None:
+            self._fails_file.write(json.dumps({"failed": sample}) + "\n")
+
+    def parse_generated_batch(self, raw_generated_batch: str) -> List[Dict[str, Any]]:
+        parsed_samples, failed_samples = self.parser.parse(text=raw_generated_batch)
+
+        if not parsed_samples and not failed_samples:
+            self._empty_batch_counter += 1
+
+        for failed_sample in failed_samples:
+            self.save_failed_sample(sample=failed_sample)
+
+        return parsed_samples
+
+    def _put_stream_samples(
+            self,
+            parsed_samples: List[Dict[str, Any]],
+            failed_samples: List[str],
+            samples_queue: "asyncio.Queue[Dict[str, Any]]",
+    ) -> int:
+        for failed_sample in failed_samples:
+            self.save_failed_sample(sample=failed_sample)
+
+        for parsed_sample in parsed_samples:
+            samples_queue.put_nowait(parsed_sample)
+
+        return len(parsed_samples) + len(failed_samples)
+
     def parse_generated_data(self, generated_data: List[str]) -> None:
         for raw_generated_batch in generated_data:
-            if self.examples_separator in raw_generated_batch:
-                # Yes, we drop gpt response if there's something wrong with them. Rare situation (I hope)
-                generated_batch = raw_generated_batch.split(self.examples_separator)
-                for generated_sample in generated_batch:
-                    try:
-                        parsed_sample = self.parse_generated_sample(generated_sample)
-                        self.save_parsed_sample(sample=parsed_sample)
-                    except Exception as exception:
-                        self._fails_counter += 1
-                        if self._fails_file is not None:
-                            self._fails_file.write(json.dumps({"failed": generated_sample}) + "\n")
-                        logger.error(f"Exception cathed: {exception}")
-            else:
-                self._batch_separator_fails_counter += 1
+            for parsed_sample in self.parse_generated_batch(raw_generated_batch=raw_generated_batch):
+                self.save_parsed_sample(sample=parsed_sample)
 
-    def generate_batch(self, gpt_client: GPTClient, num_rounds: int = 1) -> None:
+    def recover_fails(
+            self,
+            fails_file_path: str,
+            data_file_path: str,
+            remaining_fails_file_path: Optional[str] = None,
+    ) -> int:
+        # Re-parses failed samples of previous runs and appends everything recovered to the data file
+        with open(fails_file_path) as file_object:
+            failed_samples = [json.loads(line)["failed"] for line in file_object]
+
+        if self.deduplicator is not None and os.path.isfile(data_file_path):
+            self.deduplicator.add_file(path_to_data=data_file_path)
+
+        self._counter = 0
+        self._fails_counter = 0
+        self._empty_batch_counter = 0
+        self._duplicates_counter = 0
+        self._file = open(data_file_path, mode="a")
+        self._fails_file = open(remaining_fails_file_path, mode="w") if remaining_fails_file_path is not None else None
+
+        self.parse_generated_data(generated_data=failed_samples)
+
+        self._file.close()
+        self._file = None
+        if self._fails_file is not None:
+            self._fails_file.close()
+            self._fails_file = None
+
+        logger.info(
+            f"Recovered samples: {self._counter}. Still failed: {self._fails_counter}. "
+            f"Duplicates: {self._duplicates_counter}. Failed samples in file: {len(failed_samples)}"
+        )
+
+        return self._counter
+
+    async def agenerate_batch(self, gpt_client: GPTClient, num_rounds: int = 1) -> None:
         prompt = self.format_generate_batch_prompt()
         generated_data = list()
-        with ThreadPoolExecutor(max_workers=num_rounds) as executor:
-            futures = {executor.submit(gpt_client.one_turn_generation, prompt) for i in range(num_rounds)}
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                generated_data.extend(result)
+        results = await gpt_client.agenerate(
+            contents=[prompt] * num_rounds,
+            cache_indices=self._next_cache_indices(num_requests=num_rounds),
+        )
+        for result in results:
+            generated_data.extend(result)
         self.parse_generated_data(generated_data=generated_data)
 
-    def _build(self, data_file_path: str, fails_file_path: str, num_samples: int, data_file_mode: str = "w") -> None:
-        self._file = open(data_file_path, mode=data_file_mode)
-        self._fails_file = open(fails_file_path, mode="w")
-        self._progress_bar = tqdm(total=num_samples, desc="Generating data")
+    def generate_batch(self, gpt_client: GPTClient, num_rounds: int = 1) -> None:
+        asyncio.run(self.agenerate_batch(gpt_client=gpt_client, num_rounds=num_rounds))
+
+    @staticmethod
+    def get_manifest_path(data_file_path: str) -> str:
+        return data_file_path + ".progress.json"
+
+    @staticmethod
+    def count_valid_rows(data_file_path: str, max_size: Optional[int] = None) -> Tuple[int, int]:
+        # Returns num of valid rows and byte size of the valid prefix. Stops at the first partial or broken row
+        num_rows = 0
+        valid_size = 0
+
+        with open(data_file_path, mode="rb") as file_object:
+            for line in file_object:
+                if not line.endswith(b"\n") or (max_size is not None and valid_size + len(line) > max_size):
+                    break
+                try:
+                    sample = json.loads(line)
+                except ValueError:
+                    break
+                if not isinstance(sample, dict) or enums.Field.description not in sample:
+                    break
+                num_rows += 1
+                valid_size += len(line)
+
+        return num_rows, valid_size
+
+    def _restore(self, data_file_path: str) -> None:
+        manifest: Dict[str, Any] = dict()
+
+        if self._manifest_path is not None and os.path.isfile(self._manifest_path):
+            with open(self._manifest_path) as file_object:
+                manifest = json.load(file_object)
+
+        num_rows, valid_size = self.count_valid_rows(data_file_path=data_file_path)
+
+        checkpoint_size = manifest.get("data_file_size")
+        # Manifest is trusted when the file has exactly its num of rows at its checkpoint size
+        checkpoint_rows: Optional[int] = None
+        if checkpoint_size is not None and checkpoint_size <= valid_size:
+            checkpoint_rows, prefix_size = self.count_valid_rows(
+                data_file_path=data_file_path, max_size=checkpoint_size
+            )
+            if prefix_size != checkpoint_size:
+                checkpoint_rows = None
+
+        if checkpoint_rows is not None and manifest.get("counter") == checkpoint_rows:
+            self._fails_counter = manifest["fails_counter"]
+            self._empty_batch_counter = manifest["empty_batch_counter"]
+            self._duplicates_counter = manifest.get("duplicates_counter", 0)
+            self._requests_counter = manifest["requests_counter"]
+            version, internal_state, gauss_next = manifest["random_state"]
+            random.setstate((version, tuple(internal_state), gauss_next))
+            if num_rows > checkpoint_rows:
+                logger.info(f"Rows written after the last checkpoint are kept: {num_rows - checkpoint_rows}")
+        elif manifest:
+            logger.warning("Progress manifest does not match data file, resume from the valid rows of data file")
+
+        # Every valid row is kept, only a trailing partial or broken row is cut
+        with open(data_file_path, mode="r+b") as file_object:
+            file_object.truncate(valid_size)
+
+        self._counter = num_rows
+        self._last_checkpoint_counter = num_rows
+        logger.info(f"Resume data generation from {num_rows} samples")
+
+    def _build(
+            self,
+            data_file_path: str,
+            fails_file_path: str,
+            num_samples: int,
+            data_file_mode: str = "w",
+            resume: bool = False,
+    ) -> None:
         self._counter = 0
         self._fails_counter = 0
-        self._batch_separator_fails_counter = 0
+        self._empty_batch_counter = 0
+        self._duplicates_counter = 0
+        self._requests_counter = 0
+        self._last_checkpoint_counter = 0
+        self._last_fsync_time = time.monotonic()
+        self._manifest_path = self.get_manifest_path(data_file_path=data_file_path)
+
+        if resume and os.path.isfile(data_file_path):
+            self._restore(data_file_path=data_file_path)
+            data_file_mode = "a"
+
+        if self.deduplicator is not None and data_file_mode == "a" and os.path.isfile(data_file_path):
+            self.deduplicator.add_file(path_to_data=data_file_path)
+            logger.info(f"Deduplication index built from {len(self.deduplicator)} existing samples")
+
+        self._file = open(data_file_path, mode=data_file_mode)
+        self._fails_file = open(fails_file_path, mode="a" if resume else "w")
+        self._progress_bar = tqdm(total=num_samples, initial=self._counter, desc="Generating data")
+
+    def checkpoint(self, force: bool = False) -> None:
+        if self._file is None or self._manifest_path is None:
+            return None
+
+        if not force and self._counter - self._last_checkpoint_counter < self.flush_every:
+            return None
+
+        self._file.flush()
+        if self._fails_file is not None:
+            self._fails_file.flush()
+
+        now = time.monotonic()
+        if force or now - self._last_fsync_time >= self.fsync_every_seconds:
+            os.fsync(self._file.fileno())
+            self._last_fsync_time = now
+
+        manifest = {
+            "counter": self._counter,
+            "data_file_size": self._file.tell(),
+            "fails_counter": self._fails_counter,
+            "empty_batch_counter": self._empty_batch_counter,
+            "duplicates_counter": self._duplicates_counter,
+            "requests_counter": self._requests_counter,
+            "random_state": random.getstate(),
+        }
+
+        temp_manifest_path = self._manifest_path + ".tmp"
+        with open(temp_manifest_path, mode="w") as file_object:
+            json.dump(manifest, file_object)
+        os.replace(temp_manifest_path, self._manifest_path)
+
+        self._last_checkpoint_counter = self._counter
+
+        return None
+
+    async def _agenerate_rounds(self, gpt_client: GPTClient, num_samples: int, num_rounds_per_call: int) -> None:
+        async with gpt_client.session():
+            while self._counter < num_samples:
+                await self.agenerate_batch(gpt_client=gpt_client, num_rounds=num_rounds_per_call)
+                self.checkpoint()
+                num_sample_left = num_samples - self._counter
+                num_sample_left = num_sample_left if num_sample_left >= 0 else 0
+                logger.info(f"Generation round complete. Generated data: {self._counter}. Left: {num_sample_left}")
+
+    async def _agenerate_pipeline(
+            self,
+            gpt_client: GPTClient,
+            num_samples: int,
+            num_workers: int,
+            stream: bool = False,
+            max_consecutive_fails: int = 16,
+    ) -> None:
+        # Requests -> completions queue -> parser -> samples queue -> writer. Every worker sends a new request
+        # as soon as its previous one is done, so one slow completion does not hold the others back
+        completions_queue: "asyncio.Queue[List[str]]" = asyncio.Queue(maxsize=num_workers)
+        samples_queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        done = asyncio.Event()
+        num_consecutive_fails = 0
+
+        async def on_request_complete(is_failed: bool) -> None:
+            # Failed requests are not retried by the client on errors like 400 or 401, so without a pause here the
+            # workers would resend them in a tight loop and the writer would wait for samples forever
+            nonlocal num_consecutive_fails
+            if not is_failed:
+                num_consecutive_fails = 0
+                return
+            num_consecutive_fails += 1
+            if num_consecutive_fails >= max_consecutive_fails:
+                raise RuntimeError(f"Generation aborted: {num_consecutive_fails} requests in a row returned nothing")
+            await asyncio.sleep(gpt_client.rate_limiter.backoff_delay(attempt=num_consecutive_fails - 1))
+
+        async def request_worker() -> None:
+            while True:
+                prompt = self.format_generate_batch_prompt()
+                (cache_index,) = self._next_cache_indices(num_requests=1)
+                generated_data = await gpt_client.one_turn_generation_async(content=prompt, cache_index=cache_index)
+                is_failed = not any(generated_data)
+                if not is_failed:
+                    await completions_queue.put(generated_data)
+                await on_request_complete(is_failed=is_failed)
+
+        async def stream_worker() -> None:
+            # Samples go to the writer as soon as their json closes, and the request is closed once the target
+            # num of samples is reached, so the tail of the completion is not generated
+            while not done.is_set():
+                prompt = self.format_generate_batch_prompt()
+                (cache_index,) = self._next_cache_indices(num_requests=1)
+                parsers: Dict[int, SampleParser] = defaultdict(
+                    lambda: SampleParser(input_placeholder=self.input_placeholder)
+                )
+                num_found: Dict[int, int] = defaultdict(int)
+                deltas = gpt_client.astream_generation(content=prompt, cache_index=cache_index)
+                try:
+                    async for choice_index, delta in deltas:
+                        parsed_samples, failed_samples = parsers[choice_index].feed(text=delta)
+                        num_found[choice_index] += self._put_stream_samples(
+                            parsed_samples=parsed_samples,
+                            failed_samples=failed_samples,
+                            samples_queue=samples_queue,
+                        )
+                        if done.is_set():
+                            break
+                finally:
+                    await deltas.aclose()
+
+                if done.is_set():
+                    # Tails of the closed request are cut on purpose, they are not fails
+                    break
+
+                for choice_index, choice_parser in parsers.items():
+                    parsed_samples, failed_samples = choice_parser.finish()
+                    num_found[choice_index] += self._put_stream_samples(
+                        parsed_samples=parsed_samples,
+                        failed_samples=failed_samples,
+                        samples_queue=samples_queue,
+                    )
+                    if not num_found[choice_index]:
+                        self._empty_batch_counter += 1
+
+                await on_request_complete(is_failed=not any(num_found.values()))
+
+        async def parser() -> None:
+            while True:
+                generated_data = await completions_queue.get()
+                for raw_generated_batch in generated_data:
+                    for parsed_sample in self.parse_generated_batch(raw_generated_batch=raw_generated_batch):
+                        samples_queue.put_nowait(parsed_sample)
+
+        async def writer() -> None:
+            while self._counter < num_samples:
+                parsed_sample = await samples_queue.get()
+                self.save_parsed_sample(sample=parsed_sample)
+                self.checkpoint()
+            done.set()
+
+        async with gpt_client.session(max_concurrency=num_workers):
+            if stream:
+                tasks = [asyncio.create_task(stream_worker()) for _ in range(num_workers)]
+            else:
+                tasks = [asyncio.create_task(request_worker()) for _ in range(num_workers)]
+                tasks.append(asyncio.create_task(parser()))
+
+            writer_task = asyncio.create_task(writer())
+            try:
+                # Workers run until they are cancelled, so one that finishes before the writer has failed
+                await asyncio.wait([writer_task, *tasks], return_when=asyncio.FIRST_COMPLETED)
+                if not writer_task.done():
+                    for task in tasks:
+                        if task.done():
+                            task.result()
+                writer_task.result()
+                if stream:
+                    # Let stream workers close their requests themselves
+                    await asyncio.wait(tasks, timeout=5.0)
+            finally:
+                for task in [writer_task, *tasks]:
+                    task.cancel()
+                await asyncio.gather(writer_task, *tasks, return_exceptions=True)
+
+        logger.info(f"Generation pipeline complete. Generated data: {self._counter}. Dropped: {samples_queue.qsize()}")
+
+    def _generate_batch_api(self, batch_runner: BatchRunner, num_samples: int, num_requests: Optional[int]) -> None:
+        num_samples_per_request = batch_runner.gpt_client.num_completion * self.num_samples_per_batch
+
+        while self._counter < num_samples:
+            # Some margin over the exact num of requests, because part of generated samples fails to parse
+            num_samples_left = num_samples - self._counter
+            num_batch_requests = num_requests or math.ceil(num_samples_left / num_samples_per_request * 1.2)
+            prompts = [self.format_generate_batch_prompt() for _ in range(num_batch_requests)]
+            cache_indices = self._next_cache_indices(num_requests=num_batch_requests)
+            custom_ids = [f"generate-{cache_index}" for cache_index in cache_indices]
+
+            results = batch_runner.run(contents=prompts, custom_ids=custom_ids, cache_indices=cache_indices)
+
+            if not results:
+                raise ValueError("Batch returned no results")
+
+            for custom_id in custom_ids:
+                for raw_generated_batch in results.get(custom_id, list()):
+                    for parsed_sample in self.parse_generated_batch(raw_generated_batch=raw_generated_batch):
+                        if self._counter < num_samples:
+                            self.save_parsed_sample(sample=parsed_sample)
+
+            self.checkpoint()
+            logger.info(f"Batch complete. Generated data: {self._counter}. Left: {max(num_samples - self._counter, 0)}")
 
     def generate_data(
             self,
@@ -129,27 +480,58 @@ class DataGenerationEngine:
             data_file_mode: str = "w",
             num_samples: int = 5_000,
             num_rounds_per_call: int = 4,
+            pipeline: bool = False,
+            stream: bool = False,
+            num_workers: Optional[int] = None,
+            max_consecutive_fails: int = 16,
+            resume: bool = False,
+            batch_runner: Optional[BatchRunner] = None,
+            num_requests_per_batch: Optional[int] = None,
     ) -> None:
         self._build(
             data_file_path=data_file_path,
             fails_file_path=fails_file_path,
             data_file_mode=data_file_mode,
             num_samples=num_samples,
+            resume=resume,
         )
 
-        global_batch_size = gpt_client.num_completion * num_rounds_per_call * self.num_samples_per_batch
-
-        logger.info(
-            f"Start data generation. Required num samples: {num_samples}. Global batch size: {global_batch_size}"
-        )
+        if batch_runner is not None:
+            logger.info(f"Start batch API data generation. Required num samples: {num_samples}")
+            self._generate_batch_api(
+                batch_runner=batch_runner,
+                num_samples=num_samples,
+                num_requests=num_requests_per_batch,
+            )
+        elif pipeline or stream:
+            num_workers = num_workers or gpt_client.max_concurrency
+            logger.info(
+                f"Start {'streaming' if stream else 'pipeline'} data generation. "
+                f"Required num samples: {num_samples}. Workers: {num_workers}"
+            )
+            asyncio.run(
+                self._agenerate_pipeline(
+                    gpt_client=gpt_client,
+                    num_samples=num_samples,
+                    num_workers=num_workers,
+                    stream=stream,
+                    max_consecutive_fails=max_consecutive_fails,
+                )
+            )
+        else:
+            global_batch_size = gpt_client.num_completion * num_rounds_per_call * self.num_samples_per_batch
+            logger.info(
+                f"Start data generation. Required num samples: {num_samples}. Global batch size: {global_batch_size}"
+            )
+            asyncio.run(
+                self._agenerate_rounds(
+                    gpt_client=gpt_client,
+                    num_samples=num_samples,
+                    num_rounds_per_call=num_rounds_per_call,
+                )
+            )
 
-        while True:
-            self.generate_batch(gpt_client=gpt_client, num_rounds=num_rounds_per_call)
-            num_sample_left = num_samples - self._counter
-            num_sample_left = num_sample_left if num_sample_left >= 0 else 0
-            logger.info(f"Generation round complete. Generated data: {self._counter}. Left: {num_sample_left}")
-            if self._counter >= num_samples:
-                break
+        self.checkpoint(force=True)
 
         if self._file is not None:
             self._file.close()
@@ -158,6 +540,9 @@ class DataGenerationEngine:
             self._fails_file.close()
 
         logger.info("Data generation complete")
+        gpt_client.rate_limiter.log_stats()
+        if gpt_client.cache is not None:
+            gpt_client.cache.log_stats()
 
         if self._fails_counter > 0:
             fails_fraction = self._fails_counter * 100 / (self._fails_counter + self._counter)
@@ -165,5 +550,9 @@ class DataGenerationEngine:
         else:
             os.remove(fails_file_path)
 
-        if self._batch_separator_fails_counter > 0:
-            logger.warning(f"Batch separator num fails: {self._batch_separator_fails_counter}")
+        if self._empty_batch_counter > 0:
+            logger.warning(f"Completions without samples: {self._empty_batch_counter}")
+
+        if self.deduplicator is not None:
+            dedup_rate = self._duplicates_counter * 100 / max(self._duplicates_counter + self._counter, 1)
+            logger.info(f"Dedup rate: {dedup_rate:.2f} % - {self._duplicates_counter}")
@@ -0,0 +1,143 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mmap
+import os
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+
+INDEX_SUFFIX = ".idx.npy"
+INDEX_CHUNK_SIZE = 64 * 1024 * 1024
+NEWLINE = ord("\n")
+
+
+def get_index_path(file_path: str) -> str:
+    return file_path + INDEX_SUFFIX
+
+
+def build_line_offsets(file_path: str, chunk_size: int = INDEX_CHUNK_SIZE) -> np.ndarray:
+    # (num_lines, 2) array of start and end byte of every non empty line, end excludes the newline.
+    # File is scanned through mmap by chunks, so memory does not depend on file size
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    newline_positions = list()
+    with open(file_path, "rb") as file_object, mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        for chunk_start in range(0, file_size, chunk_size):
+            chunk = np.frombuffer(
+                buffer, dtype=np.uint8, count=min(chunk_size, file_size - chunk_start), offset=chunk_start
+            )
+            newline_positions.append(np.flatnonzero(chunk == NEWLINE) + chunk_start)
+            del chunk
+
+    ends = np.concatenate(newline_positions)
+    if not ends.size or ends[-1] != file_size - 1:
+        # Last line without trailing newline
+        ends = np.append(ends, file_size)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+
+    offsets = np.stack([starts, ends], axis=1).astype(np.int64)
+    return offsets[offsets[:, 1] > offsets[:, 0]]
+
+
+def load_line_offsets(file_path: str, index_path: Optional[str] = None) -> np.ndarray:
+    # Index is cached beside the file and rebuilt when the file is newer than the index. It is loaded as mmap,
+    # so every rank shares the same pages instead of holding its own copy
+    index_path = index_path or get_index_path(file_path=file_path)
+
+    if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(file_path):
+        offsets = build_line_offsets(file_path=file_path)
+        temporary_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file_object:
+            np.save(file_object, offsets)
+        # Atomic, so ranks building the index at the same time never read a half written one
+        os.replace(temporary_path, index_path)
+        logger.info(f"Line index built for {file_path}: {len(offsets)} lines")
+
+    return np.load(index_path, mmap_mode="r")
+
+
+class JsonlFile(Sequence[Dict[str, Any]]):
+    # Lazy list of json objects of a jsonl file. Lines are read from mmap on access, optionally through an
+    # array of line indices, which is how shuffled and split views are made without reading the file
+    def __init__(self, file_path: str, indices: Optional[np.ndarray] = None):
+        self.file_path = file_path
+        self.offsets = load_line_offsets(file_path=file_path)
+        self.indices = indices
+
+        self._file_object: Optional[BinaryIO] = None
+        self._buffer: Optional[mmap.mmap] = None
+
+    def _get_buffer(self) -> mmap.mmap:
+        # Opened on first access, so the object is cheap to pickle into dataloader workers
+        if self._buffer is None:
+            self._file_object = open(self.file_path, "rb")
+            self._buffer = mmap.mmap(self._file_object.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._buffer
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_file_object"] = None
+        state["_buffer"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.indices) if self.indices is not None else len(self.offsets)
+
+    def line_index(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index {index} is out of range")
+        return int(self.indices[index]) if self.indices is not None else index
+
+    def get_line(self, index: int) -> bytes:
+        start, end = self.offsets[self.line_index(index=index)]
+        return self._get_buffer()[start:end]
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:  # type: ignore[override]
+        sample: Dict[str, Any] = json.loads(self.get_line(index=index))
+        return sample
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def subset(self, indices: np.ndarray) -> "JsonlFile":
+        subset = JsonlFile.__new__(JsonlFile)
+        subset.file_path = self.file_path
+        subset.offsets = self.offsets
+        subset.indices = self.indices[indices] if self.indices is not None else np.asarray(indices, dtype=np.int64)
+        subset._file_object = None
+        subset._buffer = None
+        return subset
+
+    def write(self, file_path: str) -> None:
+        # Raw lines are copied, samples are not decoded and encoded again
+        offsets = self.offsets[self.indices] if self.indices is not None else self.offsets
+        buffer = self._get_buffer()
+        with open(file_path, "wb") as file_object:
+            file_object.writelines(buffer[start:end] + b"\n" for start, end in offsets.tolist())
+
+    def close(self) -> None:
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+        if self._file_object is not None:
+            self._file_object.close()
+            self._file_object = None
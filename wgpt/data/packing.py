@@ -0,0 +1,107 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+from typing import Any, List, Tuple
+
+import numpy as np
+from xllm import dist_logger
+from xllm.types import RawSample
+
+from wgpt import enums
+from wgpt.data.dataset import DescriptionToJsonDataset
+from wgpt.data.jsonl import JsonlFile
+from wgpt.data.tokens import TokenCache
+
+
+def pack_lengths(lengths: np.ndarray, max_length: int) -> List[List[int]]:
+    # Best fit decreasing: every sample, longest first, goes to the open bin with the least space that still fits
+    # it. Samples longer than max_length get a bin of their own
+    bins: List[List[int]] = list()
+    # Sorted (space left, bin index) of bins that still have space
+    free_spaces: List[Tuple[int, int]] = list()
+
+    for sample_index in np.argsort(-lengths, kind="stable").tolist():
+        length = int(lengths[sample_index])
+        position = bisect.bisect_left(free_spaces, (length, -1))
+
+        if position < len(free_spaces):
+            space_left, bin_index = free_spaces.pop(position)
+            bins[bin_index].append(sample_index)
+            space_left -= length
+        else:
+            bin_index = len(bins)
+            bins.append([sample_index])
+            space_left = max_length - length
+
+        if space_left > 0:
+            bisect.insort(free_spaces, (space_left, bin_index))
+
+    return bins
+
+
+class PackedDescriptionToJsonDataset(DescriptionToJsonDataset):
+    # Every item is several samples from the token cache packed into one sequence of up to max_length tokens.
+    # Samples keep their own positions and attention inside the sequence, see PretokenizedCompletionCollator
+    def __init__(self, data: JsonlFile, token_cache: TokenCache, max_length: int, seed: int = 42):
+        super().__init__(data=data, token_cache=token_cache)
+        self.max_length = max_length
+
+        # Input of a sample is its tokens without the last one
+        lengths = np.diff(np.asarray(token_cache.sample_offsets)) - 1
+        self.bins = pack_lengths(lengths=lengths, max_length=max_length)
+        np.random.default_rng(seed=seed).shuffle(self.bins)
+
+        num_tokens = int(lengths.sum())
+        efficiency = num_tokens / max(len(self.bins) * max_length, 1)
+        dist_logger(
+            f"Packed {len(lengths)} samples into {len(self.bins)} sequences of {max_length} tokens. "
+            f"Packing efficiency: {efficiency * 100:.1f} %. "
+            f"Samples per sequence: {len(lengths) / max(len(self.bins), 1):.2f}"
+        )
+
+    @classmethod
+    def load(  # type: ignore[override]
+            cls,
+            path_to_data: str,
+            max_length: int = 2048,
+            seed: int = 42,
+            **kwargs: Any,
+    ) -> "PackedDescriptionToJsonDataset":
+        dataset = DescriptionToJsonDataset.load(path_to_data=path_to_data)
+        if dataset.token_cache is None:
+            raise ValueError(f"Packing needs the token cache of {path_to_data}, run prepare with pretokenize")
+        return cls(data=dataset.data, token_cache=dataset.token_cache, max_length=max_length, seed=seed)
+
+    def __len__(self) -> int:
+        return len(self.bins)
+
+    def get_sample(self, index: int) -> RawSample:
+        assert self.token_cache is not None
+        token_ids: List[int] = list()
+        segment_lengths = list()
+        completion_starts = list()
+
+        for sample_index in self.bins[index]:
+            sample_token_ids, completion_start = self.token_cache.get(index=sample_index)
+            token_ids.extend(sample_token_ids)
+            segment_lengths.append(len(sample_token_ids))
+            completion_starts.append(completion_start)
+
+        return {
+            enums.Field.token_ids: token_ids,
+            enums.Field.segment_lengths: segment_lengths,
+            enums.Field.completion_starts: completion_starts,
+            enums.Field.tokenizer_hash: self.token_cache.tokenizer_hash,
+        }  # type: ignore[dict-item]
@@ -0,0 +1,188 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from wgpt import enums
+from wgpt.core.constants import WEATHER_JSON_SCHEMA
+
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+
+
+def find_json_object_end(text: str, start: int) -> Optional[int]:
+    # Index right after the balanced object that begins at text[start] == "{", or None if it is not closed yet
+    depth = 0
+    in_string = False
+    escaped = False
+
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+
+    return None
+
+
+def loads_json_object(text: str) -> Dict[str, Any]:
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = json.loads(TRAILING_COMMA_PATTERN.sub(r"\1", text))
+
+    if not isinstance(data, dict):
+        raise ValueError("JSON is not an object")
+
+    return data
+
+
+def validate_weather_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    if set(data) != set(WEATHER_JSON_SCHEMA):
+        raise ValueError(f"Wrong JSON fields: {sorted(data)}")
+
+    validated_data: Dict[str, Any] = dict()
+
+    for field_name, field_type in WEATHER_JSON_SCHEMA.items():
+        value = data[field_name]
+        if value is None:
+            validated_data[field_name] = None
+        elif field_type is str:
+            if not isinstance(value, str):
+                raise ValueError(f"Field {field_name} must be a string")
+            validated_data[field_name] = value
+        else:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"Field {field_name} must be a number")
+            validated_data[field_name] = int(round(value)) if field_type is int else float(value)
+
+    return validated_data
+
+
+class SampleParser:
+    def __init__(self, input_placeholder: str = "Input:", output_placeholder: str = "Output:"):
+        self.input_placeholder = input_placeholder
+        self.output_placeholder = output_placeholder
+
+        self._input_pattern = re.compile(re.escape(input_placeholder), flags=re.IGNORECASE)
+        self._output_pattern = re.compile(re.escape(output_placeholder), flags=re.IGNORECASE)
+
+        self._buffer = ""
+
+    @staticmethod
+    def clean_description(text: str) -> str:
+        # Description is the first non-empty line, the rest is usually model commentary
+        lines = [line for line in (line.strip().strip("*_`").strip() for line in text.split("\n")) if line]
+        text = lines[0] if lines else ""
+        if len(text) > 1 and text[0] == text[-1] and text[0] in "\"'":
+            text = text[1:-1].strip()
+        return text
+
+    def _parse_pair(self, description_text: str, json_text: str) -> Dict[str, Any]:
+        description = self.clean_description(description_text)
+        if not description:
+            raise ValueError("Empty description")
+
+        weather_data = validate_weather_data(loads_json_object(json_text))
+
+        parsed_sample = {
+            enums.Field.description: description,
+            enums.Field.data: weather_data,
+        }
+        return parsed_sample
+
+    def _next_sample(self, final: bool) -> Optional[Tuple[Optional[Dict[str, Any]], str, int]]:
+        # Returns (parsed sample or None if it is invalid, raw sample text, num consumed chars) or None if the buffer
+        # does not contain a complete sample yet
+        input_match = self._input_pattern.search(self._buffer)
+        if input_match is None:
+            return None
+
+        description_start = input_match.end()
+        next_input_match = self._input_pattern.search(self._buffer, description_start)
+        sample_end = next_input_match.start() if next_input_match is not None else len(self._buffer)
+
+        output_match = self._output_pattern.search(self._buffer, description_start, sample_end)
+
+        if output_match is None and next_input_match is None and not final:
+            # Output placeholder may still be on the way, braces in the description must not be taken for JSON
+            return None
+
+        json_search_start = output_match.end() if output_match is not None else description_start
+        json_start = self._buffer.find("{", json_search_start, sample_end)
+        json_end = find_json_object_end(self._buffer, json_start) if json_start >= 0 else None
+
+        if json_end is None or json_end > sample_end:
+            if next_input_match is None and not final:
+                return None
+            return None, self._buffer[input_match.start(): sample_end], sample_end
+
+        description_end = output_match.start() if output_match is not None else json_start
+        raw_sample = self._buffer[input_match.start(): json_end]
+
+        try:
+            parsed_sample = self._parse_pair(
+                description_text=self._buffer[description_start:description_end],
+                json_text=self._buffer[json_start:json_end],
+            )
+        except ValueError:
+            return None, raw_sample, json_end
+
+        return parsed_sample, raw_sample, json_end
+
+    def _drain(self, final: bool) -> Tuple[List[Dict[str, Any]], List[str]]:
+        parsed_samples = list()
+        failed_samples = list()
+
+        while True:
+            result = self._next_sample(final=final)
+            if result is None:
+                break
+            parsed_sample, raw_sample, num_consumed = result
+            self._buffer = self._buffer[num_consumed:]
+            if parsed_sample is not None:
+                parsed_samples.append(parsed_sample)
+            elif raw_sample.strip():
+                failed_samples.append(raw_sample)
+
+        return parsed_samples, failed_samples
+
+    def feed(self, text: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+        # Incremental mode: returns samples that are complete so far and keeps the tail for the next call
+        self._buffer += text
+        return self._drain(final=False)
+
+    def finish(self) -> Tuple[List[Dict[str, Any]], List[str]]:
+        parsed_samples, failed_samples = self._drain(final=True)
+        self._buffer = ""
+        return parsed_samples, failed_samples
+
+    def parse(self, text: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+        self._buffer = ""
+        parsed_samples, failed_samples = self.feed(text=text)
+        final_parsed_samples, final_failed_samples = self.finish()
+        return parsed_samples + final_parsed_samples, failed_samples + final_failed_samples
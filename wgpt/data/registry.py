@@ -12,12 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from xllm.collators import collators_registry
 from xllm.datasets import datasets_registry
+from xllm.experiments import experiments_registry
 
-from wgpt.core.constants import DATASET_KEY
+from wgpt.core.constants import COLLATOR_KEY, DATASET_KEY, PACKING_EXPERIMENT_KEY
+from wgpt.core.experiment import PackingExperiment
 
-from .dataset import DescriptionToJsonDataset
+from .collator import PretokenizedCompletionCollator
+from .dataset import DescriptionToJsonDataset, DescriptionToJsonTextDataset
 
 
-def registry_description_to_json_dataset() -> None:
-    datasets_registry.add(key=DATASET_KEY, value=DescriptionToJsonDataset)
+def registry_description_to_json_dataset(use_token_cache: bool = True) -> None:
+    dataset_cls = DescriptionToJsonDataset if use_token_cache else DescriptionToJsonTextDataset
+    datasets_registry.add(key=DATASET_KEY, value=dataset_cls)
+
+
+def registry_pretokenized_completion_collator() -> None:
+    collators_registry.add(key=COLLATOR_KEY, value=PretokenizedCompletionCollator)
+
+
+def registry_packing_experiment() -> None:
+    experiments_registry.add(key=PACKING_EXPERIMENT_KEY, value=PackingExperiment)
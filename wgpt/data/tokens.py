@@ -0,0 +1,178 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+from transformers import PreTrainedTokenizerBase
+
+TOKEN_CACHE_SUFFIX = ".tokens-"
+TOKEN_IDS_FILE_NAME = "token_ids.npy"
+SAMPLE_OFFSETS_FILE_NAME = "sample_offsets.npy"
+COMPLETION_STARTS_FILE_NAME = "completion_starts.npy"
+
+
+def get_tokenizer_hash(tokenizer: PreTrainedTokenizerBase) -> str:
+    # Full tokenizer definition for fast tokenizers, vocab and special tokens for the rest
+    if tokenizer.is_fast:
+        definition = tokenizer.backend_tokenizer.to_str()
+    else:
+        definition = json.dumps(
+            {
+                "class": type(tokenizer).__name__,
+                "vocab": tokenizer.get_vocab(),
+                "special_tokens": tokenizer.special_tokens_map,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+    return hashlib.sha256(definition.encode("utf-8")).hexdigest()[:16]
+
+
+def get_token_cache_dir(file_path: str, tokenizer_hash: str) -> str:
+    return file_path + TOKEN_CACHE_SUFFIX + tokenizer_hash
+
+
+def find_token_cache_dir(file_path: str) -> Optional[str]:
+    # Latest cache beside the file, the collator checks that it was built with its tokenizer
+    cache_dirs = [
+        cache_dir
+        for cache_dir in glob.glob(glob.escape(file_path) + TOKEN_CACHE_SUFFIX + "*")
+        if os.path.isfile(os.path.join(cache_dir, TOKEN_IDS_FILE_NAME))
+        and os.path.getmtime(cache_dir) >= os.path.getmtime(file_path)
+    ]
+    if not cache_dirs:
+        return None
+    return max(cache_dirs, key=os.path.getmtime)
+
+
+def tokenize_text_parts(
+        tokenizer: PreTrainedTokenizerBase,
+        batch_text_parts: List[List[str]],
+        separator: str = "\n",
+) -> List[Tuple[List[int], int]]:
+    # Same tokens as xllm CompletionCollator: every part gets the separator and is tokenized on its own, the first
+    # token of every part but the first is dropped. Returns token ids and the start of the last part
+    flat_texts = [text + separator for text_parts in batch_text_parts for text in text_parts]
+    flat_token_ids = tokenizer(flat_texts)["input_ids"]
+
+    tokenized = list()
+    position = 0
+    for text_parts in batch_text_parts:
+        token_ids: List[int] = list()
+        completion_start = 0
+        for part_index, part_token_ids in enumerate(flat_token_ids[position: position + len(text_parts)]):
+            if part_index > 0:
+                part_token_ids = part_token_ids[1:]
+            if part_index == len(text_parts) - 1:
+                completion_start = len(token_ids)
+            token_ids.extend(part_token_ids)
+        position += len(text_parts)
+        tokenized.append((token_ids, completion_start))
+
+    return tokenized
+
+
+def build_token_cache(
+        samples: Iterable[List[str]],
+        num_samples: int,
+        tokenizer: PreTrainedTokenizerBase,
+        cache_dir: str,
+        separator: str = "\n",
+        batch_size: int = 1024,
+) -> None:
+    # Token ids of all samples in one flat array, sample i is token_ids[sample_offsets[i]: sample_offsets[i + 1]]
+    # and its completion starts completion_starts[i] tokens in
+    dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+    token_ids_chunks = list()
+    sample_lengths = np.zeros(num_samples, dtype=np.int64)
+    completion_starts = np.zeros(num_samples, dtype=np.int32)
+
+    batch: List[List[str]] = list()
+    sample_index = 0
+
+    def flush() -> None:
+        nonlocal sample_index
+        for token_ids, completion_start in tokenize_text_parts(
+                tokenizer=tokenizer, batch_text_parts=batch, separator=separator
+        ):
+            token_ids_chunks.append(np.asarray(token_ids, dtype=dtype))
+            sample_lengths[sample_index] = len(token_ids)
+            completion_starts[sample_index] = completion_start
+            sample_index += 1
+        batch.clear()
+
+    for text_parts in tqdm(samples, total=num_samples, desc="Tokenizing"):
+        batch.append(text_parts)
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+
+    sample_offsets = np.zeros(num_samples + 1, dtype=np.int64)
+    np.cumsum(sample_lengths, out=sample_offsets[1:])
+
+    # Built in a temporary dir and moved, so an interrupted build never looks like a valid cache
+    temporary_dir = f"{cache_dir}.{os.getpid()}.tmp"
+    os.makedirs(temporary_dir, exist_ok=True)
+    np.save(os.path.join(temporary_dir, TOKEN_IDS_FILE_NAME), np.concatenate(token_ids_chunks or [np.zeros(0, dtype)]))
+    np.save(os.path.join(temporary_dir, SAMPLE_OFFSETS_FILE_NAME), sample_offsets)
+    np.save(os.path.join(temporary_dir, COMPLETION_STARTS_FILE_NAME), completion_starts)
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(temporary_dir, cache_dir)
+
+    logger.info(f"Token cache saved to {cache_dir}. Samples: {num_samples}. Tokens: {sample_offsets[-1]}")
+
+
+class TokenCache:
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.tokenizer_hash = cache_dir.rsplit(TOKEN_CACHE_SUFFIX, 1)[-1]
+        self.token_ids = np.load(os.path.join(cache_dir, TOKEN_IDS_FILE_NAME), mmap_mode="r")
+        self.sample_offsets = np.load(os.path.join(cache_dir, SAMPLE_OFFSETS_FILE_NAME), mmap_mode="r")
+        self.completion_starts = np.load(os.path.join(cache_dir, COMPLETION_STARTS_FILE_NAME), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.completion_starts)
+
+    def get(self, index: int) -> Tuple[List[int], int]:
+        start, end = self.sample_offsets[index], self.sample_offsets[index + 1]
+        return self.token_ids[start:end].tolist(), int(self.completion_starts[index])
+
+
+def build_token_cache_for_file(
+        file_path: str,
+        tokenizer: PreTrainedTokenizerBase,
+        get_text_parts: Callable[[int], List[str]],
+        num_samples: int,
+        separator: str = "\n",
+) -> str:
+    cache_dir = get_token_cache_dir(file_path=file_path, tokenizer_hash=get_tokenizer_hash(tokenizer=tokenizer))
+    build_token_cache(
+        samples=(get_text_parts(index) for index in range(num_samples)),
+        num_samples=num_samples,
+        tokenizer=tokenizer,
+        cache_dir=cache_dir,
+        separator=separator,
+    )
+    return cache_dir
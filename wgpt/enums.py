@@ -23,6 +23,19 @@ class Field:
     description: str = "description"
     data: str = "data"
 
+    index: str = "index"
+    generated: str = "generated"
+
+    prompt_id: str = "prompt_id"
+    content_hash: str = "content_hash"
+    responses: str = "responses"
+
+    token_ids: str = "token_ids"
+    completion_start: str = "completion_start"
+    tokenizer_hash: str = "tokenizer_hash"
+    segment_lengths: str = "segment_lengths"
+    completion_starts: str = "completion_starts"
+
 
 @dataclass
 class GPTRole:
@@ -31,6 +44,30 @@ class GPTRole:
     user: str = "user"
 
 
+@dataclass
+class Batching:
+    fixed: str = "fixed"
+    sorted: str = "sorted"
+    token_budget: str = "token_budget"
+
+
+@dataclass
+class Speculation:
+    prompt_lookup: str = "prompt_lookup"
+    draft_model: str = "draft_model"
+
+
+@dataclass
+class BatchStatus:
+    in_progress: str = "in_progress"
+    completed: str = "completed"
+    failed: str = "failed"
+    expired: str = "expired"
+    cancelled: str = "cancelled"
+
+    terminal = (completed, failed, expired, cancelled)
+
+
 @dataclass
 class EnvironmentVariable:
     openai_api_key: str = "OPENAI_API_KEY"
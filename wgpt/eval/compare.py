@@ -0,0 +1,144 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from wgpt.core.constants import CATEGORICAL_SYNONYMS, WEATHER_JSON_SCHEMA
+
+CORRECT = "correct"
+INCORRECT = "incorrect"
+
+# "none" means no precipitation rather than an unknown value, so it is not folded into null
+NULL_STRINGS = {"", "null", "n/a", "unknown"}
+
+
+def normalize_string(value: Any, synonyms: Optional[Dict[str, str]] = None) -> Optional[str]:
+    # Lower case with "_" and "-" as spaces, so "Partly_Cloudy" and "partly cloudy" are equal. Null-like strings
+    # are None
+    if value is None:
+        return None
+    text = " ".join(str(value).lower().replace("_", " ").replace("-", " ").strip().strip(".").split())
+    if text in NULL_STRINGS:
+        return None
+    return synonyms.get(text, text) if synonyms else text
+
+
+class FieldComparator:
+    # Labels clear cases without the labeling model: every field equal after normalization is correct, broken
+    # json or many wrong fields is incorrect. Everything in between, a different key set included, is left for the
+    # labeling model
+    def __init__(
+            self,
+            schema: Optional[Dict[str, type]] = None,
+            absolute_tolerance: float = 0.5,
+            relative_tolerance: float = 0.01,
+            synonyms: Optional[Dict[str, Dict[str, str]]] = None,
+            min_incorrect_fields: int = 3,
+    ):
+        self.schema = schema or WEATHER_JSON_SCHEMA
+        self.absolute_tolerance = absolute_tolerance
+        self.relative_tolerance = relative_tolerance
+        self.synonyms = CATEGORICAL_SYNONYMS if synonyms is None else synonyms
+        self.min_incorrect_fields = min_incorrect_fields
+
+        self.num_compared = 0
+        self.num_correct = 0
+        self.num_incorrect = 0
+
+    @property
+    def num_ambiguous(self) -> int:
+        return self.num_compared - self.num_correct - self.num_incorrect
+
+    def normalize_string(self, value: Any, field_name: str) -> Optional[str]:
+        return normalize_string(value=value, synonyms=self.synonyms.get(field_name))
+
+    @staticmethod
+    def normalize_number(value: Any) -> Optional[float]:
+        if value is None or isinstance(value, bool):
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        try:
+            return float(str(value).strip().rstrip("%"))
+        except ValueError:
+            return None
+
+    def is_field_equal(self, field_name: str, field_type: type, generated_value: Any, true_value: Any) -> bool:
+        if field_type is str:
+            return self.normalize_string(value=generated_value, field_name=field_name) == self.normalize_string(
+                value=true_value, field_name=field_name
+            )
+
+        generated_number = self.normalize_number(generated_value)
+        true_number = self.normalize_number(true_value)
+        if generated_number is None or true_number is None:
+            return generated_number is None and true_number is None
+
+        tolerance = max(self.absolute_tolerance, self.relative_tolerance * abs(true_number))
+        return abs(generated_number - true_number) <= tolerance
+
+    def find_wrong_fields(self, generated_data: Dict[str, Any], true_data: Dict[str, Any]) -> List[str]:
+        return [
+            field_name
+            for field_name, field_type in self.schema.items()
+            if not self.is_field_equal(
+                field_name=field_name,
+                field_type=field_type,
+                generated_value=generated_data.get(field_name),
+                true_value=true_data.get(field_name),
+            )
+        ]
+
+    def compare(self, generated_json_string: str, true_json_string: str) -> Optional[str]:
+        # Returns an assessment for clear cases and None for ambiguous ones
+        self.num_compared += 1
+
+        try:
+            generated_data = json.loads(generated_json_string)
+        except json.JSONDecodeError:
+            generated_data = None
+
+        if not isinstance(generated_data, dict):
+            self.num_incorrect += 1
+            return INCORRECT
+
+        # Missing or extra keys may still carry right values, e.g. under a renamed key
+        if set(generated_data) != set(self.schema):
+            return None
+
+        wrong_fields = self.find_wrong_fields(generated_data=generated_data, true_data=json.loads(true_json_string))
+
+        if not wrong_fields:
+            self.num_correct += 1
+            return CORRECT
+
+        if len(wrong_fields) >= self.min_incorrect_fields:
+            self.num_incorrect += 1
+            return INCORRECT
+
+        return None
+
+    def log_stats(self) -> None:
+        if not self.num_compared:
+            return
+
+        logger.info(
+            f"Pre-judged: {self.num_correct + self.num_incorrect} of {self.num_compared} "
+            f"({(self.num_correct + self.num_incorrect) * 100 / self.num_compared:.1f} %). "
+            f"Correct: {self.num_correct}. Incorrect: {self.num_incorrect}. "
+            f"Saved labeling requests: {self.num_correct + self.num_incorrect}. Sent: {self.num_ambiguous}"
+        )
@@ -0,0 +1,259 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from loguru import logger
+from torch import Tensor
+from transformers import BatchEncoding, PreTrainedModel, PreTrainedTokenizerBase
+
+from wgpt.core.constants import WEATHER_JSON_SCHEMA
+
+NULL = "null"
+
+VALUE_PREFIX_PATTERNS = {
+    str: re.compile(r'"[^"\\\x00-\x1f]*"?'),
+    int: re.compile(r"-?(0|[1-9]\d*)?"),
+    float: re.compile(r"-?((0|[1-9]\d*)(\.\d*)?)?"),
+}
+
+VALUE_PATTERNS = {
+    str: re.compile(r'"[^"\\\x00-\x1f]*"'),
+    int: re.compile(r"-?(0|[1-9]\d*)"),
+    float: re.compile(r"-?(0|[1-9]\d*)(\.\d+)?"),
+}
+
+
+def is_value_prefix(value: str, value_type: type) -> bool:
+    return not value or NULL.startswith(value) or VALUE_PREFIX_PATTERNS[value_type].fullmatch(value) is not None
+
+
+def is_value_complete(value: str, value_type: type) -> bool:
+    return value == NULL or VALUE_PATTERNS[value_type].fullmatch(value) is not None
+
+
+def is_value_closed(value: str, value_type: type) -> bool:
+    # Complete and can not be continued, so forced text follows without asking the model
+    return value == NULL or (value_type is str and is_value_complete(value=value, value_type=value_type))
+
+
+def complete_value(value: str, value_type: type) -> str:
+    # Shortest suffix that makes a valid value, used when the value runs out of tokens
+    if is_value_complete(value=value, value_type=value_type):
+        return ""
+    if not value or NULL.startswith(value):
+        return NULL[len(value):]
+    if value_type is str:
+        return '"'
+    return "0"
+
+
+class SchemaConstrainedDecoder:
+    # Greedy decoding where the json structure comes from the schema: braces, quotes, keys and separators are
+    # fed to the model in bulk as one chunk per step, and only value tokens are chosen by the model among
+    # tokens that keep the value valid. Rows of a batch feed chunks of different length in the same forward,
+    # shorter chunks are padded and masked out
+    def __init__(
+            self,
+            tokenizer: PreTrainedTokenizerBase,
+            schema: Optional[Dict[str, type]] = None,
+            max_value_tokens: int = 16,
+            top_k: int = 64,
+    ):
+        self.tokenizer = tokenizer
+        self.schema = schema or WEATHER_JSON_SCHEMA
+        self.max_value_tokens = max_value_tokens
+        self.top_k = top_k
+
+        self.field_types = list(self.schema.values())
+        field_names = list(self.schema)
+        self.forced_texts = ["{" + json.dumps(field_names[0]) + ": "]
+        self.forced_texts.extend(", " + json.dumps(field_name) + ": " for field_name in field_names[1:])
+        self.forced_texts.append("}")
+
+        self._anchor_ids: List[int] = self.tokenizer.encode("{", add_special_tokens=False)
+        self._anchor_text = self.tokenizer.decode(self._anchor_ids)
+        self._token_texts: Dict[int, str] = dict()
+        self._forced_ids: Dict[str, List[int]] = dict()
+
+        self.num_forward_passes = 0
+        self.num_forced_tokens = 0
+        self.num_chosen_tokens = 0
+
+    def token_text(self, token_id: int) -> str:
+        # Decoded after an anchor, so tokenizers that drop the leading space of a lone token keep it
+        if token_id not in self._token_texts:
+            text = self.tokenizer.decode(self._anchor_ids + [token_id])
+            self._token_texts[token_id] = text[len(self._anchor_text):]
+        return self._token_texts[token_id]
+
+    def encode_continuation(self, text: str) -> List[int]:
+        if not text:
+            return list()
+        if text not in self._forced_ids:
+            token_ids = self.tokenizer.encode(self._anchor_text + text, add_special_tokens=False)
+            if token_ids[: len(self._anchor_ids)] == self._anchor_ids:
+                token_ids = token_ids[len(self._anchor_ids):]
+            else:
+                token_ids = self.tokenizer.encode(text, add_special_tokens=False)
+            self._forced_ids[text] = token_ids
+        return self._forced_ids[text]
+
+    def choose(
+            self,
+            logits: Tensor,
+            value: str,
+            value_type: type,
+            next_forced_text: str,
+    ) -> Tuple[int, str, str, bool]:
+        # First token in order of logits that continues the value, or completes it and starts the forced text.
+        # Returns token id, text added to the value, forced text left to feed after the token, is value finished
+        top_k = min(self.top_k, logits.shape[-1])
+        for candidates in (torch.topk(logits, k=top_k).indices, torch.argsort(logits, descending=True)[top_k:]):
+            for token_id in candidates.tolist():
+                text = self.token_text(token_id=token_id)
+                if not text:
+                    continue
+
+                if is_value_prefix(value=value + text, value_type=value_type):
+                    if is_value_closed(value=value + text, value_type=value_type):
+                        return token_id, text, next_forced_text, True
+                    return token_id, text, "", False
+
+                for split_index in range(len(text) - 1, -1, -1):
+                    value_part, forced_part = text[:split_index], text[split_index:]
+                    if not next_forced_text.startswith(forced_part):
+                        continue
+                    if is_value_complete(value=value + value_part, value_type=value_type):
+                        return token_id, value_part, next_forced_text[len(forced_part):], True
+
+        raise ValueError("No token continues the value")
+
+    def _forward(self, model: PreTrainedModel, input_ids: Tensor, attention_mask: Tensor, past_key_values: Any) -> Any:
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)[:, -input_ids.shape[1]:]
+        self.num_forward_passes += 1
+        return model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+
+    @torch.no_grad()
+    def generate(self, model: PreTrainedModel, batch_tokenized: BatchEncoding) -> Tensor:
+        device = batch_tokenized.input_ids.device
+        batch_size = batch_tokenized.input_ids.shape[0]
+        pad_token_id = self.tokenizer.pad_token_id
+
+        first_forced_ids = self.encode_continuation(text=self.forced_texts[0])
+        generated_ids: List[List[int]] = [list(first_forced_ids) for _ in range(batch_size)]
+        field_indices = [0] * batch_size
+        values = [""] * batch_size
+        num_value_tokens = [0] * batch_size
+        done = [False] * batch_size
+
+        input_ids = torch.cat(
+            [batch_tokenized.input_ids, torch.tensor([first_forced_ids] * batch_size, device=device)], dim=1
+        )
+        attention_mask = torch.cat(
+            [batch_tokenized.attention_mask, torch.ones(batch_size, len(first_forced_ids), device=device).long()],
+            dim=1,
+        )
+        self.num_forced_tokens += batch_size * len(first_forced_ids)
+        last_positions = [input_ids.shape[1] - 1] * batch_size
+        past_key_values = None
+
+        while True:
+            outputs = self._forward(
+                model=model, input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values
+            )
+            past_key_values = outputs.past_key_values
+            logits = outputs.logits
+
+            chunks: List[List[int]] = list()
+
+            for row in range(batch_size):
+                if done[row]:
+                    chunks.append(list())
+                    continue
+
+                field_index = field_indices[row]
+                value_type = self.field_types[field_index]
+                next_forced_text = self.forced_texts[field_index + 1]
+
+                if num_value_tokens[row] >= self.max_value_tokens:
+                    forced_text = complete_value(value=values[row], value_type=value_type) + next_forced_text
+                    chunk = self.encode_continuation(text=forced_text)
+                    self.num_forced_tokens += len(chunk)
+                    value_finished = True
+                else:
+                    token_id, value_text, forced_text, value_finished = self.choose(
+                        logits=logits[row, last_positions[row]],
+                        value=values[row],
+                        value_type=value_type,
+                        next_forced_text=next_forced_text,
+                    )
+                    values[row] += value_text
+                    num_value_tokens[row] += 1
+                    forced_ids = self.encode_continuation(text=forced_text)
+                    chunk = [token_id] + forced_ids
+                    self.num_chosen_tokens += 1
+                    self.num_forced_tokens += len(forced_ids)
+
+                generated_ids[row].extend(chunk)
+
+                if value_finished:
+                    field_indices[row] += 1
+                    values[row] = ""
+                    num_value_tokens[row] = 0
+                    if field_indices[row] == len(self.field_types):
+                        # Closing brace is already in the chunk, nothing left to ask the model
+                        done[row] = True
+                        chunk = list()
+
+                chunks.append(chunk)
+
+            if all(done):
+                break
+
+            chunk_length = max(len(chunk) for chunk in chunks)
+            input_ids = torch.tensor(
+                [chunk + [pad_token_id] * (chunk_length - len(chunk)) for chunk in chunks], device=device
+            )
+            chunk_mask = torch.tensor(
+                [[1] * len(chunk) + [0] * (chunk_length - len(chunk)) for chunk in chunks], device=device
+            )
+            attention_mask = torch.cat([attention_mask, chunk_mask], dim=1)
+            # Logits of a row are taken from its last real token of the chunk
+            last_positions = [max(len(chunk), 1) - 1 for chunk in chunks]
+
+        max_generated_length = max(len(row_ids) for row_ids in generated_ids)
+        new_ids = torch.tensor(
+            [row_ids + [pad_token_id] * (max_generated_length - len(row_ids)) for row_ids in generated_ids]
+        )
+
+        return torch.cat([batch_tokenized.input_ids.cpu(), new_ids], dim=1)
+
+    def log_stats(self) -> None:
+        num_tokens = self.num_forced_tokens + self.num_chosen_tokens
+        if num_tokens:
+            logger.info(
+                f"Constrained decoding. Forward passes: {self.num_forward_passes}. "
+                f"Tokens chosen by model: {self.num_chosen_tokens}. "
+                f"Forced tokens: {self.num_forced_tokens} ({self.num_forced_tokens * 100 / num_tokens:.1f} %)"
+            )
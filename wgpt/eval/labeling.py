@@ -12,18 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import concurrent
+import asyncio
 import json
 import random
 from collections import Counter
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from loguru import logger
 
 from wgpt import enums
 from wgpt.core.prompts import LABELING_PROMPT
+from wgpt.eval.compare import FieldComparator
+from wgpt.openai.batch import BatchRunner
 from wgpt.openai.client import GPTClient
+from wgpt.openai.executor import IndexedExecutor
 
 from .wrapper import WGPTWrapper
 
@@ -33,13 +35,24 @@ class Labeler:
             self,
             wrapper: WGPTWrapper,
             gpt_client: GPTClient,
-            num_requests: int = 8,
+            num_requests: Optional[int] = None,
             assessment_placeholder: str = "Assessment:",
+            batch_runner: Optional[BatchRunner] = None,
+            pipeline: bool = False,
+            comparator: Optional[FieldComparator] = None,
+            executor: Optional[IndexedExecutor] = None,
     ):
+        if pipeline and batch_runner is not None:
+            raise ValueError("Pipeline labeling does not work with batch API")
+
         self.wrapper = wrapper
         self.gpt_client = gpt_client
         self.num_requests = num_requests
         self.assessment_placeholder = assessment_placeholder
+        self.batch_runner = batch_runner
+        self.pipeline = pipeline
+        self.comparator = comparator
+        self.executor = executor or IndexedExecutor(gpt_client=gpt_client)
 
     def format_prompt(self, weather_description: str, generated_json_string: str, true_json_string: str) -> str:
         prompt = LABELING_PROMPT.format(
@@ -49,20 +62,120 @@ class Labeler:
         )
         return prompt
 
-    def label_batch(self, prompts: List[str]) -> List[str]:
-        generated_data = list()
-        with ThreadPoolExecutor(max_workers=self.num_requests) as executor:
-            futures = {executor.submit(self.gpt_client.one_turn_generation, prompt) for prompt in prompts}
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                generated_data.extend(result)
+    @staticmethod
+    def build_prompt_ids(sample_indices: List[int]) -> List[str]:
+        return [f"label-{sample_index}" for sample_index in sample_indices]
+
+    async def alabel_batch(self, prompts: List[str], sample_indices: Optional[List[int]] = None) -> List[str]:
+        # One assessment per prompt in order of prompts, empty string for a failed request
+        prompt_ids = self.build_prompt_ids(sample_indices=sample_indices or list(range(len(prompts))))
+        results = await self.executor.arun(contents=prompts, prompt_ids=prompt_ids, max_concurrency=self.num_requests)
+        return [results[prompt_id][0] if prompt_id in results else "" for prompt_id in prompt_ids]
+
+    def label_batch_offline(self, prompts: List[str], sample_indices: Optional[List[int]] = None) -> List[str]:
+        if self.batch_runner is None:
+            raise ValueError("Batch runner is not set")
+
+        custom_ids = self.build_prompt_ids(sample_indices=sample_indices or list(range(len(prompts))))
+        results = self.batch_runner.run(contents=prompts, custom_ids=custom_ids)
+        return [results[custom_id][0] if results.get(custom_id) else "" for custom_id in custom_ids]
+
+    def label_batch(self, prompts: List[str], sample_indices: Optional[List[int]] = None) -> List[str]:
+        if self.batch_runner is not None:
+            return self.label_batch_offline(prompts=prompts, sample_indices=sample_indices)
+        generated_data = asyncio.run(self.alabel_batch(prompts=prompts, sample_indices=sample_indices))
         return generated_data
 
     def parse_assessment(self, text: str) -> str:
         if self.assessment_placeholder in text:
             text = text[text.find(self.assessment_placeholder) + len(self.assessment_placeholder):]
-        text = text.lower().split()[0]
-        return text
+        # Empty assessment is returned for responses with nothing to parse, such samples stay unlabeled
+        tokens = text.lower().split()
+        return tokens[0] if tokens else ""
+
+    def prejudge(self, generated_json_string: str, true_json_string: str) -> Optional[str]:
+        if self.comparator is None:
+            return None
+        return self.comparator.compare(generated_json_string=generated_json_string, true_json_string=true_json_string)
+
+    def log_assessments(self, assessments: List[str]) -> None:
+        # Empty assessment means the labeling request failed
+        counter = Counter(assessment for assessment in assessments if assessment)
+
+        num_elements = sum(counter.values())
+        num_failed = len(assessments) - num_elements
+
+        for key, value in counter.items():
+            fraction = value / num_elements
+            logger.info(f"{key}: {fraction:.2f}")
+
+        if num_failed:
+            logger.warning(f"Failed labeling requests: {num_failed}")
+
+    async def arun_pipeline(
+            self,
+            weather_descriptions: List[str],
+            true_json_strings: List[str],
+    ) -> Tuple[List[str], List[str]]:
+        # Every finished batch of the local model goes to labeling right away, while the model works on the
+        # next one, so eval takes about max(inference, labeling) instead of their sum
+        loop = asyncio.get_running_loop()
+        batches_queue: "asyncio.Queue[Optional[Tuple[List[int], List[str]]]]" = asyncio.Queue()
+
+        generated_json_strings = [""] * len(weather_descriptions)
+        assessments = [""] * len(weather_descriptions)
+        counter: Counter = Counter()
+
+        def run_inference() -> None:
+            try:
+                for batch in self.wrapper.iter_generate(texts=weather_descriptions):
+                    loop.call_soon_threadsafe(batches_queue.put_nowait, batch)
+            finally:
+                loop.call_soon_threadsafe(batches_queue.put_nowait, None)
+
+        async def label(sample_index: int) -> None:
+            assessment = self.prejudge(
+                generated_json_string=generated_json_strings[sample_index],
+                true_json_string=true_json_strings[sample_index],
+            )
+            if assessment is not None:
+                assessments[sample_index] = assessment
+                counter[assessment] += 1
+                return
+
+            sample_prompt = self.format_prompt(
+                weather_description=weather_descriptions[sample_index],
+                generated_json_string=generated_json_strings[sample_index],
+                true_json_string=true_json_strings[sample_index],
+            )
+            (prompt_id,) = self.build_prompt_ids(sample_indices=[sample_index])
+            raw_assessments = await self.executor.arun_one(prompt_id=prompt_id, content=sample_prompt)
+            assessment = self.parse_assessment(raw_assessments[0]) if raw_assessments else ""
+            if assessment:
+                assessments[sample_index] = assessment
+                counter[assessment] += 1
+
+        labeling_tasks: List["asyncio.Task[None]"] = list()
+
+        async with self.gpt_client.session(max_concurrency=self.num_requests):
+            inference = loop.run_in_executor(None, run_inference)
+            try:
+                while True:
+                    batch = await batches_queue.get()
+                    if batch is None:
+                        break
+                    for sample_index, generated_json_string in zip(*batch):
+                        generated_json_strings[sample_index] = generated_json_string
+                        labeling_tasks.append(asyncio.create_task(label(sample_index=sample_index)))
+                    logger.info(f"Labeling in progress. Sent: {len(labeling_tasks)}. Labeled: {dict(counter)}")
+
+                await inference
+                await asyncio.gather(*labeling_tasks)
+            finally:
+                for task in labeling_tasks:
+                    task.cancel()
+
+        return generated_json_strings, assessments
 
     def run(self, data: List[Dict[str, str]]) -> Tuple[List[str], List[str]]:
         weather_descriptions = list()
@@ -72,35 +185,64 @@ class Labeler:
             weather_descriptions.append(sample.get(enums.Field.description) + "\n")
             true_json_strings.append(json.dumps(sample.get(enums.Field.data)))
 
-        generated_json_strings = self.wrapper.generate(texts=weather_descriptions)
+        if self.pipeline:
+            generated_json_strings, assessments = asyncio.run(
+                self.arun_pipeline(weather_descriptions=weather_descriptions, true_json_strings=true_json_strings)
+            )
+        else:
+            generated_json_strings, assessments = self.run_sequential(
+                weather_descriptions=weather_descriptions, true_json_strings=true_json_strings
+            )
 
-        samples_to_show = random.sample(generated_json_strings, 3)
+        samples_to_show = random.sample(generated_json_strings, min(3, len(generated_json_strings)))
 
         for sample_to_show in samples_to_show:
             logger.info(f"Generated: {sample_to_show}")
 
+        self.gpt_client.rate_limiter.log_stats()
+        if self.gpt_client.cache is not None:
+            self.gpt_client.cache.log_stats()
+
+        if self.comparator is not None:
+            self.comparator.log_stats()
+
+        self.log_assessments(assessments=assessments)
+
+        return generated_json_strings, assessments
+
+    def run_sequential(
+            self,
+            weather_descriptions: List[str],
+            true_json_strings: List[str],
+    ) -> Tuple[List[str], List[str]]:
+        generated_json_strings = self.wrapper.generate(texts=weather_descriptions)
+
         assert len(generated_json_strings) == len(weather_descriptions) == len(true_json_strings)
 
+        assessments = [""] * len(weather_descriptions)
         prompts = list()
+        sample_indices = list()
 
         for sample_index in range(len(weather_descriptions)):
+            assessment = self.prejudge(
+                generated_json_string=generated_json_strings[sample_index],
+                true_json_string=true_json_strings[sample_index],
+            )
+            if assessment is not None:
+                assessments[sample_index] = assessment
+                continue
+
             sample_prompt = self.format_prompt(
                 weather_description=weather_descriptions[sample_index],
                 generated_json_string=generated_json_strings[sample_index],
                 true_json_string=true_json_strings[sample_index],
             )
             prompts.append(sample_prompt)
+            sample_indices.append(sample_index)
 
-        raw_assessments = self.label_batch(prompts=prompts)
-
-        assessments = [self.parse_assessment(assessment) for assessment in raw_assessments]
-
-        counter = Counter(assessments)
-
-        num_elements = len(assessments)
-
-        for key, value in counter.items():
-            fraction = value / num_elements
-            logger.info(f"{key}: {fraction:.2f}")
+        if prompts:
+            raw_assessments = self.label_batch(prompts=prompts, sample_indices=sample_indices)
+            for sample_index, raw_assessment in zip(sample_indices, raw_assessments):
+                assessments[sample_index] = self.parse_assessment(raw_assessment)
 
         return generated_json_strings, assessments
@@ -0,0 +1,312 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from wgpt.core.constants import CATEGORICAL_SYNONYMS, WEATHER_JSON_SCHEMA
+from wgpt.eval.compare import normalize_string
+
+# Rows above this use the normal approximation for bootstrap of non binary values, resampling them is O(rows)
+# per bootstrap round
+MAX_RESAMPLING_ROWS = 50_000
+
+# Rows are joined by chunks and decoded at their known offsets in the chunk, it is faster than json.loads per row
+PARSE_CHUNK_SIZE = 4096
+
+
+def normalize_number(value: Any) -> float:
+    if value is None or isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_json_object(json_string: str) -> Optional[Dict[str, Any]]:
+    try:
+        data = json.loads(json_string)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def parse_json_objects(json_strings: List[str]) -> List[Optional[Dict[str, Any]]]:
+    # Every row must decode to one object that ends exactly at the end of the row, so a broken row never takes
+    # its neighbours with it
+    raw_decode = json.JSONDecoder().raw_decode
+    parsed: List[Optional[Dict[str, Any]]] = list()
+
+    for chunk_start in range(0, len(json_strings), PARSE_CHUNK_SIZE):
+        chunk = [
+            json_string.strip() if isinstance(json_string, str) else ""
+            for json_string in json_strings[chunk_start: chunk_start + PARSE_CHUNK_SIZE]
+        ]
+        text = "\n".join(chunk)
+        start = 0
+        for json_string in chunk:
+            end = start + len(json_string)
+            data = None
+            if json_string:
+                try:
+                    data, decoded_end = raw_decode(text, start)
+                except json.JSONDecodeError:
+                    pass
+                else:
+                    if decoded_end != end or not isinstance(data, dict):
+                        data = None
+            parsed.append(data)
+            start = end + 1
+
+    return parsed
+
+
+def encode_strings(values: List[Any]) -> Tuple[np.ndarray, List[Any]]:
+    # Codes of raw values and the raw vocabulary. Raw vocabulary is small, so normalization runs on it instead
+    # of on every row
+    vocabulary: Dict[Any, int] = dict()
+    codes = np.fromiter(
+        (vocabulary.setdefault(value if isinstance(value, str) or value is None else str(value), len(vocabulary))
+         for value in values),
+        dtype=np.int64,
+        count=len(values),
+    )
+    return codes, list(vocabulary)
+
+
+def to_numbers(values: List[Any]) -> np.ndarray:
+    column = np.array(values, dtype=object)
+    is_null = np.equal(column, None)
+    try:
+        numbers = np.where(is_null, np.nan, column).astype(np.float64)
+    except (TypeError, ValueError):
+        return np.array([normalize_number(value) for value in values], dtype=np.float64)
+    # Booleans are not numbers in json schema
+    is_bool = np.array([isinstance(value, bool) for value in column[~is_null]], dtype=bool)
+    if is_bool.any():
+        numbers[np.flatnonzero(~is_null)[is_bool]] = np.nan
+    return numbers
+
+
+class FieldColumns:
+    # Json strings parsed once into one numpy array per field. Numbers are float with nan for null, strings are
+    # codes of a raw vocabulary with the vocabulary itself
+    def __init__(self, json_strings: List[str], schema: Optional[Dict[str, type]] = None):
+        self.schema = schema or WEATHER_JSON_SCHEMA
+        self.num_rows = len(json_strings)
+
+        parsed = parse_json_objects(json_strings=json_strings)
+        self.is_valid = np.fromiter((data is not None for data in parsed), dtype=bool, count=self.num_rows)
+        rows = [data if data is not None else dict() for data in parsed]
+
+        self.numbers: Dict[str, np.ndarray] = dict()
+        self.string_codes: Dict[str, np.ndarray] = dict()
+        self.string_vocabularies: Dict[str, List[Any]] = dict()
+
+        for field_name, field_type in self.schema.items():
+            values = [row.get(field_name) for row in rows]
+            if field_type is str:
+                self.string_codes[field_name], self.string_vocabularies[field_name] = encode_strings(values=values)
+            else:
+                self.numbers[field_name] = to_numbers(values=values)
+
+
+def encode_categories(
+        generated_codes: np.ndarray,
+        generated_vocabulary: List[Any],
+        true_codes: np.ndarray,
+        true_vocabulary: List[Any],
+        synonyms: Optional[Dict[str, str]] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Raw codes of both columns are mapped to codes of one shared normalized vocabulary, -1 for null. Strings are
+    # normalized the same way as in FieldComparator, so metrics and pre-judging agree on every pair
+    normalized_generated = [normalize_string(value=value, synonyms=synonyms) for value in generated_vocabulary]
+    normalized_true = [normalize_string(value=value, synonyms=synonyms) for value in true_vocabulary]
+    vocabulary = np.array(sorted({value for value in normalized_generated + normalized_true if value is not None}))
+    index = {value: code for code, value in enumerate(vocabulary.tolist())}
+
+    def remap(normalized_values: List[Optional[str]]) -> np.ndarray:
+        return np.array([-1 if value is None else index[value] for value in normalized_values], dtype=np.int64)
+
+    return remap(normalized_generated)[generated_codes], remap(normalized_true)[true_codes], vocabulary
+
+
+def bootstrap_mean_ci(
+        values: np.ndarray,
+        num_bootstrap: int = 1000,
+        confidence: float = 0.95,
+        rng: Optional[np.random.Generator] = None,
+) -> Tuple[float, float, float]:
+    values = values[~np.isnan(values)] if values.dtype.kind == "f" else values
+    if values.size == 0:
+        return np.nan, np.nan, np.nan
+
+    rng = rng or np.random.default_rng(seed=42)
+    mean = float(values.mean())
+    num_rows = values.size
+    alpha = (1 - confidence) / 2
+
+    if values.dtype == bool or np.isin(values, (0, 1)).all():
+        # Num of ones in a resample of a binary column is binomial, so the bootstrap is exact and O(rounds)
+        means = rng.binomial(num_rows, mean, size=num_bootstrap) / num_rows
+    elif num_rows <= MAX_RESAMPLING_ROWS:
+        means = np.empty(num_bootstrap)
+        chunk_size = max(1, 10_000_000 // num_rows)
+        for start in range(0, num_bootstrap, chunk_size):
+            end = min(start + chunk_size, num_bootstrap)
+            means[start:end] = values[rng.integers(0, num_rows, size=(end - start, num_rows))].mean(axis=1)
+    else:
+        means = rng.normal(mean, values.std() / np.sqrt(num_rows), size=num_bootstrap)
+
+    low, high = np.quantile(means, [alpha, 1 - alpha])
+
+    return mean, float(low), float(high)
+
+
+def null_precision_recall(generated_is_null: np.ndarray, true_is_null: np.ndarray) -> Tuple[float, float]:
+    num_true_positive = int((generated_is_null & true_is_null).sum())
+    num_predicted = int(generated_is_null.sum())
+    num_actual = int(true_is_null.sum())
+    precision = num_true_positive / num_predicted if num_predicted else np.nan
+    recall = num_true_positive / num_actual if num_actual else np.nan
+    return precision, recall
+
+
+def confusion_table(
+        generated_codes: np.ndarray,
+        true_codes: np.ndarray,
+        vocabulary: np.ndarray,
+        top_k: int = 20,
+) -> List[Tuple[Optional[str], Optional[str], int]]:
+    # Most frequent (true, generated) pairs. Codes are shifted by one so that null gets code 0
+    num_codes = len(vocabulary) + 1
+    pair_codes = (true_codes + 1).astype(np.int64) * num_codes + (generated_codes + 1)
+    unique_pairs, counts = np.unique(pair_codes, return_counts=True)
+    order = np.argsort(-counts, kind="stable")[:top_k]
+
+    def decode(code: int) -> Optional[str]:
+        return None if code == 0 else str(vocabulary[code - 1])
+
+    true_pair_codes, generated_pair_codes = np.divmod(unique_pairs[order], num_codes)
+
+    return [
+        (decode(int(true_code)), decode(int(generated_code)), int(count))
+        for true_code, generated_code, count in zip(true_pair_codes, generated_pair_codes, counts[order])
+    ]
+
+
+def compute_metrics(
+        generated_json_strings: List[str],
+        true_json_strings: List[str],
+        schema: Optional[Dict[str, type]] = None,
+        numeric_tolerance: float = 1.0,
+        num_bootstrap: int = 1000,
+        confidence: float = 0.95,
+        seed: int = 42,
+        synonyms: Optional[Dict[str, Dict[str, str]]] = None,
+) -> Dict[str, Any]:
+    if len(generated_json_strings) != len(true_json_strings):
+        raise ValueError("Generated and true json strings must have the same length")
+
+    schema = schema or WEATHER_JSON_SCHEMA
+    synonyms = CATEGORICAL_SYNONYMS if synonyms is None else synonyms
+    rng = np.random.default_rng(seed=seed)
+
+    generated = FieldColumns(json_strings=generated_json_strings, schema=schema)
+    true = FieldColumns(json_strings=true_json_strings, schema=schema)
+
+    def with_ci(values: np.ndarray) -> Dict[str, float]:
+        mean, low, high = bootstrap_mean_ci(values=values, num_bootstrap=num_bootstrap, confidence=confidence, rng=rng)
+        return {"value": mean, "ci_low": low, "ci_high": high}
+
+    metrics: Dict[str, Any] = {
+        "num_samples": generated.num_rows,
+        "parse_accuracy": with_ci(generated.is_valid),
+        "fields": dict(),
+    }
+
+    all_fields_match = generated.is_valid.copy()
+
+    for field_name, field_type in schema.items():
+        field_metrics: Dict[str, Any] = dict()
+
+        if field_type is str:
+            generated_codes, true_codes, vocabulary = encode_categories(
+                generated_codes=generated.string_codes[field_name],
+                generated_vocabulary=generated.string_vocabularies[field_name],
+                true_codes=true.string_codes[field_name],
+                true_vocabulary=true.string_vocabularies[field_name],
+                synonyms=synonyms.get(field_name),
+            )
+            generated_is_null = generated_codes == -1
+            true_is_null = true_codes == -1
+            exact_match = (generated_codes == true_codes) & generated.is_valid
+            field_metrics["confusion"] = confusion_table(
+                generated_codes=generated_codes, true_codes=true_codes, vocabulary=vocabulary
+            )
+        else:
+            generated_numbers = generated.numbers[field_name]
+            true_numbers = true.numbers[field_name]
+            generated_is_null = np.isnan(generated_numbers)
+            true_is_null = np.isnan(true_numbers)
+            both_null = generated_is_null & true_is_null
+            absolute_error = np.abs(generated_numbers - true_numbers)
+            exact_match = ((absolute_error == 0) | both_null) & generated.is_valid
+            # Nan error where one side is null, such rows count for null metrics, not for mae
+            field_metrics["mae"] = with_ci(absolute_error)
+            field_metrics["tolerance_accuracy"] = with_ci(
+                ((absolute_error <= numeric_tolerance) | both_null) & generated.is_valid
+            )
+
+        # Invalid json has every field null, it must not count as a correct null prediction
+        generated_is_null = generated_is_null & generated.is_valid
+        null_precision, null_recall = null_precision_recall(
+            generated_is_null=generated_is_null, true_is_null=true_is_null
+        )
+
+        field_metrics["exact_match"] = with_ci(exact_match)
+        field_metrics["null_precision"] = null_precision
+        field_metrics["null_recall"] = null_recall
+
+        all_fields_match &= exact_match
+        metrics["fields"][field_name] = field_metrics
+
+    metrics["all_fields_exact_match"] = with_ci(all_fields_match)
+
+    return metrics
+
+
+def log_metrics(metrics: Dict[str, Any]) -> None:
+    def format_ci(value: Dict[str, float]) -> str:
+        return f"{value['value']:.4f} [{value['ci_low']:.4f}, {value['ci_high']:.4f}]"
+
+    logger.info(f"Num samples: {metrics['num_samples']}")
+    logger.info(f"Parse accuracy: {format_ci(metrics['parse_accuracy'])}")
+    logger.info(f"All fields exact match: {format_ci(metrics['all_fields_exact_match'])}")
+
+    for field_name, field_metrics in metrics["fields"].items():
+        text = (
+            f"{field_name}. Exact match: {format_ci(field_metrics['exact_match'])}. "
+            f"Null precision: {field_metrics['null_precision']:.4f}. Null recall: {field_metrics['null_recall']:.4f}"
+        )
+        if "mae" in field_metrics:
+            text += (
+                f". MAE: {format_ci(field_metrics['mae'])}. "
+                f"Tolerance accuracy: {format_ci(field_metrics['tolerance_accuracy'])}"
+            )
+        logger.info(text)
@@ -0,0 +1,200 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+from loguru import logger
+
+from wgpt import enums
+from wgpt.eval.wrapper import WGPTWrapper
+
+
+@dataclass
+class InferenceRequest:
+    text: str
+    num_tokens: int
+    future: "asyncio.Future[str]"
+    arrival_time: float
+
+
+class InferenceServer:
+    # Single requests are collected into micro batches: a batch is sent to the model when it reaches
+    # max_batch_size, when the next request would overflow the token budget, or when the first request of the
+    # batch waited max_wait_ms. One batching loop per model replica, all of them read the same queue
+    def __init__(
+            self,
+            wrapper: WGPTWrapper,
+            max_batch_size: Optional[int] = None,
+            max_wait_ms: float = 10.0,
+            max_batch_tokens: Optional[int] = None,
+            max_queue_size: int = 4096,
+    ):
+        self.wrapper = wrapper
+        self.max_batch_size = max_batch_size or wrapper.batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.max_batch_tokens = max_batch_tokens or wrapper.max_batch_tokens
+        self.max_queue_size = max_queue_size
+
+        self._queue: Optional["asyncio.Queue[InferenceRequest]"] = None
+        self._executor = ThreadPoolExecutor(max_workers=len(wrapper.models))
+        self._tasks: List["asyncio.Task[None]"] = list()
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_batched_requests = 0
+
+    def batch_cost(self, batch_size: int, max_num_tokens: int) -> int:
+        # Prompt is padded to the longest one, and every row can run up to max_new_tokens
+        return batch_size * (max_num_tokens + self.wrapper.max_new_tokens)
+
+    async def _collect_batch(
+            self,
+            first_request: InferenceRequest,
+    ) -> Tuple[List[InferenceRequest], Optional[InferenceRequest]]:
+        # Returns the batch and the request that did not fit into the token budget, it opens the next batch
+        assert self._queue is not None
+        batch = [first_request]
+        max_num_tokens = first_request.num_tokens
+        deadline = first_request.arrival_time + self.max_wait_seconds
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    request = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                else:
+                    # Deadline passed while the model was busy, take what is already waiting
+                    request = self._queue.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+
+            candidate_max_num_tokens = max(max_num_tokens, request.num_tokens)
+            candidate_cost = self.batch_cost(batch_size=len(batch) + 1, max_num_tokens=candidate_max_num_tokens)
+            if candidate_cost > self.max_batch_tokens:
+                return batch, request
+
+            batch.append(request)
+            max_num_tokens = candidate_max_num_tokens
+
+        return batch, None
+
+    async def _batching_loop(self, replica_index: int) -> None:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        next_request: Optional[InferenceRequest] = None
+
+        while True:
+            first_request = next_request or await self._queue.get()
+            batch, next_request = await self._collect_batch(first_request=first_request)
+            batch = [request for request in batch if not request.future.cancelled()]
+            if not batch:
+                continue
+
+            try:
+                generated_texts = await loop.run_in_executor(
+                    self._executor,
+                    self.wrapper.generate_texts,
+                    [request.text for request in batch],
+                    replica_index,
+                )
+            except Exception as exception:
+                logger.error(f"Batch generation failed: {exception}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(exception)
+                continue
+
+            self.num_batches += 1
+            self.num_batched_requests += len(batch)
+            for request, generated_text in zip(batch, generated_texts):
+                if not request.future.done():
+                    request.future.set_result(generated_text)
+
+    async def generate(self, text: str) -> str:
+        if self._queue is None:
+            raise ValueError("Server is not started")
+
+        (num_tokens,) = self.wrapper.get_lengths(texts=[text])
+        future: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(
+            InferenceRequest(text=text, num_tokens=num_tokens, future=future, arrival_time=time.perf_counter())
+        )
+        self.num_requests += 1
+
+        return await future
+
+    async def handle_generate(self, request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+            description = payload[enums.Field.description]
+        except Exception:
+            return web.json_response({"error": f"Expected json with '{enums.Field.description}'"}, status=400)
+
+        if not isinstance(description, str):
+            return web.json_response({"error": f"'{enums.Field.description}' must be a string"}, status=400)
+
+        if self._queue is not None and self._queue.qsize() >= self.max_queue_size:
+            return web.json_response({"error": "Server is overloaded"}, status=503)
+
+        try:
+            generated_text = await self.generate(text=description + "\n")
+        except Exception as exception:
+            return web.json_response({"error": str(exception)}, status=500)
+
+        return web.json_response({enums.Field.generated: generated_text})
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "queue_size": self._queue.qsize() if self._queue is not None else 0,
+                "num_requests": self.num_requests,
+                "num_batches": self.num_batches,
+            }
+        )
+
+    async def start(self, app: web.Application) -> None:
+        self._queue = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._batching_loop(replica_index=replica_index))
+            for replica_index in range(len(self.wrapper.models))
+        ]
+        logger.info(
+            f"Inference server started. Replicas: {len(self._tasks)}. Max batch size: {self.max_batch_size}. "
+            f"Max wait: {self.max_wait_seconds * 1000:.1f} ms. Max batch tokens: {self.max_batch_tokens}"
+        )
+
+    async def stop(self, app: web.Application) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+
+        if self.num_batches:
+            logger.info(
+                f"Inference server stopped. Requests: {self.num_requests}. Batches: {self.num_batches}. "
+                f"Mean batch size: {self.num_batched_requests / self.num_batches:.2f}"
+            )
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/generate", self.handle_generate)
+        app.router.add_get("/health", self.handle_health)
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.stop)
+        return app
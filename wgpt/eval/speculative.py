@@ -0,0 +1,226 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any, List, Optional, Tuple
+
+import torch
+from loguru import logger
+from torch import Tensor
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+
+from wgpt.eval.stopping import JsonStoppingCriteria
+
+
+def crop_past_key_values(past_key_values: Any, length: int) -> Any:
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+
+    # Legacy cache, tuple of (key, value) per layer with sequence on the dim before the last
+    return tuple(tuple(tensor[..., :length, :] for tensor in layer) for layer in past_key_values)
+
+
+def find_prompt_lookup_draft(token_ids: List[int], ngram_size: int = 3, num_draft_tokens: int = 10) -> List[int]:
+    # Continuation of the latest earlier occurrence of the trailing n-gram. Numbers and words of the json
+    # are mostly copied from the description, so the continuation is often right
+    for current_ngram_size in range(min(ngram_size, len(token_ids) - 1), 0, -1):
+        ngram = token_ids[-current_ngram_size:]
+        for start in range(len(token_ids) - current_ngram_size - 1, -1, -1):
+            if token_ids[start: start + current_ngram_size] == ngram:
+                continuation = token_ids[start + current_ngram_size: start + current_ngram_size + num_draft_tokens]
+                if continuation:
+                    return continuation
+
+    return list()
+
+
+class SpeculativeDecoder:
+    # Greedy decoding where draft tokens from prompt lookup or a small draft model are checked by the target
+    # model in one forward pass. Accepted tokens are exactly those greedy decoding would produce, so outputs
+    # do not change, only the num of target forward passes does
+    def __init__(
+            self,
+            tokenizer: PreTrainedTokenizerBase,
+            num_draft_tokens: int = 10,
+            ngram_size: int = 3,
+            draft_model: Optional[PreTrainedModel] = None,
+            early_stopping: bool = True,
+            eos_token: str = "\n",
+    ):
+        self.tokenizer = tokenizer
+        self.num_draft_tokens = num_draft_tokens
+        self.ngram_size = ngram_size
+        self.draft_model = draft_model
+        self.early_stopping = early_stopping
+        self.eos_token = eos_token
+
+        self.num_target_forward_passes = 0
+        self.num_generated_tokens = 0
+        self.num_draft_tokens_proposed = 0
+        self.num_draft_tokens_accepted = 0
+
+    def _draft_with_model(
+            self,
+            token_ids: List[int],
+            past_key_values: Any,
+            past_length: int,
+            num_tokens: int,
+    ) -> Tuple[List[int], Any, int]:
+        # Draft model cache covers token_ids[:past_length], tokens after it are fed before drafting
+        assert self.draft_model is not None
+        device = self.draft_model.device
+        draft: List[int] = list()
+        input_ids = token_ids[past_length:]
+
+        for _ in range(num_tokens):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([input_ids], device=device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            past_key_values = outputs.past_key_values
+            past_length += len(input_ids)
+            next_token_id = int(outputs.logits[0, -1].argmax())
+            draft.append(next_token_id)
+            input_ids = [next_token_id]
+
+        return draft, past_key_values, past_length
+
+    @torch.no_grad()
+    def generate(self, model: PreTrainedModel, input_ids: List[int], max_new_tokens: int) -> List[int]:
+        device = model.device
+        stopping_criteria = None
+        if self.early_stopping:
+            stopping_criteria = JsonStoppingCriteria(
+                tokenizer=self.tokenizer, prompt_length=len(input_ids), batch_size=1, eos_token=self.eos_token
+            )
+        eos_token_id = self.tokenizer.eos_token_id
+
+        outputs = model(input_ids=torch.tensor([input_ids], device=device), use_cache=True)
+        self.num_target_forward_passes += 1
+        # Target cache covers every token except the last one, which is fed with the next draft
+        past_key_values = outputs.past_key_values
+        token_ids = input_ids + [int(outputs.logits[0, -1].argmax())]
+        new_tokens = [token_ids[-1]]
+
+        draft_past_key_values = None
+        draft_past_length = 0
+
+        while len(new_tokens) < max_new_tokens:
+            if self._is_stopped(stopping_criteria=stopping_criteria, token_ids=token_ids, eos_token_id=eos_token_id):
+                break
+
+            num_tokens = min(self.num_draft_tokens, max_new_tokens - len(new_tokens))
+            if self.draft_model is not None:
+                draft, draft_past_key_values, draft_past_length = self._draft_with_model(
+                    token_ids=token_ids,
+                    past_key_values=draft_past_key_values,
+                    past_length=draft_past_length,
+                    num_tokens=num_tokens,
+                )
+            else:
+                draft = find_prompt_lookup_draft(
+                    token_ids=token_ids, ngram_size=self.ngram_size, num_draft_tokens=num_tokens
+                )
+
+            outputs = model(
+                input_ids=torch.tensor([token_ids[-1:] + draft], device=device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            self.num_target_forward_passes += 1
+            predicted_ids = outputs.logits[0].argmax(dim=-1).tolist()
+
+            num_accepted = 0
+            while num_accepted < len(draft) and draft[num_accepted] == predicted_ids[num_accepted]:
+                num_accepted += 1
+
+            self.num_draft_tokens_proposed += len(draft)
+            self.num_draft_tokens_accepted += num_accepted
+
+            past_key_values = crop_past_key_values(
+                past_key_values=outputs.past_key_values, length=len(token_ids) + num_accepted
+            )
+            if self.draft_model is not None:
+                # Draft cache is valid up to the first rejected draft token
+                draft_past_length = min(draft_past_length, len(token_ids) + num_accepted)
+                draft_past_key_values = crop_past_key_values(
+                    past_key_values=draft_past_key_values, length=draft_past_length
+                )
+
+            # Target prediction after the last accepted token comes for free
+            accepted = draft[:num_accepted] + [predicted_ids[num_accepted]]
+            for token_id in accepted[: max_new_tokens - len(new_tokens)]:
+                token_ids.append(token_id)
+                new_tokens.append(token_id)
+                if self._is_stopped(
+                        stopping_criteria=stopping_criteria, token_ids=token_ids, eos_token_id=eos_token_id
+                ):
+                    self.num_generated_tokens += len(new_tokens)
+                    return new_tokens
+
+        self.num_generated_tokens += len(new_tokens)
+
+        return new_tokens
+
+    @staticmethod
+    def _is_stopped(
+            stopping_criteria: Optional[JsonStoppingCriteria],
+            token_ids: List[int],
+            eos_token_id: Optional[int],
+    ) -> bool:
+        # Checked token by token, so generation ends where greedy decoding with the same criteria ends
+        if eos_token_id is not None and token_ids[-1] == eos_token_id:
+            return True
+        if stopping_criteria is None:
+            return False
+        return bool(stopping_criteria(torch.tensor([token_ids]), None)[0])
+
+    def generate_batch(
+            self,
+            model: PreTrainedModel,
+            input_ids: Tensor,
+            attention_mask: Tensor,
+            max_new_tokens: int,
+    ) -> Tensor:
+        # Rows are decoded one by one, speculation pays off in latency of a row, not in batch throughput
+        pad_token_id = self.tokenizer.pad_token_id
+        rows_new_tokens = list()
+
+        for row_input_ids, row_attention_mask in zip(input_ids.tolist(), attention_mask.tolist()):
+            row_input_ids = [token_id for token_id, mask in zip(row_input_ids, row_attention_mask) if mask]
+            row_new_tokens = self.generate(model=model, input_ids=row_input_ids, max_new_tokens=max_new_tokens)
+            rows_new_tokens.append(row_new_tokens)
+
+        max_new_length = max(len(row_new_tokens) for row_new_tokens in rows_new_tokens)
+        new_ids = torch.tensor(
+            [
+                row_new_tokens + [pad_token_id] * (max_new_length - len(row_new_tokens))
+                for row_new_tokens in rows_new_tokens
+            ]
+        )
+
+        return torch.cat([input_ids.cpu(), new_ids], dim=1)
+
+    def log_stats(self) -> None:
+        if not self.num_target_forward_passes:
+            return
+
+        acceptance_rate = self.num_draft_tokens_accepted / max(self.num_draft_tokens_proposed, 1)
+        logger.info(
+            f"Speculative decoding ({'draft model' if self.draft_model is not None else 'prompt lookup'}). "
+            f"Acceptance rate: {acceptance_rate * 100:.1f} %. "
+            f"Target forward passes: {self.num_target_forward_passes}. "
+            f"Tokens per forward pass: {self.num_generated_tokens / self.num_target_forward_passes:.2f}"
+        )
@@ -0,0 +1,70 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any, List
+
+import torch
+from transformers import PreTrainedTokenizerBase, StoppingCriteria
+
+
+class JsonStoppingCriteria(StoppingCriteria):
+    # Marks a sequence done as soon as its top level json object closes or eos text appears. Only new tokens
+    # of every step are decoded, so the cost per step does not grow with the generated length
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, prompt_length: int, batch_size: int, eos_token: str = "\n"):
+        self.tokenizer = tokenizer
+        self.eos_token = eos_token
+
+        self._num_processed = prompt_length
+        self._depth: List[int] = [0] * batch_size
+        self._in_string: List[bool] = [False] * batch_size
+        self._escape: List[bool] = [False] * batch_size
+        self._done: List[bool] = [False] * batch_size
+
+    @property
+    def num_done(self) -> int:
+        return sum(self._done)
+
+    def _update(self, row: int, text: str) -> None:
+        if self.eos_token and self.eos_token in text:
+            # Text before eos in the same token may still close the object, either way the row is done
+            self._done[row] = True
+            return
+
+        for char in text:
+            if self._in_string[row]:
+                if self._escape[row]:
+                    self._escape[row] = False
+                elif char == "\\":
+                    self._escape[row] = True
+                elif char == '"':
+                    self._in_string[row] = False
+            elif char == '"' and self._depth[row] > 0:
+                self._in_string[row] = True
+            elif char == "{":
+                self._depth[row] += 1
+            elif char == "}" and self._depth[row] > 0:
+                self._depth[row] -= 1
+                if self._depth[row] == 0:
+                    self._done[row] = True
+                    return
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+        new_token_ids = input_ids[:, self._num_processed:].tolist()
+        self._num_processed = input_ids.shape[1]
+
+        for row, row_token_ids in enumerate(new_token_ids):
+            if not self._done[row]:
+                self._update(row=row, text=self.tokenizer.decode(row_token_ids))
+
+        return torch.tensor(self._done, dtype=torch.bool, device=input_ids.device)
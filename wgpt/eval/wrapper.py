@@ -12,12 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
+from typing import Iterator, List, Optional, Tuple
 
+import torch
+from loguru import logger
+from torch import Tensor
 from tqdm import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding
+from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding, PreTrainedModel, StoppingCriteriaList
 from xllm import Config
 
+from wgpt import enums
+from wgpt.eval.constrained import SchemaConstrainedDecoder
+from wgpt.eval.speculative import SpeculativeDecoder
+from wgpt.eval.stopping import JsonStoppingCriteria
+from wgpt.utils.device import get_accelerators, resolve_device, setup_cpu_threads
+
 
 class WGPTWrapper:
     def __init__(
@@ -28,34 +42,108 @@ class WGPTWrapper:
             max_new_tokens: int = 128,
             cuda_index: int = 0,
             eos_token: str = "\n",
+            batching: str = enums.Batching.fixed,
+            max_batch_tokens: Optional[int] = None,
+            early_stopping: bool = True,
+            device: Optional[str] = None,
+            num_threads: Optional[int] = None,
+            device_map: Optional[str] = None,
+            replicate: bool = False,
+            constrained: bool = False,
+            speculation: Optional[str] = None,
+            draft_model_name_or_path: Optional[str] = None,
+            num_draft_tokens: int = 10,
+            ngram_size: int = 3,
     ):
+        if speculation not in (None, enums.Speculation.prompt_lookup, enums.Speculation.draft_model):
+            raise ValueError(f"Unknown speculation: {speculation}")
+
+        if speculation == enums.Speculation.draft_model and draft_model_name_or_path is None:
+            raise ValueError("Draft model speculation requires draft_model_name_or_path")
+
+        if batching not in (enums.Batching.fixed, enums.Batching.sorted, enums.Batching.token_budget):
+            raise ValueError(f"Unknown batching: {batching}")
+
         self.batch_size = batch_size
         self.max_length = max_length
         self.max_new_tokens = max_new_tokens
         self.cuda_index = cuda_index
         self.eos_token = eos_token
+        self.batching = batching
+        self.early_stopping = early_stopping
+        # Prompt and new tokens of the whole batch, padding included
+        self.max_batch_tokens = max_batch_tokens or batch_size * (max_length + max_new_tokens)
+
+        self.device_map = device_map
+
+        self.devices = [resolve_device(device=device, cuda_index=cuda_index)]
+        if replicate and device_map is None:
+            self.devices = get_accelerators() or self.devices
 
         model_config = Config()
+        dtype = model_config.dtype
+        if self.devices[0] == "cpu":
+            setup_cpu_threads(num_threads=num_threads)
+            if dtype == torch.float16:
+                # Most cpu kernels have no half precision implementation
+                dtype = torch.float32
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name_or_path,
-            torch_dtype=model_config.dtype,
-        )
-
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.model.to(self.device)
+        # Decoder only models continue from the last prompt token, so padding must go on the left
+        self.tokenizer.padding_side = "left"
+        # Fast tokenizer is not thread safe: a call that changes its padding or truncation state fails with
+        # "Already borrowed" while another thread uses it. Replica threads and the server call it concurrently
+        self._tokenizer_lock = threading.Lock()
+
+        if device_map is not None:
+            # Layers are sharded across available devices, inputs go to the device of the embeddings
+            self.models = [
+                AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=dtype, device_map=device_map)
+            ]
+        else:
+            self.models = list()
+            for replica_device in self.devices:
+                model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=dtype)
+                model.to(replica_device)
+                self.models.append(model)
+
+        self.model = self.models[0]
+
+        self.constrained_decoder: Optional[SchemaConstrainedDecoder] = None
+        if constrained:
+            self.constrained_decoder = SchemaConstrainedDecoder(tokenizer=self.tokenizer)
+
+        self.speculative_decoder: Optional[SpeculativeDecoder] = None
+        if speculation is not None:
+            draft_model = None
+            if speculation == enums.Speculation.draft_model:
+                # Draft model must share the tokenizer of the target model
+                draft_model = AutoModelForCausalLM.from_pretrained(draft_model_name_or_path, torch_dtype=dtype)
+                draft_model.to(self.model.device)
+            self.speculative_decoder = SpeculativeDecoder(
+                tokenizer=self.tokenizer,
+                num_draft_tokens=num_draft_tokens,
+                ngram_size=ngram_size,
+                draft_model=draft_model,
+                early_stopping=early_stopping,
+                eos_token=self.eos_token,
+            )
+        logger.info(f"Model replicas: {len(self.models)}. Device map: {device_map}. Devices: {self.devices}")
 
     @property
     def device(self) -> str:
-        return f"cuda:{self.cuda_index}"
+        if self.device_map is not None:
+            return str(self.model.device)
+        return self.devices[0]
 
-    def tokenize(self, texts: List[str]) -> BatchEncoding:
-        tokenized = self.tokenizer(
-            texts, return_tensors="pt", padding=True, truncation=True, max_length=self.max_length
-        )
-        tokenized = tokenized.to(f"cuda:{self.cuda_index}")
+    def tokenize(self, texts: List[str], device: Optional[str] = None) -> BatchEncoding:
+        with self._tokenizer_lock:
+            tokenized = self.tokenizer(
+                texts, return_tensors="pt", padding=True, truncation=True, max_length=self.max_length
+            )
+        tokenized = tokenized.to(device or self.device)
         return tokenized
 
     def post_processing(self, text: str) -> str:
@@ -67,17 +155,215 @@ class WGPTWrapper:
 
         return text
 
-    def generate(self, texts: List[str]) -> List[str]:
-        generated_indices = list()
+    def get_lengths(self, texts: List[str]) -> List[int]:
+        # Same padding and truncation as tokenize, so the tokenizer state is not switched back and forth and
+        # decoding in stopping criteria of other threads never meets a state change
+        with self._tokenizer_lock:
+            tokenized = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length)
+        return [sum(attention_mask) for attention_mask in tokenized.attention_mask]
+
+    def build_batches(self, texts: List[str]) -> List[List[int]]:
+        # Batches of positions in texts. Sorted modes put texts of similar length together, so little compute
+        # goes to padding. Longest batches go first, so out of memory shows up at the start
+        if self.batching == enums.Batching.fixed:
+            return [
+                list(range(batch_start, min(batch_start + self.batch_size, len(texts))))
+                for batch_start in range(0, len(texts), self.batch_size)
+            ]
+
+        lengths = self.get_lengths(texts=texts)
+        order = sorted(range(len(texts)), key=lambda index: lengths[index], reverse=True)
+
+        if self.batching == enums.Batching.sorted:
+            return [
+                order[batch_start: batch_start + self.batch_size]
+                for batch_start in range(0, len(order), self.batch_size)
+            ]
+
+        batches: List[List[int]] = list()
+        batch: List[int] = list()
+        batch_max_length = 0
+
+        for index in order:
+            # Texts go in descending length, so the first one sets the padded length of the batch
+            batch_max_length = batch_max_length or lengths[index]
+            if batch and (len(batch) + 1) * (batch_max_length + self.max_new_tokens) > self.max_batch_tokens:
+                batches.append(batch)
+                batch = list()
+                batch_max_length = lengths[index]
+            batch.append(index)
 
-        for batch_start in tqdm(range(0, len(texts), self.batch_size), desc="Generating"):
-            batch = texts[batch_start: batch_start + self.batch_size]
-            batch_tokenized = self.tokenize(texts=batch)
-            batch_generated_indices = self.model.generate(**batch_tokenized, max_new_tokens=self.max_new_tokens).cpu()
-            generated_indices.extend(batch_generated_indices)
+        if batch:
+            batches.append(batch)
 
-        generated_texts: List[str] = self.tokenizer.batch_decode(generated_indices)
+        return batches
+
+    def generate_batch(self, batch_tokenized: BatchEncoding, model: Optional[PreTrainedModel] = None) -> Tensor:
+        model = model or self.model
+
+        if self.constrained_decoder is not None:
+            return self.constrained_decoder.generate(model=model, batch_tokenized=batch_tokenized)
+
+        if self.speculative_decoder is not None:
+            return self.speculative_decoder.generate_batch(
+                model=model,
+                input_ids=batch_tokenized.input_ids,
+                attention_mask=batch_tokenized.attention_mask,
+                max_new_tokens=self.max_new_tokens,
+            )
+
+        stopping_criteria = None
+        if self.early_stopping:
+            # Batch ends once every row has its json closed, instead of always running max_new_tokens steps
+            batch_size, prompt_length = batch_tokenized.input_ids.shape
+            stopping_criteria = StoppingCriteriaList(
+                [
+                    JsonStoppingCriteria(
+                        tokenizer=self.tokenizer,
+                        prompt_length=prompt_length,
+                        batch_size=batch_size,
+                        eos_token=self.eos_token,
+                    )
+                ]
+            )
+
+        batch_generated_indices = model.generate(
+            **batch_tokenized,
+            max_new_tokens=self.max_new_tokens,
+            stopping_criteria=stopping_criteria,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
 
-        generated_texts = [self.post_processing(text=text) for text in generated_texts]
+        return batch_generated_indices.cpu()
+
+    def _generate_on_replica(
+            self,
+            batch_tokenized: BatchEncoding,
+            replicas: "Queue[Tuple[str, PreTrainedModel]]",
+    ) -> Tuple[BatchEncoding, Tensor]:
+        replica_device, model = replicas.get()
+        try:
+            batch_tokenized = batch_tokenized.to(replica_device)
+            return batch_tokenized, self.generate_batch(batch_tokenized=batch_tokenized, model=model)
+        finally:
+            replicas.put((replica_device, model))
+
+    def _generate_batches(
+            self,
+            texts: List[str],
+            batches: List[List[int]],
+    ) -> Iterator[Tuple[List[int], BatchEncoding, Tensor]]:
+        if len(self.models) == 1:
+            for batch_indices in batches:
+                batch_tokenized = self.tokenize(texts=[texts[index] for index in batch_indices])
+                yield batch_indices, batch_tokenized, self.generate_batch(batch_tokenized=batch_tokenized)
+            return
+
+        # One thread per replica, torch releases the gil inside kernels, so replicas run in parallel.
+        # Free replica is taken by the next batch, so a slow batch does not stall the others
+        replicas: "Queue[Tuple[str, PreTrainedModel]]" = Queue()
+        for replica_device, model in zip(self.devices, self.models):
+            replicas.put((replica_device, model))
+
+        # Batches are tokenized here, on the calling thread, so replica threads only run the models
+        with ThreadPoolExecutor(max_workers=len(self.models)) as executor:
+            futures = {
+                executor.submit(
+                    self._generate_on_replica,
+                    batch_tokenized=self.tokenize(texts=[texts[index] for index in batch_indices], device="cpu"),
+                    replicas=replicas,
+                ): batch_indices
+                for batch_indices in batches
+            }
+            for future in as_completed(futures):
+                batch_tokenized, batch_generated_indices = future.result()
+                yield futures[future], batch_tokenized, batch_generated_indices
+
+    def decode_new_tokens(self, batch_tokenized: BatchEncoding, batch_generated_indices: Tensor) -> List[str]:
+        # Prompt is left padded, so new tokens of every row start at the same position
+        new_token_indices = batch_generated_indices[:, batch_tokenized.input_ids.shape[1]:]
+        with self._tokenizer_lock:
+            return self.tokenizer.batch_decode(new_token_indices, skip_special_tokens=True)
+
+    def generate_texts(self, texts: List[str], replica_index: int = 0) -> List[str]:
+        # One batch on one replica, without progress bar and stats, for callers that do their own batching
+        device = self.devices[replica_index] if len(self.models) > 1 else None
+        batch_tokenized = self.tokenize(texts=texts, device=device)
+        batch_generated_indices = self.generate_batch(batch_tokenized=batch_tokenized, model=self.models[replica_index])
+        batch_generated_texts = self.decode_new_tokens(
+            batch_tokenized=batch_tokenized,
+            batch_generated_indices=batch_generated_indices,
+        )
+        return [self.post_processing(text=text) for text in batch_generated_texts]
+
+    def iter_generate(self, texts: List[str]) -> Iterator[Tuple[List[int], List[str]]]:
+        # Yields positions in texts and their generated texts batch by batch, in order of completion
+        batches = self.build_batches(texts=texts)
+
+        num_prompt_tokens = 0
+        num_padded_tokens = 0
+        num_generated_tokens = 0
+        num_decode_steps = 0
+        start_time = time.perf_counter()
+
+        for batch_indices, batch_tokenized, batch_generated_indices in tqdm(
+                self._generate_batches(texts=texts, batches=batches), total=len(batches), desc="Generating"
+        ):
+            num_prompt_tokens += int(batch_tokenized.attention_mask.sum())
+            num_padded_tokens += batch_tokenized.attention_mask.numel()
+            num_generated_tokens += batch_generated_indices.numel() - batch_tokenized.input_ids.numel()
+            num_decode_steps += batch_generated_indices.shape[1] - batch_tokenized.input_ids.shape[1]
+
+            batch_generated_texts = self.decode_new_tokens(
+                batch_tokenized=batch_tokenized,
+                batch_generated_indices=batch_generated_indices,
+            )
+            yield batch_indices, [self.post_processing(text=text) for text in batch_generated_texts]
+
+        elapsed_time = time.perf_counter() - start_time
+        # Constrained decoder feeds several tokens per forward, its own stats show the num of forward passes
+        decode_steps = ""
+        if self.constrained_decoder is None:
+            decode_steps = f"Decode steps: {num_decode_steps} of {len(batches) * self.max_new_tokens}. "
+
+        if num_padded_tokens:
+            logger.info(
+                f"Devices: {self.devices}. Batching: {self.batching}. Batches: {len(batches)}. "
+                f"Prompt padding: {(1 - num_prompt_tokens / num_padded_tokens) * 100:.1f} %. "
+                f"{decode_steps}"
+                f"Prompt tokens/sec: {num_prompt_tokens / elapsed_time:.1f}. "
+                f"Generated tokens/sec: {num_generated_tokens / elapsed_time:.1f}"
+            )
+
+        if self.constrained_decoder is not None:
+            self.constrained_decoder.log_stats()
+
+        if self.speculative_decoder is not None:
+            self.speculative_decoder.log_stats()
+
+    def generate(self, texts: List[str]) -> List[str]:
+        generated_texts: List[str] = [""] * len(texts)
+
+        # Outputs are put back on the positions of their inputs
+        for batch_indices, batch_generated_texts in self.iter_generate(texts=texts):
+            for index, text in zip(batch_indices, batch_generated_texts):
+                generated_texts[index] = text
 
         return generated_texts
+
+    def generate_to_jsonl(self, texts: List[str], file_path: str, flush_every: int = 100) -> int:
+        # Every row is written as soon as its batch is done, so memory does not grow with num of texts.
+        # Rows go in order of completion and keep the position of their input
+        num_written = 0
+
+        with open(file_path, "w") as file_object:
+            for batch_indices, batch_generated_texts in self.iter_generate(texts=texts):
+                for index, text in zip(batch_indices, batch_generated_texts):
+                    file_object.write(json.dumps({enums.Field.index: index, enums.Field.generated: text}) + "\n")
+                    num_written += 1
+                    if num_written % flush_every == 0:
+                        file_object.flush()
+
+        logger.info(f"Generated texts saved to {file_path}. Num rows: {num_written}")
+
+        return num_written
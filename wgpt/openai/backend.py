@@ -0,0 +1,256 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Mapping, Optional
+
+import aiohttp
+import openai
+import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+CHAT_COMPLETIONS_PATH = "/chat/completions"
+STREAM_DATA_PREFIX = "data:"
+STREAM_DONE = "[DONE]"
+
+
+class ChatBackend(ABC):
+    # Transport of chat completion requests. Responses and stream chunks are dicts in the OpenAI format.
+    # Async requests share one aiohttp pool, it is reference counted: the first open_session makes it, the last
+    # close_session closes it, so a request that finishes never closes the pool under the others
+    def __init__(self, max_connections: Optional[int] = None, keepalive_seconds: float = 60.0):
+        self.max_connections = max_connections
+        self.keepalive_seconds = keepalive_seconds
+
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        self._num_session_users = 0
+
+    @abstractmethod
+    def create(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def acreate(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def astream(self, params: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def open_session(self, max_concurrency: int) -> None:
+        # Synchronous, so concurrent callers never see a half opened pool. Pool belongs to the running event loop
+        if self._http_session is None:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections or max_concurrency,
+                    keepalive_timeout=self.keepalive_seconds,
+                )
+            )
+        self._num_session_users += 1
+
+    async def close_session(self) -> None:
+        if self._num_session_users == 0:
+            raise ValueError("Session is not open")
+        self._num_session_users -= 1
+        if self._num_session_users == 0 and self._http_session is not None:
+            # Detached before the await, a session opened meanwhile gets a new pool
+            http_session, self._http_session = self._http_session, None
+            await http_session.close()
+
+    @asynccontextmanager
+    async def session(self, max_concurrency: int) -> AsyncIterator[None]:
+        self.open_session(max_concurrency=max_concurrency)
+        try:
+            yield
+        finally:
+            await self.close_session()
+
+    def get_http_session(self) -> aiohttp.ClientSession:
+        if self._http_session is None:
+            raise ValueError("Session is not open")
+        return self._http_session
+
+
+class OpenAIChatBackend(ChatBackend):
+    # Module level openai client, api_base and api_key override the module settings when they are set
+    def __init__(
+            self,
+            api_base: Optional[str] = None,
+            api_key: Optional[str] = None,
+            timeout_seconds: Optional[float] = None,
+            max_connections: Optional[int] = None,
+    ):
+        super().__init__(max_connections=max_connections)
+
+        self.request_options: Dict[str, Any] = dict()
+        if api_base is not None:
+            self.request_options["api_base"] = api_base
+        if api_key is not None:
+            self.request_options["api_key"] = api_key
+        if timeout_seconds is not None:
+            self.request_options["request_timeout"] = timeout_seconds
+
+    def create(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        response: Dict[str, Any] = openai.ChatCompletion.create(**params, **self.request_options)
+        return response
+
+    async def _acreate(self, params: Dict[str, Any]) -> Any:
+        # openai takes the pool from a context variable. It is set around the call only, so it is set and reset
+        # in the same task
+        token = openai.aiosession.set(self.get_http_session())
+        try:
+            return await openai.ChatCompletion.acreate(**params, **self.request_options)
+        finally:
+            openai.aiosession.reset(token)
+
+    async def acreate(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        response: Dict[str, Any] = await self._acreate(params=params)
+        return response
+
+    async def astream(self, params: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        stream = await self._acreate(params={**params, "stream": True})
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+
+def raise_for_status(status: int, body: str, headers: Mapping[str, str]) -> None:
+    # Errors are raised as openai exceptions, so retries and rate limit handling work the same for every backend
+    if status < 400:
+        return
+
+    try:
+        json_body = json.loads(body)
+    except json.JSONDecodeError:
+        json_body = None
+
+    message = body
+    if isinstance(json_body, dict) and isinstance(json_body.get("error"), dict):
+        message = json_body["error"].get("message", body)
+    elif isinstance(json_body, dict) and isinstance(json_body.get("error"), str):
+        message = json_body["error"]
+
+    error_params = {"http_body": body, "http_status": status, "json_body": json_body, "headers": dict(headers)}
+
+    if status == 429:
+        raise openai.error.RateLimitError(message, **error_params)
+    if status == 503:
+        raise openai.error.ServiceUnavailableError(message, **error_params)
+    if status in (401, 403):
+        raise openai.error.AuthenticationError(message, **error_params)
+    if status < 500:
+        raise openai.error.InvalidRequestError(message, None, **error_params)
+    raise openai.error.APIError(message, **error_params)
+
+
+class HTTPChatBackend(ChatBackend):
+    # Any OpenAI compatible endpoint, e.g. vLLM or llama.cpp server. Connections are pooled and kept alive:
+    # one aiohttp pool per open session and one requests session for sync calls
+    def __init__(
+            self,
+            base_url: str,
+            api_key: Optional[str] = None,
+            timeout_seconds: Optional[float] = 600.0,
+            max_connections: Optional[int] = None,
+            keepalive_seconds: float = 60.0,
+    ):
+        super().__init__(max_connections=max_connections, keepalive_seconds=keepalive_seconds)
+        self.url = base_url.rstrip("/") + CHAT_COMPLETIONS_PATH
+        self.timeout_seconds = timeout_seconds
+
+        self.headers = {"Content-Type": "application/json"}
+        if api_key is not None:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+
+        self._sync_session: Optional[requests.Session] = None
+
+    def _get_sync_session(self) -> requests.Session:
+        if self._sync_session is None:
+            self._sync_session = requests.Session()
+            pool_size = self.max_connections or DEFAULT_POOLSIZE
+            self._sync_session.mount("http://", HTTPAdapter(pool_maxsize=pool_size))
+            self._sync_session.mount("https://", HTTPAdapter(pool_maxsize=pool_size))
+        return self._sync_session
+
+    def create(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            response = self._get_sync_session().post(
+                self.url, json=params, headers=self.headers, timeout=self.timeout_seconds
+            )
+        except requests.Timeout as exception:
+            raise openai.error.Timeout(str(exception)) from exception
+        except requests.ConnectionError as exception:
+            raise openai.error.APIConnectionError(str(exception)) from exception
+
+        raise_for_status(status=response.status_code, body=response.text, headers=response.headers)
+        data: Dict[str, Any] = response.json()
+        return data
+
+    async def acreate(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        async with self.get_http_session().post(
+                self.url,
+                json=params,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout_seconds),
+        ) as response:
+            body = await response.text()
+            raise_for_status(status=response.status, body=body, headers=response.headers)
+        data: Dict[str, Any] = json.loads(body)
+        return data
+
+    async def astream(self, params: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        # Timeout is between chunks, a long completion is not cut as long as tokens keep coming
+        async with self.get_http_session().post(
+                self.url,
+                json={**params, "stream": True},
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=self.timeout_seconds),
+        ) as response:
+            if response.status >= 400:
+                raise_for_status(status=response.status, body=await response.text(), headers=response.headers)
+
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith(STREAM_DATA_PREFIX):
+                    continue
+                data = line[len(STREAM_DATA_PREFIX):].strip()
+                if data == STREAM_DONE:
+                    break
+                yield json.loads(data)
+
+    def close(self) -> None:
+        if self._sync_session is not None:
+            self._sync_session.close()
+            self._sync_session = None
+
+
+def build_chat_backend(
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        timeout_seconds: Optional[float] = None,
+        max_connections: Optional[int] = None,
+) -> ChatBackend:
+    # Requests go to the OpenAI API unless a base url of another OpenAI compatible endpoint is given
+    if base_url is None:
+        return OpenAIChatBackend(api_key=api_key, timeout_seconds=timeout_seconds, max_connections=max_connections)
+    return HTTPChatBackend(
+        base_url=base_url,
+        api_key=api_key,
+        timeout_seconds=timeout_seconds,
+        max_connections=max_connections,
+    )
@@ -0,0 +1,249 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional
+
+import openai
+from loguru import logger
+
+from wgpt import enums
+from wgpt.openai.client import GPTClient
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+
+class BatchBackend(ABC):
+    @abstractmethod
+    def submit(self, requests_file_path: str) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def status(self, batch_id: str) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def download_results(self, batch_id: str, results_file_path: str) -> None:
+        raise NotImplementedError
+
+
+class OpenAIBatchBackend(BatchBackend):
+    def __init__(self, completion_window: str = "24h"):
+        self.completion_window = completion_window
+
+    @staticmethod
+    def _request(method: str, url: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        requestor = openai.api_requestor.APIRequestor()
+        response, _, _ = requestor.request(method, url, params=params)
+        data: Dict[str, Any] = response.data
+        return data
+
+    def submit(self, requests_file_path: str) -> str:
+        with open(requests_file_path, mode="rb") as file_object:
+            uploaded_file = openai.File.create(file=file_object, purpose="batch")
+
+        batch = self._request(
+            method="post",
+            url="/batches",
+            params={
+                "input_file_id": uploaded_file["id"],
+                "endpoint": CHAT_COMPLETIONS_URL,
+                "completion_window": self.completion_window,
+            },
+        )
+        batch_id: str = batch["id"]
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        status: str = self._request(method="get", url=f"/batches/{batch_id}")["status"]
+        return status
+
+    def download_results(self, batch_id: str, results_file_path: str) -> None:
+        batch = self._request(method="get", url=f"/batches/{batch_id}")
+
+        with open(results_file_path, mode="wb") as file_object:
+            for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+                if file_id is not None:
+                    file_object.write(openai.File.download(file_id))
+
+
+class LocalBatchBackend(BatchBackend):
+    # File-based stand-in for tests and offline runs: responder maps request body to completions
+    def __init__(self, responder: Callable[[Dict[str, Any]], List[str]], work_dir: str, num_polls_to_complete: int = 1):
+        self.responder = responder
+        self.work_dir = work_dir
+        self.num_polls_to_complete = num_polls_to_complete
+
+        self._num_polls: Dict[str, int] = dict()
+
+        os.makedirs(work_dir, exist_ok=True)
+
+    def _path(self, batch_id: str, suffix: str) -> str:
+        return os.path.join(self.work_dir, f"{batch_id}.{suffix}.jsonl")
+
+    def submit(self, requests_file_path: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.replace(requests_file_path, self._path(batch_id=batch_id, suffix="input"))
+        self._num_polls[batch_id] = 0
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        self._num_polls[batch_id] += 1
+        if self._num_polls[batch_id] < self.num_polls_to_complete:
+            return enums.BatchStatus.in_progress
+        return enums.BatchStatus.completed
+
+    def download_results(self, batch_id: str, results_file_path: str) -> None:
+        with open(self._path(batch_id=batch_id, suffix="input")) as input_file, open(
+                results_file_path, mode="w"
+        ) as results_file:
+            for line in input_file:
+                request = json.loads(line)
+                choices = [
+                    {"index": index, "message": {"role": "assistant", "content": content}}
+                    for index, content in enumerate(self.responder(request["body"]))
+                ]
+                result = {
+                    "id": f"response_{uuid.uuid4().hex}",
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": {"choices": choices}},
+                    "error": None,
+                }
+                results_file.write(json.dumps(result) + "\n")
+
+
+class BatchRunner:
+    def __init__(
+            self,
+            gpt_client: GPTClient,
+            backend: BatchBackend,
+            work_dir: str = "./batches",
+            poll_interval_seconds: float = 30.0,
+            max_requests_per_batch: int = 50_000,
+    ):
+        self.gpt_client = gpt_client
+        self.backend = backend
+        self.work_dir = work_dir
+        self.poll_interval_seconds = poll_interval_seconds
+        self.max_requests_per_batch = max_requests_per_batch
+
+        os.makedirs(work_dir, exist_ok=True)
+
+    def build_request(self, custom_id: str, content: str, assistant_prompt: Optional[str] = None) -> Dict[str, Any]:
+        messages = self.gpt_client.build_one_turn_messages(content=content, assistant_prompt=assistant_prompt)
+        request = {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": CHAT_COMPLETIONS_URL,
+            "body": self.gpt_client.build_request_params(messages=messages),
+        }
+        return request
+
+    def write_requests(self, requests: List[Dict[str, Any]], requests_file_path: str) -> None:
+        with open(requests_file_path, mode="w") as file_object:
+            for request in requests:
+                file_object.write(json.dumps(request) + "\n")
+
+    def read_results(self, results_file_path: str) -> Dict[str, List[str]]:
+        results = dict()
+
+        with open(results_file_path) as file_object:
+            for line in file_object:
+                result = json.loads(line)
+                response = result.get("response") or dict()
+                if result.get("error") is not None or response.get("status_code") != 200:
+                    logger.error(f"Batch request {result.get('custom_id')} failed: {result.get('error')}")
+                    continue
+                choices = response["body"]["choices"]
+                results[result["custom_id"]] = [choice["message"]["content"] for choice in choices]
+
+        return results
+
+    def wait(self, batch_id: str) -> str:
+        while True:
+            status = self.backend.status(batch_id=batch_id)
+            if status in enums.BatchStatus.terminal:
+                return status
+            logger.info(f"Batch {batch_id} status: {status}")
+            time.sleep(self.poll_interval_seconds)
+
+    def _run_chunk(self, requests: List[Dict[str, Any]], cache_indices: Dict[str, int]) -> Dict[str, List[str]]:
+        requests_file_path = os.path.join(self.work_dir, f"requests_{uuid.uuid4().hex}.jsonl")
+        self.write_requests(requests=requests, requests_file_path=requests_file_path)
+
+        batch_id = self.backend.submit(requests_file_path=requests_file_path)
+        logger.info(f"Batch {batch_id} submitted. Num requests: {len(requests)}")
+
+        status = self.wait(batch_id=batch_id)
+        if status != enums.BatchStatus.completed:
+            logger.error(f"Batch {batch_id} finished with status: {status}")
+
+        results_file_path = os.path.join(self.work_dir, f"{batch_id}.results.jsonl")
+        self.backend.download_results(batch_id=batch_id, results_file_path=results_file_path)
+
+        results = self.read_results(results_file_path=results_file_path)
+
+        if self.gpt_client.cache is not None:
+            bodies = {request["custom_id"]: request["body"] for request in requests}
+            for custom_id, text_responses in results.items():
+                self.gpt_client.cache.set(
+                    params=bodies[custom_id], responses=text_responses, cache_index=cache_indices[custom_id]
+                )
+
+        return results
+
+    def run(
+            self,
+            contents: List[str],
+            custom_ids: Optional[List[str]] = None,
+            assistant_prompt: Optional[str] = None,
+            cache_indices: Optional[List[int]] = None,
+    ) -> Dict[str, List[str]]:
+        # Maps custom id to completions. Requests missing from the result have failed
+        custom_ids = custom_ids or [f"request-{index}" for index in range(len(contents))]
+        cache_indices = cache_indices or [0] * len(contents)
+
+        if len(set(custom_ids)) != len(custom_ids):
+            raise ValueError("Custom ids must be unique")
+
+        results = dict()
+        requests = list()
+        cache_index_by_custom_id = dict()
+
+        for custom_id, content, cache_index in zip(custom_ids, contents, cache_indices):
+            request = self.build_request(custom_id=custom_id, content=content, assistant_prompt=assistant_prompt)
+            cached_responses = None
+            if self.gpt_client.cache is not None:
+                cached_responses = self.gpt_client.cache.get(params=request["body"], cache_index=cache_index)
+            if cached_responses is not None:
+                results[custom_id] = cached_responses
+            else:
+                requests.append(request)
+                cache_index_by_custom_id[custom_id] = cache_index
+
+        for chunk_start in range(0, len(requests), self.max_requests_per_batch):
+            results.update(
+                self._run_chunk(
+                    requests=requests[chunk_start: chunk_start + self.max_requests_per_batch],
+                    cache_indices=cache_index_by_custom_id,
+                )
+            )
+
+        logger.info(f"Batch requests completed: {len(results)} / {len(contents)}. Submitted: {len(requests)}")
+
+        return results
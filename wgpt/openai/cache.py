@@ -0,0 +1,146 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+
+class ResponseCache:
+    def __init__(
+            self,
+            path: str,
+            max_entries: Optional[int] = None,
+            ttl_seconds: Optional[float] = None,
+            evict_every: int = 100,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evict_every = evict_every
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, responses TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+        self._num_writes = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    @staticmethod
+    def build_key(params: Dict[str, Any], cache_index: int = 0) -> str:
+        # Number of completions is not a part of the key: a response with more choices serves requests for fewer
+        key_params = {key: value for key, value in params.items() if key != "n"}
+        key_params["cache_index"] = cache_index
+        serialized = json.dumps(key_params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def _get_responses(self, key: str) -> Optional[List[str]]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT responses, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            raw_responses, created_at = row
+
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+
+        responses: List[str] = json.loads(raw_responses)
+        return responses
+
+    def get(
+            self,
+            params: Dict[str, Any],
+            cache_index: int = 0,
+            completion_index: Optional[int] = None,
+    ) -> Optional[List[str]]:
+        responses = self._get_responses(key=self.build_key(params=params, cache_index=cache_index))
+
+        if completion_index is not None:
+            start_index, num_required = completion_index, 1
+        else:
+            start_index, num_required = 0, params.get("n", 1)
+
+        if responses is None or len(responses) < start_index + num_required:
+            self.num_misses += 1
+            return None
+
+        self.num_hits += 1
+        return responses[start_index: start_index + num_required]
+
+    def set(self, params: Dict[str, Any], responses: List[str], cache_index: int = 0) -> None:
+        if not responses:
+            return None
+
+        key = self.build_key(params=params, cache_index=cache_index)
+        now = time.time()
+
+        with self._lock:
+            row = self._connection.execute("SELECT responses FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and len(json.loads(row[0])) > len(responses):
+                return None
+
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, responses, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(responses, ensure_ascii=False), now, now),
+            )
+
+            self._num_writes += 1
+            if self._num_writes % self.evict_every == 0:
+                self._evict()
+
+        return None
+
+    def _evict(self) -> None:
+        if self.ttl_seconds is not None:
+            self._connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+
+        if self.max_entries is not None:
+            (num_entries,) = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if num_entries > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                    (num_entries - self.max_entries,),
+                )
+
+    def evict(self) -> None:
+        with self._lock:
+            self._evict()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def log_stats(self) -> None:
+        num_requests = self.num_hits + self.num_misses
+        hit_rate = self.num_hits * 100 / num_requests if num_requests > 0 else 0.0
+        logger.info(f"Cache hits: {self.num_hits}. Misses: {self.num_misses}. Hit rate: {hit_rate:.2f} %")
@@ -12,13 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict, List, Optional
+import asyncio
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
-import openai
 from loguru import logger
 
 from wgpt import enums
 from wgpt.core.prompts import ASSISTANT_PROMPT
+from wgpt.openai.backend import ChatBackend, OpenAIChatBackend
+from wgpt.openai.cache import ResponseCache
+from wgpt.openai.limiter import CHARS_PER_TOKEN, RateLimiter, estimate_num_tokens, is_retryable_error
 
 
 class GPTClient:
@@ -32,6 +38,11 @@ class GPTClient:
             top_p: float = 0.99,
             frequency_penalty: float = 0.0,
             presence_penalty: float = 0.0,
+            max_concurrency: int = 64,
+            rate_limiter: Optional[RateLimiter] = None,
+            cache: Optional[ResponseCache] = None,
+            model_name: str = DEFAULT_MODEL_NAME,
+            backend: Optional[ChatBackend] = None,
     ):
         self.num_completion = num_completion
         self.temperature = temperature
@@ -39,6 +50,92 @@ class GPTClient:
         self.top_p = top_p
         self.frequency_penalty = frequency_penalty
         self.presence_penalty = presence_penalty
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = rate_limiter or RateLimiter(max_concurrency=max_concurrency)
+        self.cache = cache
+        self.model_name = model_name
+        self.backend = backend or OpenAIChatBackend()
+
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._num_session_users = 0
+
+    def build_request_params(
+            self,
+            messages: List[Dict[str, str]],
+            model_name: Optional[str] = None,
+            num_completion: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        params = {
+            "model": model_name or self.model_name,
+            "messages": messages,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "max_tokens": self.max_tokens,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+            "n": num_completion or self.num_completion,
+        }
+        return params
+
+    def build_one_turn_messages(self, content: str, assistant_prompt: Optional[str] = None) -> List[Dict[str, str]]:
+        assistant_prompt = assistant_prompt or ASSISTANT_PROMPT
+
+        messages = [
+            {enums.Field.role: enums.GPTRole.system, enums.Field.content: assistant_prompt},
+            {
+                enums.Field.role: enums.GPTRole.user,
+                enums.Field.content: content,
+            },
+        ]
+        return messages
+
+    def _get_cached(
+            self,
+            params: Dict[str, Any],
+            cache_index: int,
+            completion_index: Optional[int],
+    ) -> Optional[List[str]]:
+        if self.cache is None:
+            return None
+        return self.cache.get(params=params, cache_index=cache_index, completion_index=completion_index)
+
+    def _set_cached(
+            self,
+            params: Dict[str, Any],
+            text_responses: List[str],
+            cache_index: int,
+            completion_index: Optional[int],
+    ) -> List[str]:
+        if self.cache is not None:
+            self.cache.set(params=params, responses=text_responses, cache_index=cache_index)
+        if completion_index is not None:
+            text_responses = text_responses[completion_index: completion_index + 1]
+        return text_responses
+
+    def _process_response(self, open_ai_response: Dict[str, Any], estimated_tokens: int) -> List[str]:
+        usage = open_ai_response.get("usage")
+        used_tokens = usage.get("total_tokens") if usage else None
+        self.rate_limiter.reconcile(estimated_tokens=estimated_tokens, used_tokens=used_tokens)
+        self.rate_limiter.on_success()
+        text_responses = [
+            choice["message"][enums.Field.content] or "" for choice in open_ai_response["choices"]
+        ]
+        return text_responses
+
+    def _process_exception(self, exception: Exception, attempt: int, num_retries: int) -> Optional[float]:
+        # Returns backoff delay before the next attempt or None if the request should not be retried
+        logger.error(f"GPT response exception: {exception}")
+
+        if not is_retryable_error(exception):
+            return None
+
+        self.rate_limiter.on_error(exception)
+
+        if attempt + 1 >= num_retries:
+            logger.error(f"GPT request failed after {num_retries} attempts")
+            return None
+
+        return self.rate_limiter.backoff_delay(attempt=attempt, exception=exception)
 
     def get_gpt_response(
             self,
@@ -46,35 +143,43 @@ class GPTClient:
             model_name: Optional[str] = None,
             num_completion: Optional[int] = None,
             num_retries: int = 3,
+            cache_index: int = 0,
+            completion_index: Optional[int] = None,
     ) -> List[str]:
-        model_name = model_name or self.DEFAULT_MODEL_NAME
-        num_completion = num_completion or self.num_completion
+        params = self.build_request_params(messages=messages, model_name=model_name, num_completion=num_completion)
+
+        cached_responses = self._get_cached(params=params, cache_index=cache_index, completion_index=completion_index)
+        if cached_responses is not None:
+            return cached_responses
+
+        estimated_tokens = estimate_num_tokens(
+            messages=messages, max_tokens=self.max_tokens, num_completion=params["n"]
+        )
 
-        retries_counter = 0
         text_responses: List[str] = list()
 
-        while True:
-            if retries_counter >= num_retries:
-                break
+        for attempt in range(num_retries):
+            delay = self.rate_limiter.reserve(num_tokens=estimated_tokens)
+            if delay > 0:
+                time.sleep(delay)
 
             try:
-                open_ai_response = openai.ChatCompletion.create(
-                    model=model_name,
-                    messages=messages,
-                    temperature=self.temperature,
-                    top_p=self.top_p,
-                    max_tokens=self.max_tokens,
-                    presence_penalty=self.presence_penalty,
-                    frequency_penalty=self.frequency_penalty,
-                    n=num_completion,
-                )
-                text_responses = [choice.message.content for choice in open_ai_response.choices]
-                break
+                open_ai_response = self.backend.create(params=params)
             except Exception as exception:
-                logger.error(f"GPT response exception: {exception}")
-                retries_counter += 1
+                backoff_delay = self._process_exception(exception=exception, attempt=attempt, num_retries=num_retries)
+                if backoff_delay is None:
+                    break
+                time.sleep(backoff_delay)
+                continue
 
-        return text_responses
+            text_responses = self._process_response(
+                open_ai_response=open_ai_response, estimated_tokens=estimated_tokens
+            )
+            break
+
+        return self._set_cached(
+            params=params, text_responses=text_responses, cache_index=cache_index, completion_index=completion_index
+        )
 
     def one_turn_generation(
             self,
@@ -82,15 +187,228 @@ class GPTClient:
             assistant_prompt: Optional[str] = None,
             model_name: Optional[str] = None,
             num_completion: Optional[int] = None,
+            cache_index: int = 0,
+            completion_index: Optional[int] = None,
     ) -> List[str]:
-        assistant_prompt = assistant_prompt or ASSISTANT_PROMPT
+        messages = self.build_one_turn_messages(content=content, assistant_prompt=assistant_prompt)
+        text_responses = self.get_gpt_response(
+            messages=messages,
+            model_name=model_name,
+            num_completion=num_completion,
+            cache_index=cache_index,
+            completion_index=completion_index,
+        )
+        return text_responses
 
-        messages = [
-            {enums.Field.role: enums.GPTRole.system, enums.Field.content: assistant_prompt},
-            {
-                enums.Field.role: enums.GPTRole.user,
-                enums.Field.content: content,
-            },
-        ]
-        text_responses = self.get_gpt_response(messages=messages, model_name=model_name, num_completion=num_completion)
+    @asynccontextmanager
+    async def session(self, max_concurrency: Optional[int] = None) -> AsyncIterator[None]:
+        # One connection pool of the backend and one in-flight limit for every request made inside the context.
+        # Reference counted: nested and concurrent contexts share what the first one opened, the last one to leave
+        # closes it. Opening has no await, so no caller ever sees a half opened session
+        if self._num_session_users == 0:
+            max_concurrency = max_concurrency or self.max_concurrency
+            self.backend.open_session(max_concurrency=max_concurrency)
+            self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._num_session_users += 1
+
+        try:
+            yield
+        finally:
+            self._num_session_users -= 1
+            if self._num_session_users == 0:
+                self._semaphore = None
+                await self.backend.close_session()
+
+    async def aget_gpt_response(
+            self,
+            messages: List[Dict[str, str]],
+            model_name: Optional[str] = None,
+            num_completion: Optional[int] = None,
+            num_retries: int = 3,
+            cache_index: int = 0,
+            completion_index: Optional[int] = None,
+    ) -> List[str]:
+        params = self.build_request_params(messages=messages, model_name=model_name, num_completion=num_completion)
+
+        cached_responses = self._get_cached(params=params, cache_index=cache_index, completion_index=completion_index)
+        if cached_responses is not None:
+            return cached_responses
+
+        estimated_tokens = estimate_num_tokens(
+            messages=messages, max_tokens=self.max_tokens, num_completion=params["n"]
+        )
+
+        text_responses: List[str] = list()
+
+        async with self.session():
+            if self._semaphore is None:
+                raise ValueError("Session is not open")
+
+            for attempt in range(num_retries):
+                await self.rate_limiter.acquire(num_tokens=estimated_tokens)
+                try:
+                    async with self._semaphore:
+                        open_ai_response = await self.backend.acreate(params=params)
+                except Exception as exception:
+                    backoff_delay = self._process_exception(
+                        exception=exception, attempt=attempt, num_retries=num_retries
+                    )
+                    if backoff_delay is None:
+                        break
+                    await asyncio.sleep(backoff_delay)
+                    continue
+                finally:
+                    await self.rate_limiter.release()
+
+                text_responses = self._process_response(
+                    open_ai_response=open_ai_response, estimated_tokens=estimated_tokens
+                )
+                break
+
+        return self._set_cached(
+            params=params, text_responses=text_responses, cache_index=cache_index, completion_index=completion_index
+        )
+
+    async def one_turn_generation_async(
+            self,
+            content: str,
+            assistant_prompt: Optional[str] = None,
+            model_name: Optional[str] = None,
+            num_completion: Optional[int] = None,
+            cache_index: int = 0,
+            completion_index: Optional[int] = None,
+    ) -> List[str]:
+        messages = self.build_one_turn_messages(content=content, assistant_prompt=assistant_prompt)
+        text_responses = await self.aget_gpt_response(
+            messages=messages,
+            model_name=model_name,
+            num_completion=num_completion,
+            cache_index=cache_index,
+            completion_index=completion_index,
+        )
         return text_responses
+
+    async def astream_gpt_response(
+            self,
+            messages: List[Dict[str, str]],
+            model_name: Optional[str] = None,
+            num_completion: Optional[int] = None,
+            num_retries: int = 3,
+            cache_index: int = 0,
+    ) -> AsyncIterator[Tuple[int, str]]:
+        # Yields (choice index, text delta). Closing the iterator early closes the request, so the rest of the
+        # completion is not generated and not paid for
+        params = self.build_request_params(messages=messages, model_name=model_name, num_completion=num_completion)
+
+        cached_responses = self._get_cached(params=params, cache_index=cache_index, completion_index=None)
+        if cached_responses is not None:
+            for choice_index, text_response in enumerate(cached_responses):
+                yield choice_index, text_response
+            return
+
+        estimated_tokens = estimate_num_tokens(
+            messages=messages, max_tokens=self.max_tokens, num_completion=params["n"]
+        )
+        prompt_tokens = estimate_num_tokens(messages=messages, max_tokens=0)
+
+        text_responses: Dict[int, List[str]] = defaultdict(list)
+        completed = False
+
+        async with self.session():
+            if self._semaphore is None:
+                raise ValueError("Session is not open")
+
+            for attempt in range(num_retries):
+                await self.rate_limiter.acquire(num_tokens=estimated_tokens)
+                try:
+                    async with self._semaphore:
+                        stream = self.backend.astream(params=params)
+                        try:
+                            async for chunk in stream:
+                                for choice in chunk["choices"]:
+                                    delta = choice.get("delta", dict()).get(enums.Field.content)
+                                    if delta:
+                                        text_responses[choice["index"]].append(delta)
+                                        yield choice["index"], delta
+                        finally:
+                            await stream.aclose()
+                    completed = True
+                except Exception as exception:
+                    if text_responses:
+                        # Part of the completion is already consumed, so the request can not be replayed
+                        logger.error(f"GPT stream interrupted: {exception}")
+                        break
+                    backoff_delay = self._process_exception(
+                        exception=exception, attempt=attempt, num_retries=num_retries
+                    )
+                    if backoff_delay is None:
+                        break
+                    await asyncio.sleep(backoff_delay)
+                    continue
+                finally:
+                    # Stream has no usage block, completion tokens are estimated from received text
+                    if text_responses:
+                        num_chars = sum(len(delta) for deltas in text_responses.values() for delta in deltas)
+                        self.rate_limiter.reconcile(
+                            estimated_tokens=estimated_tokens,
+                            used_tokens=prompt_tokens + num_chars // CHARS_PER_TOKEN,
+                        )
+                    await self.rate_limiter.release()
+
+                self.rate_limiter.on_success()
+                break
+
+        if completed:
+            self._set_cached(
+                params=params,
+                text_responses=["".join(text_responses[index]) for index in sorted(text_responses)],
+                cache_index=cache_index,
+                completion_index=None,
+            )
+
+    async def astream_generation(
+            self,
+            content: str,
+            assistant_prompt: Optional[str] = None,
+            model_name: Optional[str] = None,
+            num_completion: Optional[int] = None,
+            cache_index: int = 0,
+    ) -> AsyncIterator[Tuple[int, str]]:
+        messages = self.build_one_turn_messages(content=content, assistant_prompt=assistant_prompt)
+        stream = self.astream_gpt_response(
+            messages=messages,
+            model_name=model_name,
+            num_completion=num_completion,
+            cache_index=cache_index,
+        )
+        try:
+            async for choice_index, delta in stream:
+                yield choice_index, delta
+        finally:
+            await stream.aclose()
+
+    async def agenerate(
+            self,
+            contents: List[str],
+            assistant_prompt: Optional[str] = None,
+            model_name: Optional[str] = None,
+            num_completion: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            cache_indices: Optional[List[int]] = None,
+    ) -> List[List[str]]:
+        cache_indices = cache_indices or [0] * len(contents)
+
+        async with self.session(max_concurrency=max_concurrency):
+            text_responses = await asyncio.gather(
+                *[
+                    self.one_turn_generation_async(
+                        content=content,
+                        assistant_prompt=assistant_prompt,
+                        model_name=model_name,
+                        num_completion=num_completion,
+                        cache_index=cache_index,
+                    )
+                    for content, cache_index in zip(contents, cache_indices)
+                ]
+            )
+        return list(text_responses)
@@ -0,0 +1,231 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import hashlib
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from loguru import logger
+
+from wgpt import enums
+from wgpt.openai.client import GPTClient
+
+
+class IndexedExecutor:
+    # Runs one request per prompt id and keeps the mapping prompt id -> completions, so results never depend on
+    # completion order. Failed items are retried one by one while the retry budget lasts, items that run far
+    # longer than the typical request are reported as stragglers. Finished items are appended to the checkpoint
+    # file, a rerun with the same prompts only sends what is missing
+    def __init__(
+            self,
+            gpt_client: GPTClient,
+            max_attempts: int = 3,
+            retry_budget: Optional[int] = None,
+            item_timeout_seconds: Optional[float] = None,
+            straggler_factor: float = 5.0,
+            min_straggler_seconds: float = 30.0,
+            report_interval_seconds: float = 30.0,
+            checkpoint_path: Optional[str] = None,
+    ):
+        self.gpt_client = gpt_client
+        self.max_attempts = max_attempts
+        self.retry_budget = retry_budget
+        self.item_timeout_seconds = item_timeout_seconds
+        self.straggler_factor = straggler_factor
+        self.min_straggler_seconds = min_straggler_seconds
+        self.report_interval_seconds = report_interval_seconds
+        self.checkpoint_path = checkpoint_path
+
+        self.num_retries_left = retry_budget
+        self.num_retries = 0
+        self.num_completed = 0
+        self.failed_ids: Set[str] = set()
+        self.straggler_ids: Set[str] = set()
+
+        self._started_at: Dict[str, float] = dict()
+        self._latencies: List[float] = list()
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def load_checkpoint(self) -> Dict[str, Dict[str, Any]]:
+        checkpoint: Dict[str, Dict[str, Any]] = dict()
+        if self.checkpoint_path is None or not os.path.isfile(self.checkpoint_path):
+            return checkpoint
+
+        with open(self.checkpoint_path) as file_object:
+            for line in file_object:
+                try:
+                    sample = json.loads(line)
+                except json.JSONDecodeError:
+                    # Line cut by an interrupted run
+                    continue
+                checkpoint[sample[enums.Field.prompt_id]] = sample
+
+        return checkpoint
+
+    def straggler_threshold(self) -> float:
+        if not self._latencies:
+            return self.min_straggler_seconds
+        return max(self.min_straggler_seconds, self.straggler_factor * statistics.median(self._latencies))
+
+    def _take_retry(self) -> bool:
+        if self.num_retries_left is not None:
+            if self.num_retries_left <= 0:
+                return False
+            self.num_retries_left -= 1
+        self.num_retries += 1
+        return True
+
+    async def _request(self, content: str, assistant_prompt: Optional[str]) -> List[str]:
+        request = self.gpt_client.one_turn_generation_async(content=content, assistant_prompt=assistant_prompt)
+        if self.item_timeout_seconds is None:
+            return await request
+        return await asyncio.wait_for(request, timeout=self.item_timeout_seconds)
+
+    async def arun_one(self, prompt_id: str, content: str, assistant_prompt: Optional[str] = None) -> List[str]:
+        # Empty list means the item failed every attempt it was given
+        for attempt in range(self.max_attempts):
+            if attempt > 0 and not self._take_retry():
+                logger.warning(f"Retry budget is exhausted, {prompt_id} is left failed")
+                break
+
+            self._started_at[prompt_id] = time.perf_counter()
+            try:
+                text_responses = await self._request(content=content, assistant_prompt=assistant_prompt)
+            except asyncio.TimeoutError:
+                logger.warning(f"{prompt_id} timed out, attempt {attempt + 1} of {self.max_attempts}")
+                text_responses = list()
+            except Exception as exception:
+                logger.error(f"{prompt_id} failed, attempt {attempt + 1} of {self.max_attempts}: {exception}")
+                text_responses = list()
+            finally:
+                started_at = self._started_at.pop(prompt_id)
+
+            if text_responses and any(text.strip() for text in text_responses):
+                self._latencies.append(time.perf_counter() - started_at)
+                self.num_completed += 1
+                self.failed_ids.discard(prompt_id)
+                return text_responses
+
+        self.failed_ids.add(prompt_id)
+        return list()
+
+    async def _report_progress(self, num_items: int) -> None:
+        while True:
+            await asyncio.sleep(self.report_interval_seconds)
+            now = time.perf_counter()
+            threshold = self.straggler_threshold()
+            stragglers = [
+                prompt_id for prompt_id, started_at in self._started_at.items() if now - started_at > threshold
+            ]
+            self.straggler_ids.update(stragglers)
+            logger.info(
+                f"Requests completed: {self.num_completed} / {num_items}. Failed: {len(self.failed_ids)}. "
+                f"In flight: {len(self._started_at)}. Retries: {self.num_retries}"
+            )
+            if stragglers:
+                logger.warning(f"Stragglers running over {threshold:.1f} s: {', '.join(stragglers[:10])}")
+
+    async def arun(
+            self,
+            contents: List[str],
+            prompt_ids: Optional[List[str]] = None,
+            assistant_prompt: Optional[str] = None,
+            max_concurrency: Optional[int] = None,
+    ) -> Dict[str, List[str]]:
+        # Maps prompt id to completions. Items missing from the result have failed, the rest are still valid
+        prompt_ids = prompt_ids or [f"request-{index}" for index in range(len(contents))]
+
+        if len(set(prompt_ids)) != len(prompt_ids):
+            raise ValueError("Prompt ids must be unique")
+
+        results: Dict[str, List[str]] = dict()
+        checkpoint = self.load_checkpoint()
+        pending = list()
+
+        for prompt_id, content in zip(prompt_ids, contents):
+            sample = checkpoint.get(prompt_id)
+            # Prompt behind the id may change between runs, e.g. after the model is retrained
+            if sample is not None and sample[enums.Field.content_hash] == self.content_hash(content=content):
+                results[prompt_id] = sample[enums.Field.responses]
+            else:
+                pending.append((prompt_id, content))
+
+        if checkpoint:
+            logger.info(f"Restored from checkpoint: {len(results)} / {len(contents)}")
+
+        checkpoint_file = open(self.checkpoint_path, "a") if self.checkpoint_path is not None else None
+
+        async def run_item(prompt_id: str, content: str) -> None:
+            text_responses = await self.arun_one(
+                prompt_id=prompt_id, content=content, assistant_prompt=assistant_prompt
+            )
+            if not text_responses:
+                return
+            results[prompt_id] = text_responses
+            if checkpoint_file is not None:
+                sample = {
+                    enums.Field.prompt_id: prompt_id,
+                    enums.Field.content_hash: self.content_hash(content=content),
+                    enums.Field.responses: text_responses,
+                }
+                checkpoint_file.write(json.dumps(sample, ensure_ascii=False) + "\n")
+                checkpoint_file.flush()
+
+        reporter = asyncio.create_task(self._report_progress(num_items=len(pending)))
+        try:
+            async with self.gpt_client.session(max_concurrency=max_concurrency):
+                await asyncio.gather(
+                    *[run_item(prompt_id=prompt_id, content=content) for prompt_id, content in pending]
+                )
+        finally:
+            reporter.cancel()
+            if checkpoint_file is not None:
+                checkpoint_file.close()
+
+        self.log_stats(num_items=len(contents), num_results=len(results))
+
+        return results
+
+    def run(
+            self,
+            contents: List[str],
+            prompt_ids: Optional[List[str]] = None,
+            assistant_prompt: Optional[str] = None,
+            max_concurrency: Optional[int] = None,
+    ) -> Dict[str, List[str]]:
+        return asyncio.run(
+            self.arun(
+                contents=contents,
+                prompt_ids=prompt_ids,
+                assistant_prompt=assistant_prompt,
+                max_concurrency=max_concurrency,
+            )
+        )
+
+    def log_stats(self, num_items: int, num_results: int) -> None:
+        text = f"Indexed requests completed: {num_results} / {num_items}. Retries: {self.num_retries}"
+        if self._latencies:
+            text += f". Median latency: {statistics.median(self._latencies):.2f} s"
+        logger.info(text)
+
+        for name, prompt_ids in (("Failed", self.failed_ids), ("Straggler", self.straggler_ids)):
+            if prompt_ids:
+                logger.warning(f"{name} prompt ids ({len(prompt_ids)}): {', '.join(sorted(prompt_ids)[:20])}")
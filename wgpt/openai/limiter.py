@@ -0,0 +1,211 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+import openai
+from loguru import logger
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_num_tokens(messages: List[Dict[str, str]], max_tokens: int, num_completion: int = 1) -> int:
+    # Upper bound for tokens-per-minute accounting, corrected by the usage block once the response arrives
+    num_prompt_chars = sum(len(value) for message in messages for value in message.values())
+    return num_prompt_chars // CHARS_PER_TOKEN + max_tokens * num_completion
+
+
+def is_rate_limit_error(exception: BaseException) -> bool:
+    return isinstance(exception, openai.error.RateLimitError)
+
+
+def is_retryable_error(exception: BaseException) -> bool:
+    if isinstance(
+            exception,
+            (
+                    openai.error.RateLimitError,
+                    openai.error.ServiceUnavailableError,
+                    openai.error.Timeout,
+                    openai.error.TryAgain,
+                    openai.error.APIConnectionError,
+                    asyncio.TimeoutError,
+                    aiohttp.ClientError,
+            ),
+    ):
+        return True
+
+    if isinstance(exception, openai.error.APIError):
+        return exception.http_status is None or exception.http_status >= 500
+
+    return False
+
+
+def get_retry_after(exception: BaseException) -> Optional[float]:
+    headers = getattr(exception, "headers", None) or dict()
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.refill_rate = capacity_per_minute / 60.0
+
+        self._available = capacity_per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.refill_rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        # Takes the amount right away (the balance may go negative) and returns how long the caller has to wait
+        # until the bucket is back to zero. Waiting callers are served in reservation order
+        self._refill()
+        self._available -= min(amount, self.capacity)
+        if self._available >= 0:
+            return 0.0
+        return -self._available / self.refill_rate
+
+    def refund(self, amount: float) -> None:
+        self._refill()
+        self._available = min(self.capacity, self._available + amount)
+
+
+class RateLimiter:
+    def __init__(
+            self,
+            requests_per_minute: Optional[int] = None,
+            tokens_per_minute: Optional[int] = None,
+            max_concurrency: int = 64,
+            min_concurrency: int = 1,
+            safety_margin: float = 0.95,
+            backoff_base: float = 1.0,
+            backoff_max: float = 60.0,
+            decrease_factor: float = 0.5,
+    ):
+        assert 0 < min_concurrency <= max_concurrency
+        assert 0 < decrease_factor < 1
+
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.decrease_factor = decrease_factor
+
+        self._requests_bucket: Optional[TokenBucket] = None
+        if requests_per_minute is not None:
+            self._requests_bucket = TokenBucket(capacity_per_minute=requests_per_minute * safety_margin)
+
+        self._tokens_bucket: Optional[TokenBucket] = None
+        if tokens_per_minute is not None:
+            self._tokens_bucket = TokenBucket(capacity_per_minute=tokens_per_minute * safety_margin)
+
+        self._lock = threading.Lock()
+        self._concurrency = float(max_concurrency)
+        self._in_flight = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._condition_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self.num_requests = 0
+        self.num_rate_limits = 0
+        self.num_retries = 0
+        self.num_used_tokens = 0
+
+    @property
+    def concurrency(self) -> int:
+        return int(self._concurrency)
+
+    def reserve(self, num_tokens: int) -> float:
+        delay = 0.0
+        with self._lock:
+            if self._requests_bucket is not None:
+                delay = max(delay, self._requests_bucket.reserve(amount=1))
+            if self._tokens_bucket is not None:
+                delay = max(delay, self._tokens_bucket.reserve(amount=num_tokens))
+        return delay
+
+    def reconcile(self, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        with self._lock:
+            self.num_requests += 1
+            if used_tokens is None:
+                return
+            self.num_used_tokens += used_tokens
+            if self._tokens_bucket is not None:
+                self._tokens_bucket.refund(amount=estimated_tokens - used_tokens)
+
+    def on_success(self) -> None:
+        # Additive increase: about +1 concurrency slot per `concurrency` successful requests
+        with self._lock:
+            self._concurrency = min(self.max_concurrency, self._concurrency + 1 / self._concurrency)
+
+    def on_error(self, exception: BaseException) -> None:
+        with self._lock:
+            self.num_retries += 1
+            if is_rate_limit_error(exception):
+                self.num_rate_limits += 1
+                self._concurrency = max(self.min_concurrency, self._concurrency * self.decrease_factor)
+
+    def backoff_delay(self, attempt: int, exception: Optional[BaseException] = None) -> float:
+        # Exponential backoff with full jitter, never shorter than the server's retry-after hint
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+        retry_after = get_retry_after(exception) if exception is not None else None
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._condition_loop is not loop:
+            self._condition = asyncio.Condition()
+            self._condition_loop = loop
+        return self._condition
+
+    async def acquire(self, num_tokens: int) -> None:
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self._in_flight < self.concurrency)
+            self._in_flight += 1
+
+        # The slot is taken before the rate limit wait, so it is given back if the wait is cancelled
+        try:
+            delay = self.reserve(num_tokens=num_tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            await self.release()
+            raise
+
+    async def release(self) -> None:
+        condition = self._get_condition()
+        async with condition:
+            self._in_flight -= 1
+            condition.notify_all()
+
+    def log_stats(self) -> None:
+        logger.info(
+            f"Requests: {self.num_requests}. Used tokens: {self.num_used_tokens}. Retries: {self.num_retries}. "
+            f"Rate limits: {self.num_rate_limits}. Concurrency: {self.concurrency}"
+        )
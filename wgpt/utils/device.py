@@ -0,0 +1,61 @@
+# Copyright 2023 Boris Zubarev. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from typing import List, Optional
+
+import torch
+from loguru import logger
+
+
+def get_accelerators() -> List[str]:
+    if torch.cuda.is_available():
+        return [f"cuda:{index}" for index in range(torch.cuda.device_count())]
+
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return ["mps"]
+
+    return list()
+
+
+def resolve_device(device: Optional[str] = None, cuda_index: int = 0) -> str:
+    if device is not None:
+        return device
+
+    accelerators = get_accelerators()
+    if not accelerators:
+        return "cpu"
+
+    if accelerators[0].startswith("cuda"):
+        return f"cuda:{cuda_index}"
+
+    return accelerators[0]
+
+
+def setup_cpu_threads(num_threads: Optional[int] = None) -> int:
+    # Threads are limited to cpus available to the process, not all cpus of the host, otherwise containers
+    # oversubscribe. Interop threads are of no use for one generate call at a time
+    if num_threads is None:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can be set only once and before any parallel work started
+        pass
+
+    logger.info(f"CPU threads: {num_threads}")
+
+    return num_threads